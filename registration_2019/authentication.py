@@ -3,9 +3,11 @@ import re
 from flask_restful import Resource, reqparse, abort
 from argparse import ArgumentTypeError
 from google.oauth2 import id_token
+from google.auth.exceptions import TransportError
 from google.auth.transport import requests
 from .core import app, api
 from .helper import jwt_string, create_jwt, is_authenticated, strn
+from .breakers import Dependency, CircuitOpen, outbound_timeout
 
 # @auth decorator
 
@@ -23,6 +25,21 @@ def auth(f):
         return f(*args, **kwargs)
     return wrapper
 
+# Google sign-in
+
+class TimeoutRequest(requests.Request):
+    """google-auth's transport, with the outbound timeouts unless a call gives its own"""
+
+    def __call__(self, url, method='GET', body=None, headers=None, timeout=None, **kwargs):
+        return requests.Request.__call__(self, url, method=method, body=body, headers=headers,
+                                         timeout=timeout or outbound_timeout(), **kwargs)
+
+# one session, so connections to Google are reused
+google_request = TimeoutRequest()
+
+# only not reaching Google counts against its breaker, not invalid tokens
+google_certs = Dependency('google', lambda e: isinstance(e, TransportError))
+
 # endpoints
 
 class Login(Resource):
@@ -36,21 +53,18 @@ class Login(Resource):
         args = self.parser.parse_args()
         token = args['token']
 
-        success = False
+        # verified once (fetching Google's certificates once), then checked against both client ids
         try:
-            idinfo = id_token.verify_oauth2_token(token, requests.Request(), app.config['GOOGLE_CLIENT_ID'])
-            success = True
+            idinfo = google_certs.call(id_token.verify_token, token, google_request, certs_url=app.config['GOOGLE_CERTS_URL'])
+        except (CircuitOpen, TransportError):
+            return {"message": "Google sign-in is unavailable, try again later"}, 503
         except:
-            pass
-        try:
-            idinfo = id_token.verify_oauth2_token(token, requests.Request(), app.config['GOOGLE_CLIENT_ID_IOS'])
-            success = True
-        except:
-            pass
-        if not success:
             return {"message": "Could not authenticate"}, 401
 
-        if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com'] or idinfo['hd'] != app.config['GSUITE_DOMAIN_NAME']:
+        if idinfo.get('aud') not in [app.config['GOOGLE_CLIENT_ID'], app.config['GOOGLE_CLIENT_ID_IOS']]:
+            return {"message": "Could not authenticate"}, 401
+
+        if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com'] or idinfo.get('hd') != app.config['GSUITE_DOMAIN_NAME']:
             return {"message": "Could not authenticate"}, 401
 
         email_address = idinfo['email']
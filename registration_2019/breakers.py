@@ -0,0 +1,188 @@
+import collections
+import json
+import socketserver
+import threading
+import time
+import click
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from .core import app
+
+# Calls to other services (SES, Google) go through a circuit breaker: after LAH_BREAKER_FAILURES
+# failures in a row (timeouts, connection errors, 5xx), calls fail straight away with CircuitOpen for
+# LAH_BREAKER_RESET seconds, then one call is let through to see if the service is back. Failed calls
+# are retried only while the retry budget lasts: each successful call earns LAH_RETRY_BUDGET of a
+# retry, so retries can't multiply the load on a service that's struggling
+
+# retries a dependency can save up
+MAX_RETRY_TOKENS = 10
+
+# latencies kept for the percentiles
+LATENCY_SAMPLES = 1000
+
+# name -> Dependency
+dependencies = collections.OrderedDict()
+
+## Helpers
+
+def outbound_timeout():
+    """(connect, read) timeouts in seconds, as requests takes them"""
+    return app.config['OUTBOUND_CONNECT_TIMEOUT'], app.config['OUTBOUND_READ_TIMEOUT']
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a dependency while its breaker is open"""
+
+    def __init__(self, name):
+        Exception.__init__(self, name + " is unavailable")
+        self.name = name
+
+class Dependency:
+    """A service called through a circuit breaker, with a retry budget and the latencies of its calls.
+    `is_failure` tells the exceptions that mean the service is unhealthy from those that don't
+    (e.g. an invalid token)"""
+
+    def __init__(self, name, is_failure):
+        self.name = name
+        self.is_failure = is_failure
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0 # in a row
+        self.opened = None
+        self.probing = False
+        self.retry_tokens = MAX_RETRY_TOKENS
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.counts = collections.Counter()
+
+        dependencies[name] = self
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open' and time.time() - self.opened >= app.config['BREAKER_RESET']:
+                self.state = 'half_open'
+
+            # while half open, a single call at a time finds out if the service is back
+            if self.state == 'open' or (self.state == 'half_open' and self.probing):
+                self.counts['rejected'] += 1
+                raise CircuitOpen(self.name)
+
+            if self.state == 'half_open':
+                self.probing = True
+
+    def record(self, started, failed):
+        with self.lock:
+            self.latencies.append(time.time() - started)
+            self.counts['calls'] += 1
+            self.probing = False
+
+            if failed:
+                self.counts['failures'] += 1
+                self.failures += 1
+                if self.state == 'half_open' or self.failures >= app.config['BREAKER_FAILURES']:
+                    if self.state != 'open':
+                        self.counts['opened'] += 1
+                    self.state, self.opened = 'open', time.time()
+            else:
+                self.failures = 0
+                self.state = 'closed'
+                self.retry_tokens = min(MAX_RETRY_TOKENS, self.retry_tokens + app.config['RETRY_BUDGET'])
+
+    def take_retry(self):
+        with self.lock:
+            if self.state != 'closed' or self.retry_tokens < 1:
+                return False
+
+            self.retry_tokens -= 1
+            self.counts['retries'] += 1
+            return True
+
+    def call(self, f, *args, **kwargs):
+        while True:
+            self.allow()
+            started = time.time()
+
+            try:
+                result = f(*args, **kwargs)
+            except Exception as e:
+                failed = self.is_failure(e)
+                self.record(started, failed)
+                if failed and self.take_retry():
+                    continue
+                raise
+
+            self.record(started, False)
+            return result
+
+    def status(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+
+            def percentile(p):
+                return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3) if latencies else None
+
+            return {'name': self.name,
+                    'state': self.state,
+                    'failures_in_a_row': self.failures,
+                    'opened': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(self.opened)) if self.opened else None,
+                    'retry_tokens': round(self.retry_tokens, 3),
+                    'calls': self.counts['calls'],
+                    'failed': self.counts['failures'],
+                    'rejected': self.counts['rejected'],
+                    'retries': self.counts['retries'],
+                    'times_opened': self.counts['opened'],
+                    'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99),
+                                   'max': percentile(1)}}
+
+## Stand-ins (slow SES and Google, to try timeouts and breakers locally)
+
+# as SES answers when it's unavailable
+FAILURE = (b'<ErrorResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/"><Error><Type>Receiver</Type>'
+           b'<Code>ServiceUnavailable</Code><Message>Stand-in failure</Message></Error>'
+           b'<RequestId>stand-in</RequestId></ErrorResponse>')
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def stand_in_handler(delay, fail):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def respond(self, status, content_type, body):
+            time.sleep(delay)
+            if fail:
+                status, content_type, body = 500, 'text/xml', FAILURE
+
+            try:
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # the caller timed out
+                pass
+
+        # Google's signing certificates (none, so tokens don't verify)
+        def do_GET(self):
+            self.respond(200, 'application/json', json.dumps({}).encode())
+
+        # SES's SendEmail (and every other action gets the same answer)
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.respond(200, 'text/xml', b'<SendEmailResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">'
+                                          b'<SendEmailResult><MessageId>stand-in</MessageId></SendEmailResult>'
+                                          b'<ResponseMetadata><RequestId>stand-in</RequestId></ResponseMetadata>'
+                                          b'</SendEmailResponse>')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+@app.cli.command('stand-in')
+@click.option('--port',  default=9001, help="Port to listen on")
+@click.option('--delay', default=0.0,  help="Seconds to wait before each response")
+@click.option('--fail',  is_flag=True, help="Answer with 500s")
+def stand_in_command(port, delay, fail):
+    """Serve slow (or failing) stand-ins for SES and Google, for LAH_SES_ENDPOINT and LAH_GOOGLE_CERTS_URL"""
+    server = StandInServer(('127.0.0.1', port), stand_in_handler(delay, fail))
+    click.echo("Stand-in listening on http://127.0.0.1:" + str(port))
+    server.serve_forever()
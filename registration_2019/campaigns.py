@@ -0,0 +1,411 @@
+import datetime
+import enum
+import json
+import threading
+import time
+import click
+from botocore.exceptions import ClientError, BotoCoreError
+from sqlalchemy import Column, String, Integer, Float, Enum, ForeignKey, DateTime, Text, UniqueConstraint, Index, func, bindparam
+from flask_restful import Resource, reqparse
+from .core import api, db, app
+from .helper import *
+from .authentication import auth
+from .emailing import client, ses, format_email, TEMPLATES
+from .breakers import CircuitOpen
+from .registration import signups, AcceptanceStatusEnum
+from .mentor import mentors
+from .guest import guests, GuestKindEnum
+from .event_model import Event, current_event_id, event_closed, open_event
+
+# A campaign sends one template to every current participant of a kind matching a filter.
+# Recipients are written down when the campaign is created, and each one is marked as it is sent,
+# so an interrupted campaign resumes where it left off. Recipients that were being sent when it was
+# interrupted are marked `unknown` rather than sent again
+#
+# Each run of a campaign gets a runner token when it claims it. Recipients are claimed with the token
+# before being sent, and the runner checks in (which also checks it still holds the campaign) before every
+# batch and while it waits, so a runner that was taken over stops instead of sending alongside the new one
+
+# SES accepts at most 50 destinations per bulk call
+BATCH_SIZE = 50
+
+# attempts at a bulk call that SES rejected (e.g. throttled), nothing is sent when it's rejected
+SEND_ATTEMPTS = 3
+
+# a running campaign that hasn't checked in for this long is assumed to have crashed, and can be resumed
+STALE_AFTER = datetime.timedelta(minutes=1)
+
+# how often a running campaign checks in, including while it waits to keep to its send rate
+CHECK_IN_EVERY = datetime.timedelta(seconds=15)
+
+PARTICIPANTS = {
+    'attendee': signups,
+    'mentor':   mentors,
+    'guest':    guests,
+}
+
+## Models
+
+class CampaignStatusEnum(enum.Enum):
+    pending = "pending"
+    running = "running"
+    done    = "done"
+
+class RecipientStatusEnum(enum.Enum):
+    pending = "pending"
+    sending = "sending"
+    sent    = "sent"
+    failed  = "failed"
+    unknown = "unknown"
+
+class Campaign(db.Model):
+    id          = Column(Integer,                  nullable=False, primary_key=True)
+    event_id    = Column(Integer,                  ForeignKey(Event.id), nullable=False, default=current_event_id)
+    name        = Column(String(255),              nullable=False)
+    template    = Column(String(64),               nullable=False)
+    kind        = Column(String(16),               nullable=False)
+    send_rate   = Column(Float,                    nullable=False)
+    status      = Column(Enum(CampaignStatusEnum), nullable=False, default=CampaignStatusEnum.pending)
+    created     = Column(DateTime,                 nullable=False, default=datetime.datetime.utcnow)
+    started     = Column(DateTime)
+    finished    = Column(DateTime)
+    heartbeat   = Column(DateTime)
+    runner      = Column(String(36)) # token of the run sending it, see claim
+
+class CampaignRecipient(db.Model):
+    id             = Column(Integer,                   nullable=False, primary_key=True)
+    campaign_id    = Column(Integer,                   ForeignKey(Campaign.id), nullable=False)
+    participant_id = Column(String(36),                nullable=False)
+    email          = Column(String(255),               nullable=False)
+    data           = Column(Text,                      nullable=False)
+    status         = Column(Enum(RecipientStatusEnum), nullable=False, default=RecipientStatusEnum.pending)
+    message_id     = Column(String(255))
+    error          = Column(String(1000))
+    sent_at        = Column(DateTime)
+    runner         = Column(String(36)) # token of the run that claimed it
+
+    __table_args__ = (UniqueConstraint('campaign_id', 'participant_id'),
+                      Index('campaign_recipient_status', 'campaign_id', 'status', 'id'))
+
+## Helpers
+
+class Placeholders(dict):
+    # fills in every field as an SES template tag, which SES replaces per recipient
+    def __missing__(self, key):
+        return '{{' + key + '}}'
+
+def ses_template_name(template):
+    return 'lah-' + template
+
+def sync_template(template):
+    subject, text, html = format_email(template, Placeholders())
+    ses_template = {'TemplateName': ses_template_name(template), 'SubjectPart': subject, 'TextPart': text, 'HtmlPart': html}
+
+    try:
+        ses.call(client.get_template, TemplateName=ses_template['TemplateName'])
+    except ClientError:
+        ses.call(client.create_template, Template=ses_template)
+    else:
+        ses.call(client.update_template, Template=ses_template)
+
+def recipient_data(kind, participant):
+    if kind == 'attendee':
+        first_name = participant['first_name']
+        full_name = participant['first_name'] + ' ' + participant['surname']
+    else:
+        first_name = participant['name'].split(' ', 1)[0]
+        full_name = participant['name']
+
+    return json.dumps({**participant, 'first_name': first_name, 'full_name': full_name})
+
+def create_campaign(name, template, kind, send_rate, query):
+    participants = PARTICIPANTS[kind]
+    id_key = participants.id_column.name
+
+    campaign = Campaign(name=name, template=template, kind=kind, send_rate=send_rate)
+    db.session.add(campaign)
+    db.session.flush()
+
+    selected = participants.search(query) if query else participants.list()
+    db.session.bulk_insert_mappings(CampaignRecipient, [{'campaign_id': campaign.id,
+                                                         'participant_id': x[id_key],
+                                                         'email': x['email'],
+                                                         'data': recipient_data(kind, x),
+                                                         'status': RecipientStatusEnum.pending} for x in selected])
+    db.session.commit()
+
+    return campaign
+
+# returns the runner token to send the campaign with, or None if it can't be run
+def claim(campaign_id):
+    now = datetime.datetime.utcnow()
+    runner = rand_uuid()
+
+    # conditional update, so only one runner can send a campaign at a time
+    claimed = (Campaign.query.filter(Campaign.id == campaign_id, Campaign.event_id == current_event_id(),
+                                     (Campaign.status == CampaignStatusEnum.pending) |
+                                     ((Campaign.status == CampaignStatusEnum.running) & (Campaign.heartbeat < now - STALE_AFTER)))
+                             .update({'status': CampaignStatusEnum.running,
+                                      'runner': runner,
+                                      'heartbeat': now,
+                                      'started': func.coalesce(Campaign.started, now)}, synchronize_session=False))
+    db.session.commit()
+
+    return runner if claimed > 0 else None
+
+def check_in(campaign_id, runner):
+    # False if another runner has taken the campaign over (or it's no longer running)
+    kept = (Campaign.query.filter_by(id=campaign_id, runner=runner, status=CampaignStatusEnum.running)
+                          .update({'heartbeat': datetime.datetime.utcnow()}, synchronize_session=False))
+    db.session.commit()
+
+    return kept > 0
+
+def wait(campaign_id, runner, seconds):
+    # sleeps in slices, checking in after each one, returns False if the campaign was taken over meanwhile
+    until = time.time() + seconds
+    while True:
+        left = until - time.time()
+        if left <= 0:
+            return True
+        time.sleep(min(left, CHECK_IN_EVERY.total_seconds()))
+        if not check_in(campaign_id, runner):
+            return False
+
+# the next recipients claimed for `runner`, or None once there are none left to send
+def claim_batch(campaign_id, runner):
+    table = CampaignRecipient.__table__
+    ids = [x for x, in db.session.query(CampaignRecipient.id)
+                                 .filter_by(campaign_id=campaign_id, status=RecipientStatusEnum.pending)
+                                 .order_by(CampaignRecipient.id)
+                                 .limit(BATCH_SIZE)]
+    if not ids:
+        return None
+
+    # conditional update, so a recipient another runner claimed in the meantime isn't sent twice
+    db.session.execute(table.update().where((table.c.id.in_(ids)) & (table.c.status == RecipientStatusEnum.pending))
+                                     .values(status=RecipientStatusEnum.sending, runner=runner))
+    db.session.commit()
+
+    return (db.session.query(CampaignRecipient.id, CampaignRecipient.email, CampaignRecipient.data)
+                      .filter(CampaignRecipient.id.in_(ids),
+                              CampaignRecipient.runner == runner,
+                              CampaignRecipient.status == RecipientStatusEnum.sending)
+                      .order_by(CampaignRecipient.id)
+                      .all())
+
+def mark_interrupted(campaign_id):
+    # these may or may not have gone out, so they aren't sent again
+    (CampaignRecipient.query.filter_by(campaign_id=campaign_id, status=RecipientStatusEnum.sending)
+                            .update({'status': RecipientStatusEnum.unknown}, synchronize_session=False))
+    db.session.commit()
+
+def send_batch(template, batch):
+    destinations = [{'Destination': {'ToAddresses': [email]}, 'ReplacementTemplateData': data} for _, email, data in batch]
+
+    error = None
+    for attempt in range(SEND_ATTEMPTS):
+        try:
+            response = ses.call(client.send_bulk_templated_email, Source=app.config['SES_SENDER'],
+                                                                  Template=ses_template_name(template),
+                                                                  DefaultTemplateData=json.dumps({'api_endpoint': app.config['API_ENDPOINT']}),
+                                                                  Destinations=destinations)
+            return [(s.get('MessageId'), None if s['Status'] == 'Success' else s.get('Error', s['Status']))
+                    for s in response['Status']]
+        except ClientError as e:
+            error = e.response['Error']['Message']
+            time.sleep(2 ** attempt)
+        except (BotoCoreError, CircuitOpen) as e:
+            error = str(e)
+            time.sleep(2 ** attempt)
+
+    return [(None, error)] * len(batch)
+
+def record_results(runner, batch, results):
+    table = CampaignRecipient.__table__
+    now = datetime.datetime.utcnow()
+
+    db.session.execute(table.update().where((table.c.id == bindparam('recipient_id')) & (table.c.runner == runner)),
+                       [{'recipient_id': recipient_id,
+                         'status': RecipientStatusEnum.failed if error else RecipientStatusEnum.sent,
+                         'message_id': message_id,
+                         'error': error[:1000] if error else None,
+                         'sent_at': now}
+                        for (recipient_id, _, _), (message_id, error) in zip(batch, results)])
+
+def run_campaign(campaign_id, runner):
+    """Sends the campaign claimed as `runner`. Returns False if another runner took it over"""
+    mark_interrupted(campaign_id)
+
+    campaign = Campaign.query.get(campaign_id)
+    template, send_rate = campaign.template, campaign.send_rate
+    sync_template(template)
+
+    try:
+        while True:
+            if not check_in(campaign_id, runner):
+                return False
+
+            started = time.time()
+
+            # checkpoint the batch before sending it
+            batch = claim_batch(campaign_id, runner)
+            if batch is None:
+                break
+            if not batch:
+                continue
+
+            record_results(runner, batch, send_batch(template, batch))
+            db.session.commit()
+
+            # throttle to the campaign's send rate
+            if not wait(campaign_id, runner, len(batch) / send_rate - (time.time() - started)):
+                return False
+    except Exception:
+        # let it be resumed straight away, unless it was already taken over
+        db.session.rollback()
+        if (Campaign.query.filter_by(id=campaign_id, runner=runner)
+                          .update({'status': CampaignStatusEnum.pending}, synchronize_session=False)):
+            mark_interrupted(campaign_id)
+        db.session.commit()
+        raise
+
+    (Campaign.query.filter_by(id=campaign_id, runner=runner)
+                   .update({'status': CampaignStatusEnum.done, 'finished': datetime.datetime.utcnow()}, synchronize_session=False))
+    db.session.commit()
+    return True
+
+def run_in_background(campaign_id, runner):
+    def run():
+        with app.app_context():
+            try:
+                if not run_campaign(campaign_id, runner):
+                    print("Campaign " + str(campaign_id) + " was taken over by another runner")
+            except Exception as e:
+                print("Campaign " + str(campaign_id) + " interrupted: " + str(e))
+
+    threading.Thread(target=run, daemon=True).start()
+
+def summary(campaign):
+    counts = dict(db.session.query(CampaignRecipient.status, func.count(CampaignRecipient.id))
+                            .filter_by(campaign_id=campaign.id)
+                            .group_by(CampaignRecipient.status))
+    last_sent = db.session.query(func.max(CampaignRecipient.sent_at)).filter_by(campaign_id=campaign.id).scalar()
+    failures = (db.session.query(CampaignRecipient.email, CampaignRecipient.error)
+                          .filter_by(campaign_id=campaign.id, status=RecipientStatusEnum.failed)
+                          .order_by(CampaignRecipient.id)
+                          .limit(100))
+
+    sent = counts.get(RecipientStatusEnum.sent, 0) + counts.get(RecipientStatusEnum.failed, 0)
+    elapsed = (last_sent - campaign.started).total_seconds() if last_sent and campaign.started else None
+
+    return {
+        'id': campaign.id,
+        'name': campaign.name,
+        'template': campaign.template,
+        'kind': campaign.kind,
+        'send_rate': campaign.send_rate,
+        'status': help_jsonify(campaign.status),
+        'created': help_jsonify(campaign.created),
+        'started': help_jsonify(campaign.started),
+        'finished': help_jsonify(campaign.finished),
+        'recipients': {s.value: counts.get(s, 0) for s in RecipientStatusEnum},
+        'throughput': sent / elapsed if elapsed else None, # emails per second
+        'failures': [{'email': email, 'error': error} for email, error in failures],
+    }
+
+# the templates recipient_data fills in (confirmations need an email verification token, which is only
+# made when the participant signs up or changes their email)
+CAMPAIGN_TEMPLATES = ['acceptance', 'waitlisted']
+
+def template_name(x):
+    if x not in TEMPLATES:
+        raise ArgumentTypeError("Unknown template")
+    if x not in CAMPAIGN_TEMPLATES:
+        raise ArgumentTypeError("Template can't be sent in a campaign")
+    return x
+
+## Endpoints
+
+class CampaignCreateEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+    nested_parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('name',      type=strn,          required=True)
+        self.parser.add_argument('template',  type=template_name, required=True)
+        self.parser.add_argument('kind',      type=strn,          required=True, choices=PARTICIPANTS.keys())
+        self.parser.add_argument('send_rate', type=float,         default=app.config['SES_SEND_RATE'])
+        self.parser.add_argument('filter',    type=dict,          default={})
+
+        self.nested_parser.add_argument('acceptance_status', type=AcceptanceStatusEnum, location='filter')
+        self.nested_parser.add_argument('email_verified',    type=boolean,              location='filter')
+        self.nested_parser.add_argument('signed_waiver',     type=boolean,              location='filter')
+        self.nested_parser.add_argument('kind',              type=GuestKindEnum,        location='filter')
+
+    @auth
+    @open_event
+    def post(self):
+        args = self.parser.parse_args()
+
+        if args['send_rate'] <= 0:
+            return {"message": "send_rate must be positive"}, 400
+
+        query = remove_none_values(self.nested_parser.parse_args(req=args))
+        campaign = create_campaign(args['name'], args['template'], args['kind'], args['send_rate'], query)
+
+        return summary(campaign)
+
+class CampaignRunEndpoint(Resource):
+
+    @auth
+    @open_event
+    def post(self, campaign_id):
+        runner = claim(campaign_id)
+        if not runner:
+            return {"message": "Campaign does not exist, or is already running or done"}, 400
+
+        run_in_background(campaign_id, runner)
+        return {"status": "ok"}
+
+class CampaignStatusEndpoint(Resource):
+
+    @auth
+    def get(self, campaign_id):
+        campaign = Campaign.query.filter_by(id=campaign_id, event_id=current_event_id()).scalar()
+        if not campaign:
+            return {"message": "Campaign does not exist"}, 400
+
+        return summary(campaign)
+
+class CampaignListEndpoint(Resource):
+
+    @auth
+    def get(self):
+        return [summary(x) for x in Campaign.query.filter_by(event_id=current_event_id()).order_by(Campaign.id)]
+
+api.add_resource(CampaignCreateEndpoint, '/campaign/v1/create')
+api.add_resource(CampaignRunEndpoint,    '/campaign/v1/run/<int:campaign_id>')
+api.add_resource(CampaignStatusEndpoint, '/campaign/v1/status/<int:campaign_id>')
+api.add_resource(CampaignListEndpoint,   '/campaign/v1/list')
+
+## Command (to resume a campaign after a crash, or run one in the foreground)
+
+@app.cli.command('campaign-run')
+@click.argument('campaign_id', type=int)
+def campaign_run_command(campaign_id):
+    """Send (or resume sending) a campaign of the current event"""
+    if event_closed(current_event_id()):
+        raise click.UsageError("The current event (LAH_EVENT) is closed")
+
+    runner = claim(campaign_id)
+    if not runner:
+        raise click.UsageError("Campaign does not exist, or is already running or done")
+
+    if not run_campaign(campaign_id, runner):
+        click.echo("Stopped, the campaign was taken over by another runner")
+
+    campaign = Campaign.query.get(campaign_id)
+    click.echo(json.dumps(summary(campaign)['recipients']))
@@ -0,0 +1,202 @@
+import datetime
+import enum
+import click
+from sqlalchemy import Column, String, Integer, Enum, DateTime, event, select
+from flask_restful import Resource, reqparse
+from .core import api, db, app
+from .helper import help_jsonify, bulk_key
+from .authentication import auth
+from .routing import replica_read
+from .registration import Signup, EmailVerification
+from .mentor import Mentor, MentorEmailVerification
+from .guest import Guest
+from .dayof_model import SignIn, MealServing
+from .email_list import EmailSubscription
+
+# Every write to these tables is appended to the change log in the same transaction, along with the
+# column consumers know the row by. The log's ids are the cursors consumers sync from
+KEYS = {
+    Signup:                  Signup.user_id,
+    EmailVerification:       EmailVerification.user_id,
+    Mentor:                  Mentor.mentor_id,
+    MentorEmailVerification: MentorEmailVerification.mentor_id,
+    Guest:                   Guest.guest_id,
+    SignIn:                  SignIn.badge_data,
+    MealServing:             MealServing.id,
+    EmailSubscription:       EmailSubscription.email,
+}
+
+TABLE_KEYS = {model.__table__.name: column for model, column in KEYS.items()}
+
+# A missing id in the log is a transaction that hasn't committed yet (or was rolled back).
+# Changes after a gap younger than this aren't returned yet, so they can't be skipped over
+SETTLE_TIME = datetime.timedelta(seconds=10)
+
+MAX_LIMIT = 10000
+
+# changes read at a time by in-memory indexes catching up (and looked at to find the settled head)
+CATCH_UP_BATCH = 1000
+
+## Models
+
+class OperationEnum(enum.Enum):
+    insert = "insert"
+    update = "update"
+    delete = "delete"
+
+class Change(db.Model):
+    id         = Column(Integer,             nullable=False, primary_key=True)
+    table_name = Column(String(64),          nullable=False)
+    row_key    = Column(String(255)) # null when a bulk write's rows aren't known
+    operation  = Column(Enum(OperationEnum), nullable=False)
+    timestamp  = Column(DateTime,            nullable=False, default=datetime.datetime.utcnow)
+
+## Helpers
+
+def log_changes(connection, changes):
+    if changes:
+        now = datetime.datetime.utcnow()
+        connection.execute(Change.__table__.insert(), [{'table_name': table_name, 'row_key': row_key,
+                                                        'operation': operation, 'timestamp': now}
+                                                       for table_name, row_key, operation in changes])
+
+def row_change(obj, operation):
+    column = TABLE_KEYS.get(obj.__table__.name)
+    if column is None:
+        return None
+    return (obj.__table__.name, getattr(obj, column.key), operation)
+
+@event.listens_for(db.session, 'after_flush')
+def track_flush(session, flush_context):
+    changes = [row_change(x, OperationEnum.insert) for x in session.new]
+    changes += [row_change(x, OperationEnum.update) for x in session.dirty if session.is_modified(x)]
+    changes += [row_change(x, OperationEnum.delete) for x in session.deleted]
+
+    log_changes(session.connection(), [x for x in changes if x])
+
+def track_bulk(context, operation):
+    table_name = context.mapper.local_table.name
+    column = TABLE_KEYS.get(table_name)
+
+    if column is None or not context.result.rowcount:
+        return
+
+    whereclause = context.query.whereclause
+    row_key = bulk_key(whereclause, column) if whereclause is not None else None
+
+    log_changes(context.session.connection(), [(table_name, row_key, operation)])
+
+@event.listens_for(db.session, 'after_bulk_update')
+def track_bulk_update(context):
+    track_bulk(context, OperationEnum.update)
+
+@event.listens_for(db.session, 'after_bulk_delete')
+def track_bulk_delete(context):
+    track_bulk(context, OperationEnum.delete)
+
+def settled(changes, since, now):
+    expected = since + 1
+
+    for i, x in enumerate(changes):
+        if x.id != expected and x.timestamp > now - SETTLE_TIME:
+            return changes[:i]
+        expected = x.id + 1
+
+    return changes
+
+def head():
+    return db.session.query(db.func.max(Change.id)).scalar() or 0
+
+# the change log position everything committed so far is up to, skipping changes after a recent gap
+# (a transaction that hasn't committed yet), like changes_since does
+def settled_head(connection):
+    recent = list(connection.execute(select([Change.id, Change.timestamp]).order_by(Change.id.desc()).limit(CATCH_UP_BATCH)))[::-1]
+    if not recent:
+        return 0
+
+    since = recent[0].id - 1
+    returned = settled(recent, since, datetime.datetime.utcnow())
+    return returned[-1].id if returned else since
+
+def changed_keys_since(cursor, table_names, limit=None):
+    """For in-memory indexes to catch up: the keys of the rows of `table_names` written after `cursor`,
+    as `(new cursor, {table name: set of keys})`, or None if the index has to be rebuilt instead (a write
+    whose rows aren't known, or more than `limit` keys). Stops at a gap that hasn't settled yet instead of
+    waiting for it, so the index is served as it is and picks the rest up on a later call"""
+    keys = {name: set() for name in table_names}
+
+    while True:
+        feed = changes_since(cursor, CATCH_UP_BATCH)
+
+        for change in feed['changes']:
+            if change['table'] not in keys:
+                continue
+            if change['key'] is None:
+                return None
+            keys[change['table']].add(change['key'])
+
+        if limit is not None and sum(len(x) for x in keys.values()) > limit:
+            return None
+
+        # no progress: the next change is behind a gap (which can't fill within this transaction's snapshot)
+        if not feed['more'] or feed['cursor'] == cursor:
+            return feed['cursor'], keys
+
+        cursor = feed['cursor']
+
+def changes_since(since, limit):
+    now = datetime.datetime.utcnow()
+    changes = Change.query.filter(Change.id > since).order_by(Change.id).limit(limit + 1).all()
+    returned = settled(changes[:limit], since, now)
+
+    return {
+        'changes': [{'cursor': x.id,
+                     'table': x.table_name,
+                     'key': x.row_key,
+                     'operation': x.operation.value,
+                     'timestamp': help_jsonify(x.timestamp)} for x in returned],
+        'cursor': returned[-1].id if returned else since,
+        'more': len(changes) > len(returned),
+    }
+
+## Endpoints
+
+class ChangesEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('since', type=int, location='args')
+        self.parser.add_argument('limit', type=int, location='args', default=1000)
+
+    @auth
+    @replica_read
+    def get(self):
+        args = self.parser.parse_args()
+
+        if args['limit'] < 1 or args['limit'] > MAX_LIMIT:
+            return {"message": "limit must be between 1 and " + str(MAX_LIMIT)}, 400
+
+        # without a cursor, only the current position is returned (to start following from after a full sync)
+        if args['since'] is None:
+            return {'changes': [], 'cursor': head(), 'more': False}
+
+        return changes_since(args['since'], args['limit'])
+
+api.add_resource(ChangesEndpoint, '/changes/v1')
+
+## Commands
+
+@app.cli.command('replica-lag')
+def replica_lag_command():
+    """Show how far behind the primary each read replica is, and whether reads go to it"""
+    window = app.config['READ_YOUR_WRITES_WINDOW']
+    replicas = db.replica_engines(app)
+
+    if not replicas:
+        click.echo("No replicas (LAH_REGISTRATION_DB_REPLICAS)")
+
+    for replica in replicas:
+        lag = db.replica_lag(app, replica)
+        click.echo("{}: {:.1f}s behind, {}".format(replica.url, lag, "read from" if lag <= window else "not read from"))
@@ -1,13 +1,19 @@
 import os
 from flask import Flask
 from flask_restful import Api
-from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+try:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+except ImportError: # werkzeug < 0.15
+    from werkzeug.contrib.fixers import ProxyFix
+from registration_2019.routing import RoutingSQLAlchemy
 
 # setup app
 app = Flask(__name__)
 cors = CORS(app, resources={r"/*": {"origins": "*"}}) # provides 'Access-Control-Allow-Origin' header
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['LAH_REGISTRATION_DB'] # required
+app.config['SQLALCHEMY_REPLICA_URIS'] = [uri for uri in os.environ.get('LAH_REGISTRATION_DB_REPLICAS', '').split(',') if uri]
+app.config['READ_YOUR_WRITES_WINDOW'] = float(os.environ.get('LAH_READ_YOUR_WRITES_WINDOW', 5))
 
 app.config['JWT_SECRET'] = os.environ.get('LAH_JWT_SECRET')
 app.config['DOCUSIGN_AUTH'] = os.environ.get('LAH_DOCUSIGN_AUTH')
@@ -17,12 +23,44 @@ app.config['GSUITE_DOMAIN_NAME'] = os.environ.get('LAH_GSUITE_DOMAIN_NAME')
 app.config['DISABLE_AUTHENTICATION'] = os.environ.get('LAH_DISABLE_AUTHENTICATION')
 app.config['SES_AWS_REGION'] = os.environ.get('LAH_SES_AWS_REGION')
 app.config['SES_SENDER'] = os.environ.get('LAH_SES_SENDER')
+app.config['FAKE_SES'] = os.environ.get('LAH_FAKE_SES')
+app.config['SES_SEND_RATE'] = float(os.environ.get('LAH_SES_SEND_RATE', 14)) # emails per second
 app.config['API_ENDPOINT'] = os.environ.get('LAH_API_ENDPOINT')
 app.config['CONFIRMATION_REDIRECT'] = os.environ.get('LAH_CONFIRMATION_REDIRECT')
+app.config['VENUE_CAPACITY'] = os.environ.get('LAH_VENUE_CAPACITY')
+app.config['DAYOF_ASYNC_PORT'] = int(os.environ.get('LAH_DAYOF_ASYNC_PORT', 5001))
+app.config['DAYOF_POOL_SIZE'] = int(os.environ.get('LAH_DAYOF_POOL_SIZE', 20))
+app.config['RATE_LIMIT_STORE'] = os.environ.get('LAH_RATE_LIMIT_STORE')
+app.config['VERIFICATION_SECRET'] = os.environ.get('LAH_VERIFICATION_SECRET') or app.config['JWT_SECRET']
+app.config['VERIFICATION_TTL'] = int(os.environ.get('LAH_VERIFICATION_TTL', 60 * 60 * 24 * 30)) # 30 days
+app.config['SQL_TRACE'] = os.environ.get('LAH_SQL_TRACE')
+app.config['SQL_TRACE_LOG'] = os.environ.get('LAH_SQL_TRACE_LOG')
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('LAH_SLOW_QUERY_MS', 100))
+app.config['EVENT'] = os.environ.get('LAH_EVENT', '2019') # slug of the current event
+app.config['EXPORT_DIR'] = os.environ.get('LAH_EXPORT_DIR', 'exports')
+app.config['OUTBOUND_CONNECT_TIMEOUT'] = float(os.environ.get('LAH_OUTBOUND_CONNECT_TIMEOUT', 2)) # seconds
+app.config['OUTBOUND_READ_TIMEOUT'] = float(os.environ.get('LAH_OUTBOUND_READ_TIMEOUT', 5)) # seconds
+app.config['BREAKER_FAILURES'] = int(os.environ.get('LAH_BREAKER_FAILURES', 5)) # failures in a row that open a breaker
+app.config['BREAKER_RESET'] = float(os.environ.get('LAH_BREAKER_RESET', 30)) # seconds before trying an open breaker's service again
+app.config['RETRY_BUDGET'] = float(os.environ.get('LAH_RETRY_BUDGET', 0.1)) # retries earned per successful call
+app.config['SES_ENDPOINT'] = os.environ.get('LAH_SES_ENDPOINT') # e.g. a local stand-in
+app.config['GOOGLE_CERTS_URL'] = os.environ.get('LAH_GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+app.config['ROSTER_SECRET'] = os.environ.get('LAH_ROSTER_SECRET') # shared with the kiosks, to check roster bundles
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('LAH_TRUSTED_PROXIES', 0)) # proxies in front of the app that set X-Forwarded-For
+
+# behind proxies, the client's address (e.g. for rate limits) is the one the closest trusted proxy saw
+if app.config['TRUSTED_PROXIES']:
+    try:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+    except TypeError: # werkzeug < 0.15
+        app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=app.config['TRUSTED_PROXIES'])
 
 # setup resp api and database
 api = Api(app)
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
+
+# json representation (with compression) used by all endpoints
+import registration_2019.serialization
 
 # load in the endpoints
 import registration_2019.email_list
@@ -33,6 +71,20 @@ import registration_2019.guest
 import registration_2019.dayof
 import registration_2019.discord
 import registration_2019.docusign
+import registration_2019.stats
+import registration_2019.promotion
+import registration_2019.ratelimit
+import registration_2019.campaigns
+import registration_2019.changes
+import registration_2019.skills
+import registration_2019.dedup
+import registration_2019.loadtest
+import registration_2019.tracing
+import registration_2019.export
+import registration_2019.events
+import registration_2019.lookup
+import registration_2019.roster
+import registration_2019.retention
 
 # create db tables
 db.create_all()
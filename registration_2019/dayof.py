@@ -1,79 +1,247 @@
 import datetime
+import click
 import enum
-from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime, func, and_
+from sqlalchemy.exc import IntegrityError
 from flask import redirect
 from flask_restful import Resource, reqparse
 from .core import api, db, app
 from .helper import *
 from .authentication import auth
+from .routing import replica_read
 from .registration import Signup
 from .mentor import Mentor
 from .guest import Guest
-from .dayof_model import SignIn
+from .dayof_model import SignIn, Meal, MealCount, MealServing, Passage, Occupancy, ParticipantKindEnum, DirectionEnum
+from .event_model import current_event_id, open_event
+from .participant import retry_stale
 
 # TODO write actual regex
 badge_data = re_matches(".*", "badge data")
 
-def sign_in(user_id, badge_data):
-    if SignIn.query.filter_by(badge_data=badge_data).scalar():
-        return {"messge": "badge_data already in use"}, 400
+def record_passage(sign_in, direction):
+    db.session.add(Passage(sign_in=sign_in, kind=sign_in.kind, direction=direction))
 
-    signup = Signup.query.filter_by(user_id=user_id, outdated=False).scalar()
-    if signup:
-        if signup.sign_in:
-            return {"message": "User already signed in"}, 400
-        sign_in = SignIn(badge_data=badge_data)
-        db.session.add(sign_in)
-        signup.sign_in = sign_in
-        db.session.commit()
-        return {"status": "ok"}
+    # one row per kind, so the headcount never has to be counted
+    occupancy = Occupancy.__table__
+    change = 1 if direction == DirectionEnum.entry else -1
+    db.session.execute(occupancy.update()
+                                .where(and_(occupancy.c.event_id == current_event_id(), occupancy.c.kind == sign_in.kind))
+                                .values(inside=occupancy.c.inside + change))
 
-    mentor = Mentor.query.filter_by(mentor_id=user_id, outdated=False).scalar()
-    if mentor:
-        if mentor.sign_in:
-            return {"message": "User already signed in"}, 400
-        sign_in = SignIn(badge_data=badge_data)
-        db.session.add(sign_in)
-        mentor.sign_in = sign_in
-        db.session.commit()
-        return {"status": "ok"}
+PARTICIPANTS = [
+    (Signup, Signup.user_id,   ParticipantKindEnum.attendee),
+    (Mentor, Mentor.mentor_id, ParticipantKindEnum.mentor),
+    (Guest,  Guest.guest_id,   ParticipantKindEnum.guest),
+]
+
+BADGE_IN_USE = {"message": "badge_data already in use"}, 400
+
+def add_sign_in(user_id, badge_data):
+    event_id = current_event_id()
 
-    guest = Guest.query.filter_by(guest_id=user_id, outdated=False).scalar()
-    if guest:
-        if guest.sign_in:
+    if SignIn.query.filter_by(event_id=event_id, badge_data=badge_data).scalar():
+        return BADGE_IN_USE
+
+    for model, id_column, kind in PARTICIPANTS:
+        participant = model.query.filter(model.event_id == event_id, id_column == user_id, model.outdated == False).scalar()
+        if not participant:
+            continue
+
+        if participant.sign_in:
             return {"message": "User already signed in"}, 400
-        sign_in = SignIn(badge_data=badge_data)
+
+        sign_in = SignIn(badge_data=badge_data, kind=kind)
         db.session.add(sign_in)
-        guest.sign_in = sign_in
+        participant.sign_in = sign_in
+        record_passage(sign_in, DirectionEnum.entry)
         db.session.commit()
         return {"status": "ok"}
 
     return {"message": "User ID not found"}, 400
 
-def sign_out(badge_data):
-    sign_in = SignIn.query.filter_by(badge_data=badge_data).scalar()
+def sign_in(user_id, badge_data):
+    try:
+        # setting the sign-in is a versioned update of the participant's row
+        return retry_stale(add_sign_in, user_id, badge_data)
+    except IntegrityError as e:
+        db.session.rollback()
+        # another kiosk scanned the same badge at the same time
+        if 'badge_data' in str(e.orig) or 'sign_in_event_badge' in str(e.orig):
+            return BADGE_IN_USE
+        raise
+
+# leaving (signing out) or coming back in. The check and the change are one conditional update, so two
+# scans of the same badge at once can't both record a passage and move the headcount
+def pass_through(badge_data, direction):
+    signed_out = direction == DirectionEnum.exit
+
+    sign_in = SignIn.query.filter_by(event_id=current_event_id(), badge_data=badge_data).scalar()
     if not sign_in:
         return {"message": "Invalid badge"}, 400
-    if sign_in.signed_out:
-        return {"message": "User already signed out"}, 400
-    sign_in.signed_out = True
+
+    moved = (SignIn.query.filter(SignIn.event_id == current_event_id(), SignIn.badge_data == badge_data,
+                                 SignIn.signed_out != signed_out)
+                         .update({'signed_out': signed_out}, synchronize_session=False))
+    if not moved:
+        db.session.rollback()
+        return {"message": "User already signed out" if signed_out else "User already signed in"}, 400
+
+    record_passage(sign_in, direction)
     db.session.commit()
     return {"status": "ok"}
 
+def sign_out(badge_data):
+    return pass_through(badge_data, DirectionEnum.exit)
+
+def enter(badge_data):
+    return pass_through(badge_data, DirectionEnum.entry)
+
+def occupancy():
+    inside = dict(db.session.query(Occupancy.kind, Occupancy.inside).filter(Occupancy.event_id == current_event_id()))
+    result = {kind.value: inside.get(kind, 0) for kind in ParticipantKindEnum}
+    result['total'] = sum(result.values())
+    return result
+
+def occupancy_history(interval):
+    # how many were inside at the end of every `interval` minutes, from the first entry
+    step = datetime.timedelta(minutes=interval)
+    inside = {kind: 0 for kind in ParticipantKindEnum}
+    result = []
+    start = None
+
+    for kind, direction, timestamp in (db.session.query(Passage.kind, Passage.direction, Passage.timestamp)
+                                                 .filter(Passage.event_id == current_event_id())
+                                                 .order_by(Passage.timestamp, Passage.id)):
+        if start is None:
+            start = timestamp - (timestamp - datetime.datetime.min) % step
+        while timestamp >= start + step:
+            start += step
+            result.append(occupancy_point(start, inside))
+        inside[kind] += 1 if direction == DirectionEnum.entry else -1
+
+    if start is not None:
+        result.append(occupancy_point(start + step, inside))
+    return result
+
+def occupancy_point(time, inside):
+    point = {kind.value: n for kind, n in inside.items()}
+    point['total'] = sum(inside.values())
+    point['time'] = help_jsonify(time)
+    return point
+
+def recount_occupancy(event_id):
+    inside = dict(db.session.query(SignIn.kind, func.count())
+                            .filter(SignIn.event_id == event_id, SignIn.signed_out == False)
+                            .group_by(SignIn.kind))
+    for kind in ParticipantKindEnum:
+        (Occupancy.query.filter_by(event_id=event_id, kind=kind)
+                        .update({'inside': inside.get(kind, 0)}, synchronize_session=False))
+    db.session.commit()
+
+def meal_info(meal):
+    return {'number': meal.number,
+            'name': meal.name,
+            'allowed_servings': meal.allowed_servings}
+
+def count_serving(sign_in_id, meal_id, allowed_servings):
+    counts = MealCount.__table__
+
+    # the check and the increment in one statement, so two kiosks scanning the same badge can't both serve it
+    served = db.session.execute(counts.update()
+                                      .where(and_(counts.c.sign_in_id == sign_in_id, counts.c.meal_id == meal_id,
+                                                  counts.c.servings < allowed_servings))
+                                      .values(servings=counts.c.servings + 1))
+    if served.rowcount:
+        return True
+
+    if allowed_servings < 1 or MealCount.query.filter_by(sign_in_id=sign_in_id, meal_id=meal_id).count():
+        return False
+
+    db.session.execute(counts.insert().values(sign_in_id=sign_in_id, meal_id=meal_id, servings=1))
+    return True
+
 def meal_line(args):
-    if args["meal_number"] > 9 or args["meal_number"] < 1:
+    event_id = current_event_id()
+
+    meal = Meal.query.filter_by(event_id=event_id, number=args["meal_number"]).scalar()
+    if not meal:
         return {"message": "Invalid meal number"}, 400
-    sign_in = SignIn.query.filter_by(badge_data=args.get("badge_data")).scalar()
+    sign_in = SignIn.query.filter_by(event_id=event_id, badge_data=args.get("badge_data")).scalar()
     if not sign_in:
         return {"message": "Invalid badge"}, 400
-    meal_name = "meal_" + str(args["meal_number"])
-    times = getattr(sign_in, meal_name)
-    if times >= args["allowed_servings"]:
+
+    sign_in_id, meal_id = sign_in.id, meal.id
+    allowed_servings = meal.allowed_servings if args.get("allowed_servings") is None else args["allowed_servings"]
+
+    try:
+        served = count_serving(sign_in_id, meal_id, allowed_servings)
+    except IntegrityError:
+        # another kiosk counted the badge's first serving at the same time
+        db.session.rollback()
+        served = count_serving(sign_in_id, meal_id, allowed_servings)
+
+    if not served:
+        db.session.rollback()
         return {"message": "User has already received allowed servings for this meal"}, 400
-    setattr(sign_in, meal_name, times+1)
+
+    db.session.add(MealServing(sign_in_id=sign_in_id, meal_id=meal_id, kiosk=args.get("kiosk")))
     db.session.commit()
     return {"status": "ok", "message": "Servings received incremented"}
 
+def set_meal(args):
+    if args["number"] < 1:
+        return {"message": "Invalid meal number"}, 400
+    if args["allowed_servings"] < 0:
+        return {"message": "Invalid allowed servings"}, 400
+
+    meal =Meal.query.filter_by(event_id=current_event_id(), number=args["number"]).scalar()
+    if not meal:
+        meal = Meal(number=args["number"])
+        db.session.add(meal)
+
+    meal.name = args["name"]
+    meal.allowed_servings = args["allowed_servings"]
+    db.session.commit()
+    return {"status": "ok"}
+
+def meal_stats(interval):
+    event_id = current_event_id()
+    meals = Meal.query.filter_by(event_id=event_id).order_by(Meal.number).all()
+
+    totals = {meal_id: (servings, first, last) for meal_id, servings, first, last in
+              db.session.query(MealServing.meal_id, func.count(), func.min(MealServing.served), func.max(MealServing.served))
+                        .filter(MealServing.event_id == event_id)
+                        .group_by(MealServing.meal_id)}
+    people = dict(db.session.query(MealCount.meal_id, func.count())
+                            .filter(MealCount.meal_id.in_([x.id for x in meals]), MealCount.servings > 0)
+                            .group_by(MealCount.meal_id))
+
+    # servings per `interval` minutes, from each meal's first serving
+    throughput = {}
+    for meal_id, served in (db.session.query(MealServing.meal_id, MealServing.served)
+                                      .filter(MealServing.event_id == event_id)
+                                      .order_by(MealServing.meal_id, MealServing.served)):
+        first = totals[meal_id][1]
+        start = first + datetime.timedelta(minutes=interval) * ((served - first) // datetime.timedelta(minutes=interval))
+        buckets = throughput.setdefault(meal_id, [])
+        if buckets and buckets[-1]['start'] == start:
+            buckets[-1]['servings'] += 1
+        else:
+            buckets.append({'start': start, 'servings': 1})
+
+    result = []
+    for meal in meals:
+        servings, first, last = totals.get(meal.id, (0, None, None))
+        result.append({**meal_info(meal),
+                       'servings': servings,
+                       'people': people.get(meal.id, 0),
+                       'first_served': help_jsonify(first),
+                       'last_served': help_jsonify(last),
+                       'throughput': [{'start': help_jsonify(x['start']), 'servings': x['servings']}
+                                      for x in throughput.get(meal.id, [])]})
+    return result
+
 
 ## Endpoints
 
@@ -87,18 +255,72 @@ class SignInEndpoint(Resource):
         self.parser.add_argument('badge_data',         type=badge_data, required=True)
 
     @auth
+    @open_event
     def post(self):
         args = self.parser.parse_args()
         return sign_in(args['user_id'], args['badge_data'])
 
     @auth
+    @replica_read
     def get(self):
+        event_id = current_event_id()
         return {
-            'attendee': Signup.query.filter(Signup.sign_in_id.isnot(None), Signup.outdated == False).count(),
-            'mentor': Mentor.query.filter(Mentor.sign_in_id.isnot(None), Mentor.outdated == False).count(),
-            'guest': Guest.query.filter(Guest.sign_in_id.isnot(None), Guest.outdated == False).count(),
+            'attendee': Signup.query.filter(Signup.event_id == event_id, Signup.sign_in_id.isnot(None), Signup.outdated == False).count(),
+            'mentor': Mentor.query.filter(Mentor.event_id == event_id, Mentor.sign_in_id.isnot(None), Mentor.outdated == False).count(),
+            'guest': Guest.query.filter(Guest.event_id == event_id, Guest.sign_in_id.isnot(None), Guest.outdated == False).count(),
         }
 
+class SignOutEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('badge_data',         type=badge_data, required=True)
+
+    @auth
+    @open_event
+    def post(self):
+        args = self.parser.parse_args()
+        return sign_out(args['badge_data'])
+
+
+class EnterEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('badge_data',         type=badge_data, required=True)
+
+    @auth
+    @open_event
+    def post(self):
+        args = self.parser.parse_args()
+        return enter(args['badge_data'])
+
+class OccupancyEndpoint(Resource):
+
+    # not from a replica, this is the headcount for the fire marshal
+    @auth
+    def get(self):
+        return occupancy()
+
+class OccupancyHistoryEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('interval',           type=int,  location='args', default=5)
+
+    @auth
+    @replica_read
+    def get(self):
+        args = self.parser.parse_args()
+        if args['interval'] < 1:
+            return {"message": "interval must be at least 1 minute"}, 400
+        return occupancy_history(args['interval'])
 
 class MealLine(Resource):
     parser = reqparse.RequestParser()
@@ -106,12 +328,61 @@ class MealLine(Resource):
     def __init__(self):
         self.parser.add_argument('badge_data',         type=badge_data, required=True)
         self.parser.add_argument('meal_number',        type=int,  required=True)
-        self.parser.add_argument('allowed_servings',   type=int,  required=True)
+        self.parser.add_argument('allowed_servings',   type=int)
+        self.parser.add_argument('kiosk',              type=strn)
 
     @auth
+    @open_event
     def post(self):
         args = self.parser.parse_args()
         return meal_line(args)
 
-api.add_resource(SignInEndpoint,  '/dayof/v1/sign-in')
-api.add_resource(MealLine,        '/dayof/v1/meal')
+class MealsEndpoint(Resource):
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+        self.parser.add_argument('number',             type=int,  required=True)
+        self.parser.add_argument('name',               type=strn, required=True)
+        self.parser.add_argument('allowed_servings',   type=int,  default=1)
+
+    @auth
+    @replica_read
+    def get(self):
+        return [meal_info(x) for x in Meal.query.filter_by(event_id=current_event_id()).order_by(Meal.number)]
+
+    @auth
+    @open_event
+    def post(self):
+        args = self.parser.parse_args()
+        return set_meal(args)
+
+class MealStatsEndpoint(Resource):
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+        self.parser.add_argument('interval',           type=int,  location='args', default=5)
+
+    @auth
+    @replica_read
+    def get(self):
+        args = self.parser.parse_args()
+        if args['interval'] < 1:
+            return {"message": "interval must be at least 1 minute"}, 400
+        return meal_stats(args['interval'])
+
+api.add_resource(SignInEndpoint,    '/dayof/v1/sign-in')
+api.add_resource(SignOutEndpoint,   '/dayof/v1/sign-out')
+api.add_resource(EnterEndpoint,     '/dayof/v1/enter')
+api.add_resource(OccupancyEndpoint, '/dayof/v1/occupancy')
+api.add_resource(OccupancyHistoryEndpoint, '/dayof/v1/occupancy/history')
+api.add_resource(MealLine,          '/dayof/v1/meal')
+api.add_resource(MealsEndpoint,     '/dayof/v1/meals')
+api.add_resource(MealStatsEndpoint, '/dayof/v1/meal-stats')
+
+## Commands
+
+@app.cli.command('recount-occupancy')
+def recount_occupancy_command():
+    """Count who's in the building again, from the sign-ins (e.g. after the database was edited by hand)"""
+    recount_occupancy(current_event_id())
+    click.echo(occupancy())
@@ -0,0 +1,400 @@
+import asyncio
+from argparse import ArgumentTypeError
+from aiohttp import web
+from sqlalchemy import select, func, and_
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.dialects import mysql, sqlite
+from .core import app
+from .helper import strn, jwt_string, is_authenticated
+from .versioning import versions_update
+from .changes import Change, OperationEnum
+from .registration import Signup
+from .mentor import Mentor
+from .guest import Guest
+from .dayof_model import SignIn, Meal, MealCount, MealServing, Passage, Occupancy, ParticipantKindEnum, DirectionEnum
+from .dayof import badge_data
+from .event_model import Event, current_event_id
+
+# The day-of endpoints as an asyncio service, for kiosk traffic: requests waiting on the database
+# don't hold a worker, so one process can take thousands of concurrent scans. It runs next to the
+# flask app on the same database (`python -m registration_2019.dayof_async`), using the same models,
+# authentication and responses. Writes bump the table versions and the change log like the flask app's do
+#
+# It serves the configured event (LAH_EVENT) only, and refuses scans once it's closed (as @open_event).
+#
+# Each endpoint is a few statements in one transaction, with the checks made by the statements
+# themselves (e.g. `UPDATE meal_count ... WHERE servings < allowed_servings`), so concurrent scans can't race
+
+PARTICIPANTS = [
+    (Signup, Signup.user_id,   ParticipantKindEnum.attendee),
+    (Mentor, Mentor.mentor_id, ParticipantKindEnum.mentor),
+    (Guest,  Guest.guest_id,   ParticipantKindEnum.guest),
+]
+
+## Database
+
+class Rejected(Exception):
+    """Rolls back the transaction, and is returned as a 400 with its message"""
+
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.message = message
+
+class Result:
+
+    def __init__(self, rowcount, lastrowid, rows):
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+        self.rows = rows
+
+    def scalar(self):
+        return self.rows[0][0] if self.rows else None
+
+class Transaction:
+
+    def __init__(self, database):
+        self.database = database
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await self.database.begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.database.end(self.conn, commit=exc_type is None)
+
+    async def execute(self, statement):
+        compiled = statement.compile(dialect=self.database.dialect)
+        return await self.database.run(self.conn, str(compiled), self.database.params(compiled))
+
+class MySQLDatabase:
+    """A pool of aiomysql connections"""
+
+    dialect = mysql.pymysql.dialect()
+
+    def __init__(self, url, pool_size):
+        self.url = url
+        self.pool_size = pool_size
+
+    async def connect(self):
+        import aiomysql
+        self.IntegrityError = aiomysql.IntegrityError
+        self.pool = await aiomysql.create_pool(host=self.url.host, port=self.url.port or 3306,
+                                               user=self.url.username, password=self.url.password or '',
+                                               db=self.url.database, maxsize=self.pool_size, autocommit=False)
+
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+
+    def params(self, compiled):
+        return compiled.params
+
+    async def begin(self):
+        conn = await self.pool.acquire()
+        await conn.begin()
+        return conn
+
+    async def end(self, conn, commit):
+        try:
+            if commit:
+                await conn.commit()
+            else:
+                await conn.rollback()
+        finally:
+            self.pool.release(conn)
+
+    async def run(self, conn, sql, params):
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql, params)
+            return Result(cursor.rowcount, cursor.lastrowid, await cursor.fetchall())
+
+class SQLiteDatabase:
+    """aiosqlite, for the local debug database"""
+
+    dialect = sqlite.pysqlite.dialect()
+
+    def __init__(self, url, pool_size):
+        self.path = url.database
+
+    async def connect(self):
+        import aiosqlite
+        import sqlite3
+        self.aiosqlite = aiosqlite
+        self.IntegrityError = sqlite3.IntegrityError
+
+    async def close(self):
+        pass
+
+    def params(self, compiled):
+        params = compiled.params
+        return [params[name] for name in compiled.positiontup]
+
+    async def begin(self):
+        conn = await self.aiosqlite.connect(self.path, isolation_level=None)
+        await conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    async def end(self, conn, commit):
+        try:
+            await conn.execute("COMMIT" if commit else "ROLLBACK")
+        finally:
+            await conn.close()
+
+    async def run(self, conn, sql, params):
+        async with conn.execute(sql, params) as cursor:
+            return Result(cursor.rowcount, cursor.lastrowid, await cursor.fetchall())
+
+def open_database():
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    backend = SQLiteDatabase if url.drivername.startswith('sqlite') else MySQLDatabase
+    return backend(url, app.config['DAYOF_POOL_SIZE'])
+
+database = open_database()
+
+# the configured event's id, looked up when the service starts
+event = {'id': None}
+
+# statements are run with their raw parameters, so python side column defaults and type
+# conversions (e.g. enums to their values) aren't applied and have to be given in the statement
+def insert(table, **values):
+    defaults = {c.name: c.default.arg(None) if c.default.is_callable else c.default.arg
+                for c in table.columns if c.default is not None and (c.default.is_scalar or c.default.is_callable)}
+    return table.insert().values(**{**defaults, **values})
+
+# the same bookkeeping as versioning.track_flush and changes.track_flush
+async def record_writes(transaction, changes):
+    for table_name, row_key, operation in changes:
+        await transaction.execute(insert(Change.__table__, table_name=table_name, row_key=row_key, operation=operation.value))
+
+    # last, as the session does (every table written here has an `event_id`)
+    await transaction.execute(versions_update(set((event['id'], table_name) for table_name, _, _ in changes)))
+
+## Helpers
+
+async def check_open(transaction):
+    if (await transaction.execute(select([Event.closed]).where(Event.id == event['id']))).scalar():
+        raise Rejected("Event is closed")
+
+# as dayof.record_passage
+async def record_passage(transaction, sign_in_id, kind, direction):
+    occupancy = Occupancy.__table__
+    change = 1 if direction == DirectionEnum.entry else -1
+
+    await transaction.execute(insert(Passage.__table__, event_id=event['id'], sign_in_id=sign_in_id,
+                                     kind=kind.value, direction=direction.value))
+    await transaction.execute(occupancy.update()
+                                       .where(and_(Occupancy.event_id == event['id'], Occupancy.kind == kind.value))
+                                       .values(inside=Occupancy.inside + change))
+
+async def sign_in(user_id, badge):
+    sign_ins = SignIn.__table__
+
+    async with Transaction(database) as transaction:
+        await check_open(transaction)
+
+        for model, id_column, kind in PARTICIPANTS:
+            table = model.__table__
+            current = and_(model.event_id == event['id'], id_column == user_id, model.outdated == False)
+
+            if not (await transaction.execute(select([func.count()]).select_from(table).where(current))).scalar():
+                continue
+
+            try:
+                sign_in_id = (await transaction.execute(insert(sign_ins, event_id=event['id'], badge_data=badge,
+                                                               kind=kind.value))).lastrowid
+            except database.IntegrityError:
+                raise Rejected("badge_data already in use")
+
+            signed_in = await transaction.execute(table.update()
+                                                       .where(and_(current, model.sign_in_id == None))
+                                                       .values(sign_in_id=sign_in_id, version=model.version + 1))
+            if not signed_in.rowcount:
+                raise Rejected("User already signed in")
+
+            await record_passage(transaction, sign_in_id, kind, DirectionEnum.entry)
+            await record_writes(transaction, [(sign_ins.name, badge, OperationEnum.insert),
+                                              (table.name, user_id, OperationEnum.update)])
+            return
+
+        raise Rejected("User ID not found")
+
+# leaving (signing out) or coming back in
+async def pass_through(badge, direction):
+    sign_ins = SignIn.__table__
+    signed_out = direction == DirectionEnum.exit
+
+    async with Transaction(database) as transaction:
+        await check_open(transaction)
+
+        found = (await transaction.execute(select([SignIn.id, SignIn.kind])
+                                                 .where(and_(SignIn.event_id == event['id'], SignIn.badge_data == badge)))).rows
+        if not found:
+            raise Rejected("Invalid badge")
+        sign_in_id, kind = found[0]
+
+        moved = await transaction.execute(sign_ins.update()
+                                                  .where(and_(SignIn.id == sign_in_id, SignIn.signed_out != signed_out))
+                                                  .values(signed_out=signed_out))
+        if not moved.rowcount:
+            raise Rejected("User already signed out" if signed_out else "User already signed in")
+
+        await record_passage(transaction, sign_in_id, ParticipantKindEnum(kind), direction)
+        await record_writes(transaction, [(sign_ins.name, badge, OperationEnum.update)])
+
+async def meal_line(badge, meal_number, allowed_servings, kiosk):
+    counts, servings = MealCount.__table__, MealServing.__table__
+
+    async with Transaction(database) as transaction:
+        await check_open(transaction)
+
+        meal = (await transaction.execute(select([Meal.id, Meal.allowed_servings])
+                                                .where(and_(Meal.event_id == event['id'], Meal.number == meal_number)))).rows
+        if not meal:
+            raise Rejected("Invalid meal number")
+        meal_id, allowed = meal[0]
+        if allowed_servings is not None:
+            allowed = allowed_servings
+
+        sign_in_id = (await transaction.execute(select([SignIn.id])
+                                                      .where(and_(SignIn.event_id == event['id'], SignIn.badge_data == badge)))).scalar()
+        if sign_in_id is None:
+            raise Rejected("Invalid badge")
+
+        counted = and_(MealCount.sign_in_id == sign_in_id, MealCount.meal_id == meal_id)
+        served = await transaction.execute(counts.update()
+                                                 .where(and_(counted, MealCount.servings < allowed))
+                                                 .values(servings=MealCount.servings + 1))
+
+        if not served.rowcount:
+            if allowed < 1:
+                raise Rejected("User has already received allowed servings for this meal")
+            try:
+                await transaction.execute(insert(counts, sign_in_id=sign_in_id, meal_id=meal_id, servings=1))
+            except database.IntegrityError:
+                # counted already (possibly by another kiosk just now)
+                served = await transaction.execute(counts.update()
+                                                         .where(and_(counted, MealCount.servings < allowed))
+                                                         .values(servings=MealCount.servings + 1))
+                if not served.rowcount:
+                    raise Rejected("User has already received allowed servings for this meal")
+
+        serving_id = (await transaction.execute(insert(servings, event_id=event['id'], sign_in_id=sign_in_id,
+                                                       meal_id=meal_id, kiosk=kiosk))).lastrowid
+        await record_writes(transaction, [(servings.name, serving_id, OperationEnum.insert)])
+
+async def signed_in_count(model):
+    async with Transaction(database) as transaction:
+        query = (select([func.count()]).select_from(model.__table__)
+                                       .where(and_(model.event_id == event['id'], model.sign_in_id != None, model.outdated == False)))
+        return (await transaction.execute(query)).scalar()
+
+async def attendance():
+    # each count on its own pooled connection, concurrently
+    attendee, mentor, guest = await asyncio.gather(*[signed_in_count(model) for model, _, _ in PARTICIPANTS])
+    return {'attendee': attendee, 'mentor': mentor, 'guest': guest}
+
+async def parse_args(request, arguments, optional=[]):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    body = body if type(body) is dict else {}
+
+    args, errors = {}, {}
+    for name, parse in arguments + optional:
+        if body.get(name) is None:
+            if (name, parse) in arguments:
+                errors[name] = "Missing required parameter in the JSON body"
+            continue
+        try:
+            args[name] = parse(body[name])
+        except (ArgumentTypeError, TypeError, ValueError) as e:
+            errors[name] = str(e)
+
+    # like reqparse's errors
+    if errors:
+        raise Rejected(errors)
+
+    return args
+
+# @auth decorator, as in authentication.py
+
+def auth(handler):
+    async def wrapper(request):
+        try:
+            token = jwt_string(request.headers.get('Authorization', ''))
+        except ArgumentTypeError as e:
+            return web.json_response({"message": {"authorization": str(e)}}, status=400)
+
+        if not app.config.get('DISABLE_AUTHENTICATION') and not is_authenticated(token):
+            return web.json_response({"message": "Not authenticated"}, status=401)
+
+        try:
+            return web.json_response(await handler(request))
+        except Rejected as e:
+            return web.json_response({"message": e.message}, status=400)
+    return wrapper
+
+## Endpoints
+
+@auth
+async def sign_in_endpoint(request):
+    args = await parse_args(request, [('user_id', strn), ('badge_data', badge_data)])
+    await sign_in(args['user_id'], args['badge_data'])
+    return {"status": "ok"}
+
+@auth
+async def attendance_endpoint(request):
+    return await attendance()
+
+@auth
+async def sign_out_endpoint(request):
+    args = await parse_args(request, [('badge_data', badge_data)])
+    await pass_through(args['badge_data'], DirectionEnum.exit)
+    return {"status": "ok"}
+
+@auth
+async def enter_endpoint(request):
+    args = await parse_args(request, [('badge_data', badge_data)])
+    await pass_through(args['badge_data'], DirectionEnum.entry)
+    return {"status": "ok"}
+
+@auth
+async def occupancy_endpoint(request):
+    async with Transaction(database) as transaction:
+        inside = dict((await transaction.execute(select([Occupancy.kind, Occupancy.inside])
+                                                       .where(Occupancy.event_id == event['id']))).rows)
+
+    result = {kind.value: inside.get(kind.value, 0) for kind in ParticipantKindEnum}
+    result['total'] = sum(result.values())
+    return result
+
+@auth
+async def meal_endpoint(request):
+    args = await parse_args(request, [('badge_data', badge_data), ('meal_number', int)],
+                            [('allowed_servings', int), ('kiosk', strn)])
+    await meal_line(args['badge_data'], args['meal_number'], args.get('allowed_servings'), args.get('kiosk'))
+    return {"status": "ok", "message": "Servings received incremented"}
+
+async def connect(service):
+    event['id'] = current_event_id()
+    await database.connect()
+
+async def close(service):
+    await database.close()
+
+def make_service():
+    service = web.Application()
+    service.router.add_post('/dayof/v1/sign-in',  sign_in_endpoint)
+    service.router.add_get('/dayof/v1/sign-in',   attendance_endpoint)
+    service.router.add_post('/dayof/v1/sign-out', sign_out_endpoint)
+    service.router.add_post('/dayof/v1/enter',    enter_endpoint)
+    service.router.add_get('/dayof/v1/occupancy', occupancy_endpoint)
+    service.router.add_post('/dayof/v1/meal',     meal_endpoint)
+    service.on_startup.append(connect)
+    service.on_cleanup.append(close)
+    return service
+
+if __name__ == '__main__':
+    web.run_app(make_service(), port=app.config['DAYOF_ASYNC_PORT'])
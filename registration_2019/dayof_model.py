@@ -1,16 +1,90 @@
-from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime
-from .core import db
+import datetime
+import enum
+from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime, UniqueConstraint, Index, select, event
+from .core import db, app
+from .event_model import Event, current_event_id
+
+# meals the configured event starts with, so kiosks can scan `meal_number` 1 to 9 until meals are set up
+DEFAULT_MEALS = range(1, 10)
+
+class ParticipantKindEnum(enum.Enum):
+    attendee = "attendee"
+    mentor = "mentor"
+    guest = "guest"
+
+class DirectionEnum(enum.Enum):
+    entry = "entry"
+    exit = "exit"
 
 # This has to be in this file to avoid circular dependencies
 # Actual logic related to this data is in dayof.py
 class SignIn(db.Model):
+    id          = Column(Integer,                   nullable=False, primary_key=True)
+    event_id    = Column(Integer,                   ForeignKey(Event.id), nullable=False, default=current_event_id)
+    badge_data  = Column(String(128),               nullable=False)
+    kind        = Column(Enum(ParticipantKindEnum), nullable=False)
+    signed_out  = Column(Boolean,                   nullable=False, default=False) # whether they're out of the building
+
+    __table_args__ = (UniqueConstraint('event_id', 'badge_data', name='sign_in_event_badge'),)
+
+# The meals an event serves, scanned by their number
+class Meal(db.Model):
+    id               = Column(Integer,      nullable=False, primary_key=True)
+    event_id         = Column(Integer,      ForeignKey(Event.id), nullable=False, default=current_event_id)
+    number           = Column(SmallInteger, nullable=False)
+    name             = Column(String(64),   nullable=False)
+    allowed_servings = Column(SmallInteger, nullable=False, default=1)
+
+    __table_args__ = (UniqueConstraint('event_id', 'number', name='meal_event_number'),)
+
+# How many servings of a meal a badge has received, checked and incremented in one statement
+class MealCount(db.Model):
+    sign_in_id  = Column(Integer,      ForeignKey(SignIn.id), nullable=False, primary_key=True)
+    meal_id     = Column(Integer,      ForeignKey(Meal.id),   nullable=False, primary_key=True)
+    servings    = Column(SmallInteger, nullable=False, default=0)
+
+# Every serving, with the kiosk that scanned it and when
+class MealServing(db.Model):
     id          = Column(Integer,     nullable=False, primary_key=True)
-    badge_data  = Column(String(128),  nullable=False, unique=True)
-    meal_1      = Column(SmallInteger, nullable=False, default=0)
-    meal_2      = Column(SmallInteger, nullable=False, default=0)
-    meal_3      = Column(SmallInteger, nullable=False, default=0)
-    meal_4      = Column(SmallInteger, nullable=False, default=0)
-    meal_5      = Column(SmallInteger, nullable=False, default=0)
-    meal_7      = Column(SmallInteger, nullable=False, default=0)
-    meal_8      = Column(SmallInteger, nullable=False, default=0)
-    meal_9      = Column(SmallInteger, nullable=False, default=0)
+    event_id    = Column(Integer,     ForeignKey(Event.id),  nullable=False, default=current_event_id)
+    sign_in_id  = Column(Integer,     ForeignKey(SignIn.id), nullable=False)
+    meal_id     = Column(Integer,     ForeignKey(Meal.id),   nullable=False)
+    kiosk       = Column(String(64))
+    served      = Column(DateTime,    nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (Index('meal_serving_meal_served', 'meal_id', 'served'),
+                      Index('meal_serving_event_served', 'event_id', 'served'))
+
+# Every time a badge enters (signing in, or coming back) or leaves the building
+class Passage(db.Model):
+    id          = Column(Integer,                   nullable=False, primary_key=True)
+    event_id    = Column(Integer,                   ForeignKey(Event.id),  nullable=False, default=current_event_id)
+    sign_in_id  = Column(Integer,                   ForeignKey(SignIn.id), nullable=False)
+    kind        = Column(Enum(ParticipantKindEnum), nullable=False)
+    direction   = Column(Enum(DirectionEnum),       nullable=False)
+    timestamp   = Column(DateTime,                  nullable=False, default=datetime.datetime.utcnow)
+
+    sign_in     = db.relationship('SignIn', foreign_keys='Passage.sign_in_id')
+
+    __table_args__ = (Index('passage_event_timestamp', 'event_id', 'timestamp'),)
+
+# How many of each kind of participant are in the building, updated along with each passage
+class Occupancy(db.Model):
+    event_id    = Column(Integer,                   ForeignKey(Event.id), nullable=False, primary_key=True)
+    kind        = Column(Enum(ParticipantKindEnum), nullable=False, primary_key=True)
+    inside      = Column(Integer,                   nullable=False, default=0)
+
+def occupancy_rows(event_id):
+    return [{'event_id': event_id, 'kind': kind, 'inside': 0} for kind in ParticipantKindEnum]
+
+@event.listens_for(Occupancy.__table__, 'after_create')
+def add_occupancy(table, connection, **kwargs):
+    for event_id, in connection.execute(select([Event.id])):
+        connection.execute(table.insert(), occupancy_rows(event_id))
+
+@event.listens_for(Meal.__table__, 'after_create')
+def add_default_meals(table, connection, **kwargs):
+    event_id = connection.execute(select([Event.id]).where(Event.slug == app.config['EVENT'])).scalar()
+    if event_id is not None:
+        connection.execute(table.insert(), [{'event_id': event_id, 'number': number, 'name': 'Meal ' + str(number),
+                                             'allowed_servings': 1} for number in DEFAULT_MEALS])
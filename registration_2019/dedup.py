@@ -0,0 +1,375 @@
+import collections
+import datetime
+import difflib
+import re
+import click
+from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, Index, UniqueConstraint, event, select, and_, or_, inspect
+from sqlalchemy.exc import IntegrityError
+from flask_restful import Resource, reqparse
+from .core import api, db, app
+from .helper import strn
+from .authentication import auth
+from .registration import Signup
+from .mentor import Mentor
+from .guest import Guest
+from .event_model import current_event_id, open_event
+
+# People who registered more than once are found by comparing participants that share a blocking key
+# (their normalized phone number, email local part, or the sounds of their names in either order),
+# instead of every pair of participants. Blocking keys are saved, so each new signup is only compared
+# against the participants sharing a key with it. Pairs that look alike are saved for review,
+# and grouped into clusters of people who may all be the same person
+
+Record = collections.namedtuple('Record', ['kind', 'participant_id', 'name', 'email', 'phone'])
+
+# blocks bigger than this are a common name or email (e.g. `info@`), comparing all of them would be quadratic
+MAX_BLOCK_SIZE = 100
+
+# pairs scoring less than this aren't saved
+MIN_SCORE = 0.5
+
+## Models
+
+class BlockingKey(db.Model):
+    id             = Column(Integer,     nullable=False, primary_key=True)
+    event_id       = Column(Integer,     nullable=False)
+    key            = Column(String(255), nullable=False)
+    kind           = Column(String(16),  nullable=False)
+    participant_id = Column(String(36),  nullable=False)
+
+    __table_args__ = (Index('blocking_key_event_key', 'event_id', 'key'), Index('blocking_key_participant', 'participant_id'))
+
+class DuplicatePair(db.Model):
+    id        = Column(Integer,     nullable=False, primary_key=True)
+    event_id  = Column(Integer,     nullable=False)
+    kind_a    = Column(String(16),  nullable=False)
+    id_a      = Column(String(36),  nullable=False)
+    kind_b    = Column(String(16),  nullable=False)
+    id_b      = Column(String(36),  nullable=False)
+    score     = Column(Float,       nullable=False)
+    reasons   = Column(String(255), nullable=False)
+    dismissed = Column(Boolean,     nullable=False, default=False)
+    found     = Column(DateTime,    nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint('kind_a', 'id_a', 'kind_b', 'id_b'), Index('duplicate_pair_event', 'event_id', 'dismissed'),
+                      Index('duplicate_pair_a', 'id_a'), Index('duplicate_pair_b', 'id_b'))
+
+## Helpers
+
+SOURCES = {
+    'attendee': (Signup, Signup.user_id,  lambda x: Record('attendee', x.user_id, x.first_name + ' ' + x.surname, x.email, x.student_phone_number)),
+    'mentor':   (Mentor, Mentor.mentor_id, lambda x: Record('mentor', x.mentor_id, x.name, x.email, x.phone)),
+    'guest':    (Guest,  Guest.guest_id,   lambda x: Record('guest', x.guest_id, x.name, x.email, x.phone)),
+}
+
+KINDS = {model: kind for kind, (model, _, _) in SOURCES.items()}
+
+SOUNDEX_CODES = {c: str(code) for code, letters in enumerate(['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r']) for c in letters}
+
+def soundex(word):
+    word = re.sub(r"[^a-z]", "", word.lower())
+    if not word:
+        return None
+
+    codes = [SOUNDEX_CODES[c] for c in word]
+    result, last = word[0], codes[0]
+
+    for c, code in zip(word[1:], codes[1:]):
+        if code != last and code != '0':
+            result += code
+        # h and w don't separate letters with the same code
+        if c not in 'hw':
+            last = code
+
+    return (result + '000')[:4]
+
+def normalize_phone(phone):
+    digits = re.sub(r"\D", "", phone or '')
+    return digits[-10:] if len(digits) >= 7 else None
+
+def normalize_email(email):
+    local = (email or '').lower().split('@')[0]
+    return local.split('+')[0].replace('.', '') or None
+
+def name_words(name):
+    return re.findall(r"[a-z]+", (name or '').lower())
+
+def blocking_keys(record):
+    keys = set()
+
+    phone = normalize_phone(record.phone)
+    if phone:
+        keys.add('phone:' + phone)
+
+    email = normalize_email(record.email)
+    if email:
+        keys.add('email:' + email)
+
+    words = name_words(record.name)
+    if len(words) >= 2:
+        # first and last name in either order
+        keys.add('name:' + '-'.join(sorted([soundex(words[0]), soundex(words[-1])])))
+
+    return keys
+
+def score(a, b):
+    total, reasons = 0, []
+
+    if normalize_phone(a.phone) and normalize_phone(a.phone) == normalize_phone(b.phone):
+        total += 0.5
+        reasons.append('phone')
+
+    if normalize_email(a.email) and normalize_email(a.email) == normalize_email(b.email):
+        total += 0.3
+        reasons.append('email')
+
+    # word order doesn't matter, so swapped names compare equal
+    similarity = difflib.SequenceMatcher(None, ' '.join(sorted(name_words(a.name))), ' '.join(sorted(name_words(b.name)))).ratio()
+    total += 0.4 * similarity
+    if similarity > 0.8:
+        reasons.append('name')
+
+    return min(total, 1.0), reasons
+
+def pair_row(event_id, a, b):
+    a, b = sorted([a, b], key=lambda x: (x.kind, x.participant_id))
+    pair_score, reasons = score(a, b)
+
+    if pair_score < MIN_SCORE:
+        return None
+
+    return {'event_id': event_id, 'kind_a': a.kind, 'id_a': a.participant_id, 'kind_b': b.kind, 'id_b': b.participant_id,
+            'score': round(pair_score, 3), 'reasons': ','.join(reasons), 'dismissed': False,
+            'found': datetime.datetime.utcnow()}
+
+# participants are only compared with others of the same event
+def current_records(connection, event_id, kind, participant_ids=None):
+    model, id_column, make_record = SOURCES[kind]
+    query = select([model.__table__]).where(and_(model.event_id == event_id, model.outdated == False))
+
+    if participant_ids is not None:
+        query = query.where(id_column.in_(participant_ids))
+
+    return [make_record(x) for x in connection.execute(query)]
+
+def add_pair(pairs, event_id, a, b):
+    row = pair_row(event_id, a, b)
+    if row:
+        pairs[(row['kind_a'], row['id_a'], row['kind_b'], row['id_b'])] = row
+
+def save_pairs(connection, event_id, pairs):
+    table = DuplicatePair.__table__
+
+    # pairs that were dismissed stay dismissed, and ones already saved (e.g. by a signup flushed at the same time) are kept
+    existing = set()
+    if pairs:
+        existing = set(tuple(x) for x in connection.execute(select([table.c.kind_a, table.c.id_a, table.c.kind_b, table.c.id_b])
+                                                            .where(and_(table.c.event_id == event_id,
+                                                                        table.c.id_a.in_(set(x['id_a'] for x in pairs))))))
+
+    pairs = [x for x in pairs if (x['kind_a'], x['id_a'], x['kind_b'], x['id_b']) not in existing]
+    if not pairs:
+        return
+
+    try:
+        with connection.begin_nested():
+            connection.execute(table.insert(), pairs)
+    except IntegrityError:
+        # another writer saved some of them since they were read, the others are saved one at a time
+        for pair in pairs:
+            try:
+                with connection.begin_nested():
+                    connection.execute(table.insert(), pair)
+            except IntegrityError:
+                pass
+
+def find_duplicates(connection, event_id):
+    records = [record for kind in SOURCES for record in current_records(connection, event_id, kind)]
+
+    blocks = collections.defaultdict(list)
+    keys = []
+    for record in records:
+        for key in blocking_keys(record):
+            blocks[key].append(record)
+            keys.append({'event_id': event_id, 'key': key, 'kind': record.kind, 'participant_id': record.participant_id})
+
+    pairs = {}
+    for block in blocks.values():
+        if len(block) > MAX_BLOCK_SIZE:
+            continue
+
+        for i, a in enumerate(block):
+            for b in block[i + 1:]:
+                add_pair(pairs, event_id, a, b)
+
+    connection.execute(BlockingKey.__table__.delete().where(BlockingKey.event_id == event_id))
+    if keys:
+        connection.execute(BlockingKey.__table__.insert(), keys)
+
+    connection.execute(DuplicatePair.__table__.delete().where(and_(DuplicatePair.event_id == event_id, DuplicatePair.dismissed == False)))
+    save_pairs(connection, event_id, list(pairs.values()))
+
+    return {'participants': len(records), 'blocks': len(blocks), 'pairs': len(pairs)}
+
+# `stale` are the participants who may already have keys and pairs (brand new participants can't)
+def check_participants(connection, event_id, records, stale):
+    keys_table, pairs_table = BlockingKey.__table__, DuplicatePair.__table__
+
+    if stale:
+        connection.execute(keys_table.delete().where(keys_table.c.participant_id.in_(stale)))
+        connection.execute(pairs_table.delete().where(and_(pairs_table.c.dismissed == False,
+                                                           or_(pairs_table.c.id_a.in_(stale), pairs_table.c.id_b.in_(stale)))))
+
+    # the participants written together aren't saved in any block yet, so they're compared with each other here
+    batch = collections.defaultdict(list)
+    for record in records:
+        for key in blocking_keys(record):
+            batch[key].append(record)
+    if not batch:
+        return
+
+    # the participants already in the same blocks (skipping blocks that are too big, like the batch job)
+    blocks = collections.defaultdict(set)
+    for key, kind, participant_id in connection.execute(select([keys_table.c.key, keys_table.c.kind, keys_table.c.participant_id])
+                                                        .where(and_(keys_table.c.event_id == event_id,
+                                                                    keys_table.c.key.in_(list(batch))))):
+        blocks[key].add((kind, participant_id))
+
+    pairs = {}
+    candidates = collections.defaultdict(set)
+    for key, block in batch.items():
+        if len(blocks[key]) + len(block) > MAX_BLOCK_SIZE:
+            continue
+
+        for kind, participant_id in blocks[key]:
+            candidates[kind].add(participant_id)
+
+        for i, a in enumerate(block):
+            for b in block[i + 1:]:
+                add_pair(pairs, event_id, a, b)
+
+    connection.execute(keys_table.insert(), [{'event_id': event_id, 'key': key, 'kind': record.kind, 'participant_id': record.participant_id}
+                                             for key, block in batch.items() for record in block])
+
+    others = [other for kind, participant_ids in candidates.items()
+                    for other in current_records(connection, event_id, kind, participant_ids)]
+    for record in records:
+        for other in others:
+            add_pair(pairs, event_id, record, other)
+
+    save_pairs(connection, event_id, list(pairs.values()))
+
+# a participant written without changing these (e.g. signing in or signing their waiver) keeps their keys and pairs
+KEYED = ['first_name', 'surname', 'name', 'email', 'phone', 'student_phone_number', 'outdated']
+
+def keyed_change(x):
+    attrs = inspect(x).attrs
+    return any(attrs[name].history.has_changes() for name in KEYED if name in attrs)
+
+@event.listens_for(db.session, 'after_flush')
+def track_participants(session, flush_context):
+    touched = [x for x in list(session.new) + list(session.dirty) + list(session.deleted)
+               if type(x) in KINDS and (x not in session.dirty or keyed_change(x))]
+    if not touched:
+        return
+
+    # participants whose current row was written are checked again, ones who were deleted are dropped.
+    # A participant only has older rows (and so keys and pairs) if one of them was also written
+    current = collections.defaultdict(dict)
+    stale = collections.defaultdict(set)
+    for x in touched:
+        record = SOURCES[KINDS[type(x)]][2](x)
+        if not x.outdated and x not in session.deleted:
+            current[x.event_id][record.participant_id] = record
+        if x not in session.new:
+            stale[x.event_id].add(record.participant_id)
+
+    for event_id in set(current) | set(stale):
+        check_participants(session.connection(), event_id, list(current[event_id].values()), sorted(stale[event_id]))
+
+def clusters(event_id):
+    pairs = DuplicatePair.query.filter_by(event_id=event_id, dismissed=False).all()
+
+    # union-find over the pairs
+    parent = {}
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for pair in pairs:
+        parent[find((pair.kind_b, pair.id_b))] = find((pair.kind_a, pair.id_a))
+
+    grouped = collections.defaultdict(list)
+    for pair in pairs:
+        grouped[find((pair.kind_a, pair.id_a))].append(pair)
+
+    members = collections.defaultdict(set)
+    for pair in pairs:
+        members[pair.kind_a].add(pair.id_a)
+        members[pair.kind_b].add(pair.id_b)
+
+    connection = db.session.connection()
+    records = {(x.kind, x.participant_id): x for kind, ids in members.items() for x in current_records(connection, event_id, kind, ids)}
+
+    result = []
+    for cluster_pairs in grouped.values():
+        keys = sorted(set((x.kind_a, x.id_a) for x in cluster_pairs) | set((x.kind_b, x.id_b) for x in cluster_pairs))
+        result.append({
+            'score': max(x.score for x in cluster_pairs),
+            'participants': [dict(records[key]._asdict()) for key in keys if key in records],
+            'pairs': [{'a': x.id_a, 'b': x.id_b, 'score': x.score, 'reasons': x.reasons.split(',') if x.reasons else []}
+                      for x in sorted(cluster_pairs, key=lambda x: -x.score)],
+        })
+
+    return sorted(result, key=lambda x: -x['score'])
+
+## Endpoints
+
+class DedupRunEndpoint(Resource):
+
+    @auth
+    @open_event
+    def post(self):
+        result = find_duplicates(db.session.connection(), current_event_id())
+        db.session.commit()
+        return result
+
+class DedupClustersEndpoint(Resource):
+
+    @auth
+    def get(self):
+        return clusters(current_event_id())
+
+class DedupDismissEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+        self.parser.add_argument('participant_ids', type=strn, required=True, action='append')
+
+    @auth
+    @open_event
+    def post(self):
+        ids = self.parser.parse_args()['participant_ids']
+
+        # every pair among them is not a duplicate
+        (DuplicatePair.query.filter(DuplicatePair.event_id == current_event_id(), DuplicatePair.id_a.in_(ids), DuplicatePair.id_b.in_(ids))
+                            .update({'dismissed': True}, synchronize_session=False))
+        db.session.commit()
+
+        return {"status": "ok"}
+
+api.add_resource(DedupRunEndpoint,      '/dedup/v1/run')
+api.add_resource(DedupClustersEndpoint, '/dedup/v1/clusters')
+api.add_resource(DedupDismissEndpoint,  '/dedup/v1/dismiss')
+
+## Command (to run the whole job, e.g. nightly from cron)
+
+@app.cli.command('dedup')
+def dedup_command():
+    """Find duplicate registrations among the current event's participants"""
+    result = find_duplicates(db.session.connection(), current_event_id())
+    db.session.commit()
+    click.echo("{participants} participants, {blocks} blocks, {pairs} possible duplicate pairs".format(**result))
@@ -5,13 +5,15 @@ from .authentication import auth
 from .guest import Guest
 from .mentor import Mentor
 from .registration import Signup, AcceptanceStatusEnum
+from .event_model import current_event_id
 
 ## Helpers
 
 def get_info_from_email(email):
     # Search through all attendees to find one with the right email
     # Priority order is mentor, guest-types, attendee
-    mentor = Mentor.query.filter_by(email=email, outdated=False).scalar()
+    event_id = current_event_id()
+    mentor = Mentor.query.filter_by(event_id=event_id, email=email, outdated=False).scalar()
     if mentor:
         if not mentor.email_verification.verified:
             return {'message': 'Email not verified'}, 400
@@ -20,14 +22,14 @@ def get_info_from_email(email):
             'name': mentor.name,
         }, 200
 
-    guest = Guest.query.filter_by(email=email, outdated=False).scalar()
+    guest = Guest.query.filter_by(event_id=event_id, email=email, outdated=False).scalar()
     if guest:
         return {
             'role': guest.kind.value,
             'name': guest.name,
         }, 200
 
-    attendee = Signup.query.filter_by(email=email, outdated=False).scalar()
+    attendee = Signup.query.filter_by(event_id=event_id, email=email, outdated=False).scalar()
     if attendee:
         if not attendee.email_verification.verified:
             return {'message': 'Email not verified'}, 400
@@ -8,6 +8,8 @@ from .helper       import re_matches
 from .registration import Signup
 from .mentor       import Mentor
 from .guest        import Guest
+from .event_model  import current_event_id, open_event
+from .participant  import retry_stale, CONFLICT
 
 # @basic_auth decorator
 
@@ -36,21 +38,21 @@ def basic_auth(f):
   return wrapper
 
 def sign_attendee(email, parent_email):
-    attendee = Signup.query.filter_by(email=email, outdated=False).scalar()
+    attendee = Signup.query.filter_by(event_id=current_event_id(), email=email, outdated=False).scalar()
 
     if attendee and (attendee.age >= 18 or parent_email):
         attendee.signed_waiver = True
         db.session.commit()
 
 def sign_mentor(email, parent_email):
-    mentor = Mentor.query.filter_by(email=email, outdated=False).scalar()
+    mentor = Mentor.query.filter_by(event_id=current_event_id(), email=email, outdated=False).scalar()
 
     if mentor and (mentor.over_18 or parent_email):
         mentor.signed_waiver = True
         db.session.commit()
 
 def sign_guest(email):
-    guest = Guest.query.filter_by(email=email, outdated=False).scalar()
+    guest = Guest.query.filter_by(event_id=current_event_id(), email=email, outdated=False).scalar()
 
     if guest:
         guest.signed_waiver = True
@@ -64,6 +66,7 @@ class DocusignEndpoint(Resource):
         pass
 
     @basic_auth
+    @open_event
     def post(self):
         data = request.get_data().decode("utf-8")
 
@@ -88,12 +91,12 @@ class DocusignEndpoint(Resource):
         except Exception as e:
             return {'message': 'bad xml'}, 400
 
-        # set all matching signups to signed
-        sign_attendee(email, parent_email)
-
-        sign_mentor(email, parent_email)
-
-        sign_guest(email)
+        # set all matching signups to signed (signing again is harmless, so a 409 can simply be retried)
+        for result in [retry_stale(sign_attendee, email, parent_email),
+                       retry_stale(sign_mentor, email, parent_email),
+                       retry_stale(sign_guest, email)]:
+            if result is CONFLICT:
+                return CONFLICT
 
         return {"status": "ok"}
 
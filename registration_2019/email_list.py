@@ -3,12 +3,19 @@ from flask_restful import Resource, reqparse
 from .core import api, db
 from .authentication import auth
 from .helper import email_string
+from .versioning import conditional
+from .ratelimit import rate_limited
+from .routing import replica_read
+from .event_model import Event, current_event_id, open_event
 
 ## Models
 
 class EmailSubscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(255), unique=True, nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey(Event.id), nullable=False, default=current_event_id)
+    email = db.Column(db.String(255), nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('event_id', 'email', name='email_subscription_event_email'),)
 
 ## Endpoints
 
@@ -19,11 +26,13 @@ class Subscribe(Resource):
     def __init__(self):
         self.parser.add_argument('email', type=email_string, required=True)
 
+    @rate_limited('email_list.subscribe')
+    @open_event
     def post(self):
 
         req_email = self.parser.parse_args()['email']
 
-        sub = EmailSubscription.query.filter_by(email=req_email).first()
+        sub = EmailSubscription.query.filter_by(event_id=current_event_id(), email=req_email).first()
 
         if sub == None:
             new_sub = EmailSubscription(email=req_email)
@@ -35,8 +44,10 @@ class Subscribe(Resource):
 class Subscriptions(Resource):
 
     @auth
+    @replica_read
+    @conditional(EmailSubscription)
     def get(self):
-        return [x.email for x in EmailSubscription.query.all()]
+        return [x.email for x in EmailSubscription.query.filter_by(event_id=current_event_id())]
 
 ## Register endpoints
 
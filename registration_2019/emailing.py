@@ -1,7 +1,11 @@
 import boto3
-from botocore.exceptions import ClientError
+import queue
+import threading
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
 from .core import app
 from .helper import read_file
+from .breakers import Dependency, CircuitOpen
 
 def read_email(name):
     prefix = f'email_templates/{name}/'
@@ -21,25 +25,75 @@ def read_templates(*templates):
 
 HTML_TEMPLATE = read_file('email_templates/html')
 
-TEMPLATES = read_templates("confirmation", "mentor_confirmation")
+TEMPLATES = read_templates("confirmation", "mentor_confirmation", "acceptance", "waitlisted")
 
+# data can be any mapping (e.g. one that fills in missing keys)
 def format_email(template, data):
-    text = TEMPLATES[template]['text'].format(**data)
-    subject = TEMPLATES[template]['subject'].format(**data)
-    header_1 = TEMPLATES[template]['header_1'].format(**data)
-    header_2 = TEMPLATES[template]['header_2'].format(**data)
-    body = TEMPLATES[template]['body'].format(**data)
+    text = TEMPLATES[template]['text'].format_map(data)
+    subject = TEMPLATES[template]['subject'].format_map(data)
+    header_1 = TEMPLATES[template]['header_1'].format_map(data)
+    header_2 = TEMPLATES[template]['header_2'].format_map(data)
+    body = TEMPLATES[template]['body'].format_map(data)
 
-    message = {**data, 'header_1': header_1, 'header_2': header_2, 'body': body}
-    return subject, text, HTML_TEMPLATE.format(**message)
+    message = type(data)(data, header_1=header_1, header_2=header_2, body=body)
+    return subject, text, HTML_TEMPLATE.format_map(message)
 
-client = boto3.client('ses', region_name=app.config['SES_AWS_REGION'])
+class FakeSES:
+    """Stand-in for the SES client that only logs, for running locally (set LAH_FAKE_SES)"""
+
+    def __init__(self):
+        self.templates = {}
+        self.sent = []
+
+    def message_id(self):
+        return 'fake-' + str(len(self.sent))
+
+    def send_email(self, Destination, Message, Source):
+        self.sent.append(Destination['ToAddresses'][0])
+        return {'MessageId': self.message_id()}
+
+    def get_template(self, TemplateName):
+        if TemplateName not in self.templates:
+            raise ClientError({'Error': {'Code': 'TemplateDoesNotExist', 'Message': TemplateName}}, 'GetTemplate')
+        return {'Template': self.templates[TemplateName]}
+
+    def create_template(self, Template):
+        self.templates[Template['TemplateName']] = Template
+
+    def update_template(self, Template):
+        self.templates[Template['TemplateName']] = Template
+
+    def send_bulk_templated_email(self, Source, Template, DefaultTemplateData, Destinations):
+        status = []
+        for d in Destinations:
+            self.sent.append(d['Destination']['ToAddresses'][0])
+            status.append({'Status': 'Success', 'MessageId': self.message_id()})
+        print("Fake SES sent " + Template + " to " + str(len(Destinations)) + " recipients")
+        return {'Status': status}
+
+if app.config.get('FAKE_SES'):
+    client = FakeSES()
+else:
+    # retries are left to the breaker's retry budget
+    client = boto3.client('ses', region_name=app.config['SES_AWS_REGION'], endpoint_url=app.config['SES_ENDPOINT'],
+                          config=Config(connect_timeout=app.config['OUTBOUND_CONNECT_TIMEOUT'],
+                                        read_timeout=app.config['OUTBOUND_READ_TIMEOUT'],
+                                        retries={'max_attempts': 0}))
+
+# errors from SES itself (rather than from what was sent) count against its breaker
+def ses_failure(e):
+    if isinstance(e, ClientError):
+        return (e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 400) >= 500
+                or e.response['Error']['Code'] in ('Throttling', 'ServiceUnavailable'))
+    return isinstance(e, BotoCoreError)
+
+ses = Dependency('ses', ses_failure)
 
 def send_email_template(data, template):
     data['api_endpoint'] = app.config['API_ENDPOINT']
     try:
         subject, text, html = format_email(template, data)
-        response = client.send_email(
+        response = ses.call(client.send_email,
             Destination = {'ToAddresses': [data['email']]},
             Message = {
                 'Body': {
@@ -60,5 +114,33 @@ def send_email_template(data, template):
             Source = app.config['SES_SENDER'])
     except ClientError as e:
         print(e.response['Error']['Message'])
+    except (BotoCoreError, CircuitOpen) as e:
+        print("Could not send email to " + data['email'] + ": " + str(e))
     else:
         print("Sent email to " + data['email'] + "; MessageId: '" + response['MessageId'] + "'")
+
+# Emails that don't need to go out within the request are queued and sent by a background thread
+
+outbox = queue.Queue()
+outbox_lock = threading.Lock()
+outbox_worker = None
+
+def send_queued():
+    while True:
+        data, template = outbox.get()
+        try:
+            send_email_template(data, template)
+        except Exception as e:
+            print("Could not send email to " + data['email'] + ": " + str(e))
+        finally:
+            outbox.task_done()
+
+def queue_email(data, template):
+    global outbox_worker
+
+    with outbox_lock:
+        if outbox_worker is None:
+            outbox_worker = threading.Thread(target=send_queued, daemon=True)
+            outbox_worker.start()
+
+    outbox.put((data, template))
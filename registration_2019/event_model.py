@@ -0,0 +1,93 @@
+import datetime
+from flask import g, request, has_request_context
+from flask_restful import abort
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, select, event
+from .core import db, app
+from .helper import is_authenticated
+
+# Each year's hackathon is an event. Participants, their email verifications, sign-ins and subscriptions
+# belong to one, and are only queried within the request's event: the one named by the `event` query
+# argument or `X-Event` header (its slug), or else LAH_EVENT. Indexes on those tables lead with the event,
+# so the current event's queries don't slow down as past years pile up (and past years can be archived).
+# Only organizers can ask for another event than LAH_EVENT, and endpoints that write are marked with
+# @open_event, which refuses them once the event is closed (its rows may be archived or purged)
+#
+# This has to be in this file to avoid circular dependencies, endpoints and archiving are in events.py
+
+class Event(db.Model):
+    id       = Column(Integer,     nullable=False, primary_key=True)
+    slug     = Column(String(64),  nullable=False, unique=True)
+    name     = Column(String(255), nullable=False)
+    closed   = Column(Boolean,     nullable=False, default=False)
+    archived = Column(Boolean,     nullable=False, default=False)
+    created  = Column(DateTime,    nullable=False, default=datetime.datetime.utcnow)
+
+# the configured event is added when the table is created
+@event.listens_for(Event.__table__, 'after_create')
+def add_configured_event(table, connection, **kwargs):
+    connection.execute(table.insert().values(slug=app.config['EVENT'], name=app.config['EVENT'], closed=False,
+                                             archived=False, created=datetime.datetime.utcnow()))
+
+## Helpers
+
+# slug -> id (events are never renamed or removed)
+event_ids = {}
+
+def lookup_event(slug):
+    if slug not in event_ids:
+        # on its own connection, since this can be called during a flush (as a column default)
+        with db.engine.connect() as connection:
+            event_id = connection.execute(select([Event.id]).where(Event.slug == slug)).scalar()
+
+        if event_id is None:
+            return None
+        event_ids[slug] = event_id
+
+    return event_ids[slug]
+
+def requested_event():
+    return request.args.get('event') or request.headers.get('X-Event') or app.config['EVENT']
+
+def organizer_request():
+    if app.config.get('DISABLE_AUTHENTICATION'):
+        return True
+
+    header = request.headers.get('Authorization', '')
+    return header.startswith('Bearer ') and is_authenticated(header[len('Bearer '):])
+
+def current_event_id():
+    if not has_request_context():
+        event_id = lookup_event(app.config['EVENT'])
+        if event_id is None:
+            raise LookupError("Event " + app.config['EVENT'] + " does not exist (add it with `flask create-event`)")
+        return event_id
+
+    if 'event_id' not in g:
+        slug = requested_event()
+        if slug != app.config['EVENT'] and not organizer_request():
+            abort(401, message="Only organizers can choose the event")
+
+        event_id = lookup_event(slug)
+        if event_id is None:
+            abort(404, message="Event does not exist")
+        g.event_id = event_id
+
+    return g.event_id
+
+def event_closed(event_id):
+    return bool(db.session.query(Event.closed).filter_by(id=event_id).scalar())
+
+# resolved before each request, so an unknown event is a 404 before the endpoint runs
+@app.before_request
+def resolve_event():
+    current_event_id()
+
+# @open_event decorator
+
+def open_event(f):
+    def wrapper(*args, **kwargs):
+        if event_closed(current_event_id()):
+            return {"message": "Event is closed"}, 400
+
+        return f(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,174 @@
+import click
+from sqlalchemy import Table, Column, Index, select
+from flask_restful import Resource, reqparse
+from .core import api, db, app
+from .helper import strn, re_matches, help_jsonify
+from .authentication import auth
+from .event_model import Event
+from .registration import Signup, EmailVerification
+from .mentor import Mentor, MentorEmailVerification
+from .guest import Guest
+from .dayof_model import SignIn, MealCount, MealServing, Passage, Occupancy, occupancy_rows
+from .email_list import EmailSubscription
+from .skills import MentorSkill
+from .dedup import BlockingKey, DuplicatePair
+from .versioning import TableVersion, counter_rows, mark_changed
+
+# A closed event can be archived: its rows are moved out of the live tables, into `archive_<table>`
+# tables with the same columns, so the live tables (and their indexes) only hold the events still in use.
+# Rows are moved before the rows they reference (participants, meal servings and passages before their sign-ins)
+
+ARCHIVED = [Signup, Mentor, Guest, EmailVerification, MentorEmailVerification, MealServing, Passage, SignIn, EmailSubscription]
+
+# rows moved per transaction
+ARCHIVE_CHUNK_SIZE = 1000
+
+slug = re_matches("^[a-z0-9-]{1,64}$", "event slug")
+
+## Models
+
+def archive_table(model):
+    table = model.__table__
+    return Table('archive_' + table.name, db.metadata,
+                 *[Column(c.name, c.type.copy(), primary_key=c.primary_key, autoincrement=False, nullable=c.nullable) for c in table.columns]
+                 + [Index('archive_' + table.name + '_event', 'event_id')])
+
+ARCHIVE_TABLES = {model: archive_table(model) for model in ARCHIVED}
+
+## Helpers
+
+def clean_event(event):
+    return {'slug': event.slug,
+            'name': event.name,
+            'closed': event.closed,
+            'archived': event.archived,
+            'current': event.slug == app.config['EVENT'],
+            'created': help_jsonify(event.created)}
+
+def create_event(event_slug, name):
+    if Event.query.filter_by(slug=event_slug).count():
+        return {"message": "Event already exists"}, 400
+
+    event = Event(slug=event_slug, name=name)
+    db.session.add(event)
+    db.session.flush()
+    db.session.execute(Occupancy.__table__.insert(), occupancy_rows(event.id))
+    db.session.execute(TableVersion.__table__.insert(), counter_rows(event.id))
+    db.session.commit()
+    return {"status": "ok"}
+
+def close_event(event_slug):
+    event = Event.query.filter_by(slug=event_slug).scalar()
+    if not event:
+        return {"message": "Event does not exist"}, 400
+
+    event.closed = True
+    db.session.commit()
+    return {"status": "ok"}
+
+def move_rows(model, event_id):
+    live, archive = model.__table__, ARCHIVE_TABLES[model]
+    moved = 0
+
+    while True:
+        ids = [x for x, in db.session.execute(select([live.c.id]).where(live.c.event_id == event_id)
+                                                                  .order_by(live.c.id).limit(ARCHIVE_CHUNK_SIZE))]
+        if not ids:
+            return moved
+
+        names = [c.name for c in live.columns]
+        db.session.execute(archive.insert().from_select(names, select([live.c[name] for name in names]).where(live.c.id.in_(ids))))
+        db.session.execute(live.delete().where(live.c.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+
+def archive_event(event_slug):
+    event = Event.query.filter_by(slug=event_slug).scalar()
+    if not event:
+        return {"message": "Event does not exist"}, 400
+    if not event.closed or event.slug == app.config['EVENT']:
+        return {"message": "Only closed events that aren't the current event can be archived"}, 400
+
+    event_id = event.id
+
+    # derived data isn't archived
+    mentor_ids = select([Mentor.mentor_id]).where(Mentor.event_id == event_id)
+    db.session.execute(MentorSkill.__table__.delete().where(MentorSkill.mentor_id.in_(mentor_ids)))
+    sign_in_ids = select([SignIn.id]).where(SignIn.event_id == event_id)
+    db.session.execute(MealCount.__table__.delete().where(MealCount.sign_in_id.in_(sign_in_ids)))
+    db.session.execute(BlockingKey.__table__.delete().where(BlockingKey.event_id == event_id))
+    db.session.execute(DuplicatePair.__table__.delete().where(DuplicatePair.event_id == event_id))
+    db.session.commit()
+
+    moved = {str(model.__table__.name): move_rows(model, event_id) for model in ARCHIVED}
+
+    # the rows were moved outside of the session, so the tables' versions are bumped here
+    mark_changed(db.session, [(event_id, name) for name in moved])
+    Event.query.filter_by(id=event_id).update({'archived': True}, synchronize_session=False)
+    db.session.commit()
+
+    return {"status": "ok", "archived": moved}
+
+## Endpoints
+
+class EventListEndpoint(Resource):
+
+    @auth
+    def get(self):
+        return [clean_event(x) for x in Event.query.order_by(Event.id)]
+
+class EventCreateEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('slug', type=slug, required=True)
+        self.parser.add_argument('name', type=strn, required=True)
+
+    @auth
+    def post(self):
+        args = self.parser.parse_args()
+        return create_event(args['slug'], args['name'])
+
+class EventCloseEndpoint(Resource):
+
+    @auth
+    def post(self, event_slug):
+        return close_event(event_slug)
+
+class EventArchiveEndpoint(Resource):
+
+    @auth
+    def post(self, event_slug):
+        return archive_event(event_slug)
+
+api.add_resource(EventListEndpoint,    '/event/v1/list')
+api.add_resource(EventCreateEndpoint,  '/event/v1/create')
+api.add_resource(EventCloseEndpoint,   '/event/v1/close/<event_slug>')
+api.add_resource(EventArchiveEndpoint, '/event/v1/archive/<event_slug>')
+
+## Commands
+
+@app.cli.command('create-event')
+@click.argument('event_slug')
+@click.option('--name', help="Display name (defaults to the slug)")
+def create_event_command(event_slug, name):
+    """Add an event, e.g. before switching LAH_EVENT to it"""
+    result = create_event(slug(event_slug), name or event_slug)
+    click.echo(result[0]['message'] if type(result) is tuple else "Event " + event_slug + " added")
+
+@app.cli.command('archive-event')
+@click.argument('event_slug')
+def archive_event_command(event_slug):
+    """Close an event and move its rows to the archive tables"""
+    if event_slug == app.config['EVENT']:
+        raise click.UsageError("The current event (LAH_EVENT) can't be archived")
+
+    close_event(event_slug)
+    result = archive_event(event_slug)
+    if type(result) is tuple:
+        raise click.UsageError(result[0]['message'])
+
+    for table, count in result['archived'].items():
+        click.echo("{}: {} rows archived".format(table, count))
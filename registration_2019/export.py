@@ -0,0 +1,433 @@
+import csv
+import datetime
+import enum
+import os
+import shutil
+import threading
+import click
+from flask import send_from_directory
+from flask_restful import Resource, reqparse
+from sqlalchemy import Column, String, Integer, Enum, DateTime, Boolean, SmallInteger, ForeignKey, select, and_, bindparam
+from .core import api, db, app
+from .helper import help_jsonify, boolean
+from .authentication import auth
+from .registration import Signup, EmailVerification
+from .mentor import Mentor, MentorEmailVerification
+from .guest import Guest
+from .dayof_model import SignIn, Meal, MealServing
+from .changes import Change, settled_head
+from .event_model import Event, current_event_id
+
+# Snapshots of an event's roster for analysis, one file per dataset (attendees, mentors, guests,
+# and sign-ins with their meals) as CSV, or Parquet if pyarrow is installed. Every dataset in a
+# snapshot is read in one transaction, so they agree with each other, and is streamed to its file
+# in chunks. When only a few rows changed since the last snapshot, it's copied with those rows
+# replaced (found from the change log) instead of reading everything again
+
+# rows read and written at a time
+CHUNK_SIZE = 1000
+
+# more changes than this fraction of the last snapshot's rows and the snapshot is built from scratch
+MAX_CHANGED_FRACTION = 0.2
+
+# finished snapshots kept per event and format, older ones are deleted
+KEEP_SNAPSHOTS = 5
+
+# a snapshot that's been building for this long is assumed to have crashed
+STALE_AFTER = datetime.timedelta(minutes=30)
+
+FORMATS = ['csv', 'parquet']
+
+## Models
+
+class SnapshotStatusEnum(enum.Enum):
+    running = "running"
+    done    = "done"
+    failed  = "failed"
+
+class Snapshot(db.Model):
+    id       = Column(Integer,                  nullable=False, primary_key=True)
+    event_id = Column(Integer,                  ForeignKey(Event.id), nullable=False, default=current_event_id)
+    format   = Column(String(16),               nullable=False)
+    status   = Column(Enum(SnapshotStatusEnum), nullable=False, default=SnapshotStatusEnum.running)
+    base_id  = Column(Integer) # the snapshot it was copied from, if it was built incrementally
+    cursor   = Column(Integer) # the change log position it's up to date with
+    rows     = Column(Integer)
+    started  = Column(DateTime,                 nullable=False, default=datetime.datetime.utcnow)
+    finished = Column(DateTime)
+    error    = Column(String(1000))
+
+## Datasets
+
+class Dataset:
+    """A query for the rows of one file, `key` being the column rows are known by in the change log"""
+
+    def __init__(self, name, columns, from_, where, key, tables):
+        self.name = name
+        self.columns = columns
+        self.names = [c.name for c in columns]
+        self.from_ = from_
+        self.where = where
+        self.key = key
+        self.key_index = self.names.index(key.name)
+        self.tables = tables
+
+    def query(self, keys=None):
+        query = select(self.columns).select_from(self.from_).where(self.where)
+
+        if keys is not None:
+            query = query.where(self.key.in_(keys))
+
+        return query.order_by(self.key)
+
+def participant_columns(model, columns):
+    return [getattr(model, c).label(c) for c in columns]
+
+DATASETS = [
+    Dataset('attendee',
+            participant_columns(Signup, ['user_id', 'first_name', 'surname', 'email', 'age', 'school', 'grade',
+                                         'student_phone_number', 'gender', 'ethnicity', 'tshirt_size',
+                                         'previous_hackathons', 'guardian_name', 'guardian_email',
+                                         'guardian_phone_number', 'github_username', 'linkedin_profile',
+                                         'dietary_restrictions', 'signed_waiver', 'acceptance_status', 'timestamp'])
+            + [EmailVerification.verified.label('email_verified'), SignIn.badge_data.label('badge_data')],
+            Signup.__table__.outerjoin(EmailVerification.__table__, Signup.email_verification_id == EmailVerification.id)
+                            .outerjoin(SignIn.__table__, Signup.sign_in_id == SignIn.id),
+            and_(Signup.event_id == bindparam('event_id'), Signup.outdated == False), Signup.user_id, ['signup', 'email_verification']),
+
+    Dataset('mentor',
+            participant_columns(Mentor, ['mentor_id', 'name', 'email', 'phone', 'over_18', 'skillset', 'tshirt_size',
+                                         'dietary_restrictions', 'signed_waiver', 'acceptance_status', 'timestamp'])
+            + [MentorEmailVerification.verified.label('email_verified'), SignIn.badge_data.label('badge_data')],
+            Mentor.__table__.outerjoin(MentorEmailVerification.__table__, Mentor.email_verification_id == MentorEmailVerification.id)
+                            .outerjoin(SignIn.__table__, Mentor.sign_in_id == SignIn.id),
+            and_(Mentor.event_id == bindparam('event_id'), Mentor.outdated == False), Mentor.mentor_id, ['mentor', 'mentor_email_verification']),
+
+    Dataset('guest',
+            participant_columns(Guest, ['guest_id', 'name', 'email', 'phone', 'kind', 'signed_waiver', 'timestamp'])
+            + [SignIn.badge_data.label('badge_data')],
+            Guest.__table__.outerjoin(SignIn.__table__, Guest.sign_in_id == SignIn.id),
+            and_(Guest.event_id == bindparam('event_id'), Guest.outdated == False), Guest.guest_id, ['guest']),
+
+    Dataset('sign_in',
+            [c.label(c.name) for c in SignIn.__table__.columns if c.name not in ('id', 'event_id')],
+            SignIn.__table__, SignIn.event_id == bindparam('event_id'), SignIn.badge_data, ['sign_in']),
+
+    Dataset('meal',
+            [MealServing.id.label('id'), SignIn.badge_data.label('badge_data'), Meal.number.label('meal_number'),
+             Meal.name.label('meal_name'), MealServing.kiosk.label('kiosk'), MealServing.served.label('served')],
+            MealServing.__table__.join(SignIn.__table__, MealServing.sign_in_id == SignIn.id)
+                                 .join(Meal.__table__, MealServing.meal_id == Meal.id),
+            MealServing.event_id == bindparam('event_id'), MealServing.id, ['meal_serving']),
+]
+
+DATASET_NAMES = [x.name for x in DATASETS]
+
+## Files
+
+def snapshot_directory(snapshot_id):
+    return os.path.join(app.config['EXPORT_DIR'], str(snapshot_id))
+
+def snapshot_path(snapshot_id, dataset_name, format):
+    return os.path.join(snapshot_directory(snapshot_id), dataset_name + '.' + format)
+
+class CSVFile:
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def read(self, path):
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            next(reader)
+            chunk = []
+            for row in reader:
+                chunk.append(row)
+                if len(chunk) == CHUNK_SIZE:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    def open(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.dataset.names)
+
+    def write(self, rows):
+        self.writer.writerows([help_jsonify(v) for v in row] for row in rows)
+
+    def close(self):
+        self.file.close()
+
+def arrow_type(column, pa):
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    if isinstance(column.type, (Integer, SmallInteger)):
+        return pa.int64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp('us')
+    return pa.string()
+
+class ParquetFile:
+
+    def __init__(self, dataset):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.dataset = dataset
+        self.schema = pyarrow.schema([(c.name, arrow_type(c, pyarrow)) for c in dataset.columns])
+
+    def read(self, path):
+        for batch in self.pa.parquet.ParquetFile(path).iter_batches(batch_size=CHUNK_SIZE):
+            columns = batch.to_pydict()
+            yield [list(row) for row in zip(*[columns[name] for name in self.dataset.names])]
+
+    def open(self, path):
+        self.writer = self.pa.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        values = [[v.value if isinstance(v, enum.Enum) else v for v in row] for row in rows]
+        columns = {name: [row[i] for row in values] for i, name in enumerate(self.dataset.names)}
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+FILES = {'csv': CSVFile, 'parquet': ParquetFile}
+
+def parquet_available():
+    try:
+        import pyarrow.parquet
+        return True
+    except ImportError:
+        return False
+
+## Helpers
+
+# the keys changed in each dataset between two cursors, or None if there are too many (or some aren't known)
+def changed_keys(connection, since, until, limit):
+    rows = list(connection.execute(select([Change.table_name, Change.row_key])
+                                   .where(and_(Change.id > since, Change.id <= until))
+                                   .limit(limit + 1)))
+    if len(rows) > limit:
+        return None
+
+    keys = {x.name: set() for x in DATASETS}
+    for table_name, row_key in rows:
+        for dataset in DATASETS:
+            if table_name in dataset.tables:
+                if row_key is None:
+                    return None
+                keys[dataset.name].add(row_key)
+
+    return keys
+
+def stream(connection, query, event_id):
+    result = connection.execution_options(stream_results=True).execute(query, event_id=event_id)
+    try:
+        while True:
+            rows = result.fetchmany(CHUNK_SIZE)
+            if not rows:
+                return
+            yield [list(row) for row in rows]
+    finally:
+        result.close()
+
+def write_dataset(connection, event_id, dataset, file, path, base_path=None, keys=None):
+    count = 0
+    file.open(path)
+
+    try:
+        if base_path is None:
+            for rows in stream(connection, dataset.query(), event_id):
+                file.write(rows)
+                count += len(rows)
+        else:
+            # the last snapshot's rows, except the changed ones, which are read again (and added at the end)
+            for rows in file.read(base_path):
+                # the change log's keys are strings
+                rows = [x for x in rows if str(x[dataset.key_index]) not in keys]
+                if rows:
+                    file.write(rows)
+                    count += len(rows)
+
+            keys = sorted(keys)
+            for i in range(0, len(keys), CHUNK_SIZE):
+                for rows in stream(connection, dataset.query(keys[i:i + CHUNK_SIZE]), event_id):
+                    file.write(rows)
+                    count += len(rows)
+    finally:
+        file.close()
+
+    return count
+
+def build_snapshot(snapshot_id, full=False):
+    snapshot = Snapshot.query.get(snapshot_id)
+    format, event_id = snapshot.format, snapshot.event_id
+
+    base = None
+    if not full:
+        base = (Snapshot.query.filter(Snapshot.event_id == event_id, Snapshot.format == format,
+                                      Snapshot.status == SnapshotStatusEnum.done, Snapshot.id < snapshot_id)
+                              .order_by(Snapshot.id.desc()).first())
+    db.session.commit()
+
+    os.makedirs(snapshot_directory(snapshot_id), exist_ok=True)
+
+    # on its own connection, in one read transaction for every dataset
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    try:
+        if connection.dialect.name == 'sqlite':
+            # pysqlite only starts transactions before writes
+            connection.execute('BEGIN')
+
+        cursor = settled_head(connection)
+
+        keys = None
+        if base is not None and os.path.isdir(snapshot_directory(base.id)):
+            keys = changed_keys(connection, base.cursor, cursor, int(base.rows * MAX_CHANGED_FRACTION))
+
+        rows = 0
+        for dataset in DATASETS:
+            path = snapshot_path(snapshot_id, dataset.name, format)
+            if keys is None:
+                rows += write_dataset(connection, event_id, dataset, FILES[format](dataset), path)
+            else:
+                rows += write_dataset(connection, event_id, dataset, FILES[format](dataset), path,
+                                      snapshot_path(base.id, dataset.name, format), keys[dataset.name])
+    finally:
+        transaction.rollback()
+        connection.close()
+
+    (Snapshot.query.filter_by(id=snapshot_id)
+                   .update({'status': SnapshotStatusEnum.done, 'cursor': cursor, 'rows': rows,
+                            'base_id': base.id if keys is not None else None,
+                            'finished': datetime.datetime.utcnow()}, synchronize_session=False))
+    db.session.commit()
+
+    remove_old_snapshots(event_id, format)
+
+def remove_old_snapshots(event_id, format):
+    old = (db.session.query(Snapshot.id).filter_by(event_id=event_id, format=format, status=SnapshotStatusEnum.done)
+                                        .order_by(Snapshot.id.desc()).offset(KEEP_SNAPSHOTS))
+    for snapshot_id, in old:
+        shutil.rmtree(snapshot_directory(snapshot_id), ignore_errors=True)
+
+def run_snapshot(snapshot_id, full):
+    try:
+        build_snapshot(snapshot_id, full)
+    except Exception as e:
+        db.session.rollback()
+        shutil.rmtree(snapshot_directory(snapshot_id), ignore_errors=True)
+        (Snapshot.query.filter_by(id=snapshot_id)
+                       .update({'status': SnapshotStatusEnum.failed, 'error': str(e)[:1000],
+                                'finished': datetime.datetime.utcnow()}, synchronize_session=False))
+        db.session.commit()
+        raise
+
+def building():
+    return (Snapshot.query.filter(Snapshot.status == SnapshotStatusEnum.running,
+                                  Snapshot.started > datetime.datetime.utcnow() - STALE_AFTER).count() > 0)
+
+def start_snapshot(format):
+    snapshot = Snapshot(format=format)
+    db.session.add(snapshot)
+    db.session.commit()
+    return snapshot.id
+
+def run_in_background(snapshot_id, full):
+    def run():
+        with app.app_context():
+            try:
+                run_snapshot(snapshot_id, full)
+            except Exception as e:
+                print("Snapshot " + str(snapshot_id) + " failed: " + str(e))
+
+    threading.Thread(target=run, daemon=True).start()
+
+def snapshot_format(x):
+    if x not in FORMATS:
+        raise ValueError("format must be one of: " + ', '.join(FORMATS))
+    if x == 'parquet' and not parquet_available():
+        raise ValueError("parquet snapshots need pyarrow installed")
+    return x
+
+def clean_snapshot(snapshot):
+    return {'id': snapshot.id,
+            'format': snapshot.format,
+            'status': snapshot.status.value,
+            'incremental': snapshot.base_id is not None,
+            'cursor': snapshot.cursor,
+            'rows': snapshot.rows,
+            'started': help_jsonify(snapshot.started),
+            'finished': help_jsonify(snapshot.finished),
+            'error': snapshot.error,
+            'datasets': DATASET_NAMES if snapshot.status == SnapshotStatusEnum.done else []}
+
+## Endpoints
+
+class SnapshotEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('format', type=snapshot_format, default='csv')
+        self.parser.add_argument('full',   type=boolean,         default=False)
+
+    @auth
+    def post(self):
+        args = self.parser.parse_args()
+
+        if building():
+            return {"message": "A snapshot is already being built"}, 400
+
+        snapshot_id = start_snapshot(args['format'])
+        run_in_background(snapshot_id, args['full'])
+        return {"status": "ok", "snapshot_id": snapshot_id}
+
+class SnapshotListEndpoint(Resource):
+
+    @auth
+    def get(self):
+        return [clean_snapshot(x) for x in Snapshot.query.filter_by(event_id=current_event_id()).order_by(Snapshot.id.desc()).limit(50)]
+
+class SnapshotFileEndpoint(Resource):
+
+    @auth
+    def get(self, snapshot_id, dataset):
+        snapshot = Snapshot.query.get(snapshot_id)
+
+        if not snapshot or snapshot.event_id != current_event_id() or snapshot.status != SnapshotStatusEnum.done or dataset not in DATASET_NAMES:
+            return {"message": "Snapshot does not exist"}, 404
+
+        filename = dataset + '.' + snapshot.format
+        if not os.path.exists(os.path.join(snapshot_directory(snapshot_id), filename)):
+            return {"message": "Snapshot has been deleted"}, 404
+
+        return send_from_directory(os.path.abspath(snapshot_directory(snapshot_id)), filename, as_attachment=True)
+
+api.add_resource(SnapshotEndpoint,     '/export/v1/snapshot')
+api.add_resource(SnapshotListEndpoint, '/export/v1/snapshots')
+api.add_resource(SnapshotFileEndpoint, '/export/v1/snapshot/<int:snapshot_id>/<dataset>')
+
+## Command (to take snapshots from cron)
+
+@app.cli.command('export-snapshot')
+@click.option('--format', default='csv', type=click.Choice(FORMATS), help="File format of the snapshot")
+@click.option('--full', is_flag=True, help="Read every row again, even if only a few changed since the last snapshot")
+def export_snapshot_command(format, full):
+    """Write a snapshot of the roster"""
+    if format == 'parquet' and not parquet_available():
+        raise click.UsageError("Parquet snapshots need pyarrow installed")
+    if building():
+        raise click.UsageError("A snapshot is already being built")
+
+    snapshot_id = start_snapshot(format)
+    run_snapshot(snapshot_id, full)
+
+    snapshot = Snapshot.query.get(snapshot_id)
+    click.echo("{} rows written to {} ({})".format(snapshot.rows, snapshot_directory(snapshot_id),
+                                                 'incremental' if snapshot.base_id else 'full'))
@@ -1,12 +1,18 @@
 import datetime
 import enum
-from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime
-from flask import redirect
+from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime, Index
+from sqlalchemy.orm.exc import StaleDataError
+from flask import redirect, request
 from flask_restful import Resource, reqparse
 from .core import api, db, app
 from .helper import *
 from .authentication import auth
 from .dayof_model import SignIn
+from .event_model import Event, current_event_id, open_event
+from .participant import ParticipantQueries, version_mapper_args, supersede, precondition_failed, version_changed, CONFLICT, modified
+from .versioning import conditional
+from .serialization import RowSerializer
+from .routing import replica_read
 
 ## Models
 class GuestKindEnum(enum.Enum):
@@ -16,6 +22,7 @@ class GuestKindEnum(enum.Enum):
 
 class Guest(db.Model):
     id                    = Column(Integer,                    nullable=False, primary_key=True)
+    event_id              = Column(Integer,                    ForeignKey(Event.id), nullable=False, default=current_event_id)
     guest_id              = Column(String(36),                 nullable=False, default=rand_uuid)
     name                  = Column(String(255),                nullable=False)
     phone                 = Column(String(255),                nullable=True)
@@ -24,10 +31,17 @@ class Guest(db.Model):
     signed_waiver         = Column(Boolean,                    nullable=False, default=False)
     sign_in_id            = Column(Integer,                    ForeignKey(SignIn.id), nullable=True)
     outdated              = Column(Boolean,                    nullable=False, default=False)
+    version               = Column(Integer,                    nullable=False, default=1) # see participant.version_mapper_args
     timestamp             = Column(DateTime,                   nullable=False, default=datetime.datetime.utcnow)
 
     sign_in                = db.relationship('SignIn', foreign_keys='Guest.sign_in_id')
 
+    __table_args__ = (Index('guest_event_guest', 'event_id', 'guest_id'),
+                      Index('guest_event_email', 'event_id', 'email'),
+                      Index('guest_event_outdated', 'event_id', 'outdated'))
+
+    __mapper_args__ = version_mapper_args(version)
+
     def as_dict(self):
         result = {c.name: help_jsonify(getattr(self, c.name)) for c in self.__table__.columns}
         result['signed_in'] = self.sign_in is not None
@@ -35,30 +49,35 @@ class Guest(db.Model):
 
 ## Helper Functions
 
-def email_in_use(new_email):
-    return Guest.query.filter_by(email=new_email, outdated=False).count() > 0
+clean_guest = RowSerializer(Guest, ['guest_id', 'name', 'email', 'phone',
+                                    'signed_waiver', 'timestamp', 'kind', 'signed_in', 'version'],
+                            {'signed_in': lambda x: x.sign_in_id is not None})
 
-def clean_guest(guest, extra=[]):
-    return select_keys(guest.as_dict(), ['guest_id', 'name', 'email', 'phone',
-                                         'signed_waiver', 'timestamp', 'kind', 'signed_in', *extra])
+guests = ParticipantQueries(Guest, Guest.guest_id, [Guest.name, Guest.email, Guest.phone],
+                            clean_guest, "Guest does not exist")
+
+email_in_use = guests.email_in_use
 
 
 def add_guest(guest):
     db.session.add(guest)
     db.session.commit()
 
-def modify(guest_id, delta):
+def modify(guest_id, delta, if_match=None):
 
     # find the most recent guest for guest_id
-    old_guest = Guest.query.filter_by(guest_id=guest_id, outdated=False).scalar()
+    old_guest = guests.current(guest_id)
 
     if not old_guest:
         return {"message": "Guest does not exist"}, 400
 
+    if precondition_failed(old_guest, if_match):
+        return version_changed(old_guest)
+
     new_guest, changed = copy_row(Guest, old_guest, ignored_columns=['id', 'outdated', 'timestamp'], overwrite=delta)
 
     # no changes, just return
-    if not changed and not new_verified:
+    if not changed:
         return {"status": "ok", "message": "unchanged"}
 
     # validate new data
@@ -67,54 +86,18 @@ def modify(guest_id, delta):
         return {"message": "Email already in use"}, 400
 
     # validated, update the data
-    if changed:
-        old_guest.outdated = True
+    try:
+        supersede(old_guest, new_guest)
         add_guest(new_guest)
+    except StaleDataError:
+        db.session.rollback()
+        return CONFLICT
 
-    db.session.commit()
-
-    return {"status": "ok"}
-
-def search(query):
-
-    if not query:
-        return []
-    elif type(query) is str:
-        results = Guest.query.filter((Guest.guest_id == query) |
-                                      Guest.name.contains(query) |
-                                      Guest.email.contains(query) |
-                                      Guest.phone.contains(query)).all()
-
-        return [clean_guest(x, extra=['outdated']) for x in results]
-    else:
-        query = remove_none_values(query)
-        outdated = query.get('outdated')
-
-        if outdated == '*':
-            query.pop('outdated')
-
-        if outdated is None:
-            results = Guest.query.filter_by(**query, outdated=False)
-        else:
-            results = Guest.query.filter_by(**query)
-
-        return [clean_guest(x,
-                             # include `outdated` field if it was provided in the request
-                             extra=(['outdated'] if outdated is not None else []))
-                for x in results]
-
-def list():
-    return [clean_guest(x) for x in Guest.query.filter_by(outdated=False)]
-
-def delete(guest_id):
-        guest = Guest.query.filter_by(guest_id=guest_id, outdated=False).scalar()
-        if not guest:
-            return {"message": "Guest does not exist"}, 400
+    return modified(new_guest.version)
 
-        else:
-            guest.outdated=True
-            db.session.commit()
-            return {"status": "ok"}
+search  = guests.search
+list    = guests.list
+delete  = guests.delete
 
 ## Endpoints
 
@@ -130,12 +113,13 @@ class GuestEndpoint(Resource):
         self.parser.add_argument('kind',                  type=GuestKindEnum,  required=True)
 
     @auth
+    @open_event
     def post(self):
 
         args = self.parser.parse_args()
 
         if email_in_use(args['email']):
-            guest = Guest.query.filter_by(email=args['email'], outdated=False).scalar()
+            guest = Guest.query.filter_by(event_id=current_event_id(), email=args['email'], outdated=False).scalar()
             return {"status": "ok",
                     "message": "Guest already added (by email)"}
 
@@ -156,9 +140,10 @@ class GuestModifyEndpoint(Resource):
         self.parser.add_argument('kind',                  type=GuestKindEnum)
 
     @auth
+    @open_event
     def post(self, guest_id):
         args = self.parser.parse_args()
-        return modify(guest_id, args)
+        return modify(guest_id, args, request.if_match)
 
 class GuestSearchEndpoint(Resource):
 
@@ -177,6 +162,7 @@ class GuestSearchEndpoint(Resource):
         self.nested_parser.add_argument('outdated',              type=or_types(boolean, strn), location='query')
 
     @auth
+    @replica_read
     def post(self):
         args = self.parser.parse_args()
 
@@ -191,12 +177,15 @@ class GuestSearchEndpoint(Resource):
 class GuestListEndpoint(Resource):
 
     @auth
+    @replica_read
+    @conditional(Guest)
     def get(self):
         return list()
 
 class GuestDeleteEndpoint(Resource):
 
     @auth
+    @open_event
     def get(self, guest_id):
         return delete(guest_id)
 
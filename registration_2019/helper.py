@@ -4,7 +4,10 @@ import re
 import datetime
 import time
 import enum
+import operator
 from argparse import ArgumentTypeError
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
 from flask_restful.reqparse import RequestParser
 from .core import app
 
@@ -27,6 +30,13 @@ def boolean(x):
 
     raise ArgumentTypeError("Argument must be a boolean")
 
+# booleans in query strings
+def query_boolean(x):
+    if x in ['true', 'false']:
+        return x == 'true'
+
+    raise ArgumentTypeError("Argument must be true or false")
+
 def strn(x):
     if type(x) is not str:
         raise ArgumentTypeError("Argument must be a string")
@@ -132,6 +142,14 @@ def copy_row(model, row, ignored_columns=[], overwrite={}):
 
     return copy, changed
 
+def bulk_key(whereclause, column):
+    # the value, if a bulk write was filtered on `column == <value>`
+    for x in visitors.iterate(whereclause, {}):
+        if isinstance(x, BinaryExpression) and x.operator is operator.eq and isinstance(x.right, BindParameter):
+            if x.left.compare(column.expression):
+                return x.right.effective_value
+    return None
+
 def remove_none_values(dictionary):
     return {k: v for k, v in dictionary.items() if v is not None}
 
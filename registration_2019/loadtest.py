@@ -0,0 +1,280 @@
+import json
+import math
+import random
+import threading
+import time
+import click
+import requests
+from sqlalchemy.engine.url import make_url
+from .core import db, app
+from .helper import create_jwt, rand_uuid
+from .registration import Signup, EmailVerification, AcceptanceStatusEnum, TShirtSizeEnum
+from .mentor import Mentor, MentorEmailVerification
+from .guest import Guest, GuestKindEnum
+from .dayof_model import SignIn, MealCount, MealServing, Passage
+from .dayof import recount_occupancy
+from .event_model import current_event_id
+
+# A check-in morning replayed against a running instance, with synthetic participants:
+# `flask loadtest-seed` adds them to a local database and writes them to a file, and
+# `flask loadtest` runs many clients against the instance. Early on most requests are sign-ins,
+# which give way to meal scans, while Discord verifications and dashboard polls go on throughout
+
+# synthetic participants have emails at this domain, so they can be told apart and cleared
+DOMAIN = 'loadtest.invalid'
+
+## Seeding
+
+def is_local(uri):
+    url = make_url(uri)
+    return url.drivername.startswith('sqlite') or url.host in ('localhost', '127.0.0.1', '::1')
+
+def clear_participants():
+    synthetic = '%@' + DOMAIN
+
+    sign_in_ids = [x for model in (Signup, Mentor, Guest)
+                     for x, in db.session.query(model.sign_in_id).filter(model.email.like(synthetic), model.sign_in_id.isnot(None))]
+
+    for model in (Signup, Mentor, Guest, EmailVerification, MentorEmailVerification):
+        model.query.filter(model.email.like(synthetic)).delete(synchronize_session=False)
+    if sign_in_ids:
+        MealCount.query.filter(MealCount.sign_in_id.in_(sign_in_ids)).delete(synchronize_session=False)
+        MealServing.query.filter(MealServing.sign_in_id.in_(sign_in_ids)).delete(synchronize_session=False)
+        Passage.query.filter(Passage.sign_in_id.in_(sign_in_ids)).delete(synchronize_session=False)
+        SignIn.query.filter(SignIn.id.in_(sign_in_ids)).delete(synchronize_session=False)
+
+    db.session.commit()
+
+    # the synthetic participants who were still inside are gone
+    recount_occupancy(current_event_id())
+
+def seed_participants(attendees, mentors, guests):
+    participants = []
+
+    for i in range(attendees):
+        email = 'attendee-{}@{}'.format(i, DOMAIN)
+        user_id = rand_uuid()
+        signup = Signup(user_id=user_id, first_name='Attendee', surname=str(i), email=email, age=17, school='Load Test High',
+                        grade=11, student_phone_number='555{:07d}'.format(i), gender='-',
+                        tshirt_size=TShirtSizeEnum.medium, previous_hackathons=0,
+                        acceptance_status=AcceptanceStatusEnum.accepted,
+                        email_verification=EmailVerification(user_id=user_id, email=email, verified=True))
+        db.session.add(signup)
+        participants.append(('attendee', signup))
+
+    for i in range(mentors):
+        email = 'mentor-{}@{}'.format(i, DOMAIN)
+        mentor_id = rand_uuid()
+        mentor = Mentor(mentor_id=mentor_id, name='Mentor {}'.format(i), phone='556{:07d}'.format(i), email=email, over_18=True,
+                        skillset=random.choice(['React, Node.js', 'Python, Machine Learning', 'Java, Android', 'Swift, iOS']),
+                        tshirt_size=TShirtSizeEnum.large,
+                        email_verification=MentorEmailVerification(mentor_id=mentor_id, email=email, verified=True))
+        db.session.add(mentor)
+        participants.append(('mentor', mentor))
+
+    for i in range(guests):
+        guest = Guest(guest_id=rand_uuid(), name='Guest {}'.format(i), email='guest-{}@{}'.format(i, DOMAIN), kind=GuestKindEnum.judge)
+        db.session.add(guest)
+        participants.append(('guest', guest))
+
+    db.session.commit()
+
+    ids = {'attendee': 'user_id', 'mentor': 'mentor_id', 'guest': 'guest_id'}
+    return [{'kind': kind, 'id': getattr(x, ids[kind]), 'email': x.email, 'badge_data': 'loadtest-' + getattr(x, ids[kind])}
+            for kind, x in participants]
+
+## Load
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+class Recorder:
+    """Latencies and status codes per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+
+    def record(self, name, latency, status):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(latency)
+            counts = self.statuses.setdefault(name, {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def report(self, duration):
+        report = {}
+        for name, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            report[name] = {
+                'requests': len(latencies),
+                'throughput': len(latencies) / duration, # requests per second
+                'p50': percentile(latencies, 50) * 1000, # milliseconds
+                'p95': percentile(latencies, 95) * 1000,
+                'p99': percentile(latencies, 99) * 1000,
+                'statuses': {str(status): count for status, count in sorted(self.statuses[name].items(), key=str)},
+            }
+        return report
+
+class Morning:
+    """Who's arrived so far, shared by the clients"""
+
+    def __init__(self, participants):
+        self.lock = threading.Lock()
+        self.arriving = list(participants)
+        random.shuffle(self.arriving)
+        self.arrived = []
+
+    def next_arrival(self):
+        with self.lock:
+            return self.arriving.pop() if self.arriving else None
+
+    def arrive(self, participant):
+        with self.lock:
+            self.arrived.append(participant)
+
+    def someone(self):
+        with self.lock:
+            return random.choice(self.arrived) if self.arrived else None
+
+def run_client(client, morning, recorder, started, duration, think_time):
+    session = requests.Session()
+    session.headers['Authorization'] = 'Bearer ' + client['token']
+    etags = {}
+
+    def call(name, method, url, **kwargs):
+        request_started = time.time()
+        try:
+            response = session.request(method, url, timeout=10, **kwargs)
+            status = response.status_code
+        except requests.RequestException as e:
+            response, status = None, type(e).__name__
+        recorder.record(name, time.time() - request_started, status)
+        return response
+
+    while True:
+        elapsed = time.time() - started
+        if elapsed >= duration:
+            return
+
+        # sign-ins give way to meal scans as the morning goes on
+        progress = elapsed / duration
+        action = random.choices(['sign-in', 'meal', 'discord', 'dashboard'],
+                                weights=[max(0.0, 1 - 2 * progress) * 3, progress * 3, 0.5, 0.5])[0]
+
+        if action == 'sign-in':
+            participant = morning.next_arrival()
+            if participant:
+                call('dayof.sign_in', 'POST', client['dayof_url'] + '/dayof/v1/sign-in',
+                     json={'user_id': participant['id'], 'badge_data': participant['badge_data']})
+                morning.arrive(participant)
+
+        elif action == 'meal':
+            participant = morning.someone()
+            if participant:
+                call('dayof.meal', 'POST', client['dayof_url'] + '/dayof/v1/meal',
+                     json={'badge_data': participant['badge_data'], 'meal_number': 1 + int(progress * 3), 'allowed_servings': 1})
+
+        elif action == 'discord':
+            participant = morning.someone()
+            if participant:
+                call('discord.verify', 'POST', client['url'] + '/discord/v1/discord-verify', json={'email': participant['email']})
+
+        else:
+            # dashboards poll with the ETags they were given, like a browser would
+            for name, path in [('dayof.sign_in_counts', '/dayof/v1/sign-in'), ('stats.summary', '/stats/v1/summary'),
+                               ('registration.list', '/registration/v1/list')]:
+                headers = {'If-None-Match': etags[path]} if path in etags else {}
+                response = call(name, 'GET', client['url'] + path, headers=headers)
+                if response is not None and response.headers.get('ETag'):
+                    etags[path] = response.headers['ETag']
+
+        # arrivals come in bursts
+        time.sleep(random.expovariate(1 / think_time))
+
+def run_load(url, dayof_url, participants, clients, duration, think_time):
+    morning = Morning(participants)
+    recorder = Recorder()
+    client = {'url': url.rstrip('/'), 'dayof_url': (dayof_url or url).rstrip('/'),
+              'token': create_jwt('loadtest@losaltoshacks.com')}
+
+    started = time.time()
+    threads = [threading.Thread(target=run_client, args=(client, morning, recorder, started, duration, think_time), daemon=True)
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return recorder.report(time.time() - started)
+
+def print_report(report, previous=None):
+    click.echo("{:<24} {:>9} {:>9} {:>9} {:>9} {:>9}  {}".format('endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'statuses'))
+
+    for name, x in report.items():
+        click.echo("{:<24} {:>9} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}  {}".format(
+            name, x['requests'], x['throughput'], x['p50'], x['p95'], x['p99'],
+            ' '.join(status + ':' + str(count) for status, count in x['statuses'].items())))
+
+        before = (previous or {}).get(name)
+        if before:
+            click.echo("{:<24} {:>9} {:>+9.1f} {:>+9.1f} {:>+9.1f} {:>+9.1f}".format(
+                '  vs previous', '', x['throughput'] - before['throughput'],
+                x['p50'] - before['p50'], x['p95'] - before['p95'], x['p99'] - before['p99']))
+
+## Commands
+
+@app.cli.command('loadtest-seed')
+@click.option('--attendees', default=500, help="Synthetic attendees to add")
+@click.option('--mentors', default=50, help="Synthetic mentors to add")
+@click.option('--guests', default=20, help="Synthetic guests to add")
+@click.option('--out', default='loadtest_participants.json', help="File the participants are written to, for `flask loadtest`")
+@click.option('--clear', is_flag=True, help="Only remove the synthetic participants")
+@click.option('--yes', is_flag=True, help="Don't refuse a database that isn't local")
+def loadtest_seed_command(attendees, mentors, guests, out, clear, yes):
+    """Add synthetic participants for load testing"""
+    if not yes and not is_local(app.config['SQLALCHEMY_DATABASE_URI']):
+        raise click.UsageError("Refusing to seed a database that isn't local (pass --yes to seed it anyway)")
+
+    # previous runs' participants are replaced, so they can sign in again
+    clear_participants()
+    if clear:
+        click.echo("Synthetic participants removed")
+        return
+
+    participants = seed_participants(attendees, mentors, guests)
+    with open(out, 'w') as f:
+        json.dump(participants, f)
+
+    click.echo("{} participants written to {}".format(len(participants), out))
+
+@app.cli.command('loadtest')
+@click.option('--url', default='http://localhost:5000', help="The instance to test")
+@click.option('--dayof-url', help="Where to send day-of requests, e.g. the asyncio day-of service (defaults to --url)")
+@click.option('--participants', default='loadtest_participants.json', help="File written by `flask loadtest-seed`")
+@click.option('--clients', default=50, help="Concurrent clients")
+@click.option('--duration', default=60.0, help="Seconds to run for")
+@click.option('--think-time', default=0.2, help="Average seconds each client waits between requests")
+@click.option('--out', help="File to write the results to, as JSON")
+@click.option('--compare', help="Results from a previous run to compare with")
+def loadtest_command(url, dayof_url, participants, clients, duration, think_time, out, compare):
+    """Replay a check-in morning against a running instance"""
+    with open(participants) as f:
+        participants = json.load(f)
+
+    report = run_load(url, dayof_url, participants, clients, duration, think_time)
+
+    previous = None
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)['endpoints']
+
+    print_report(report, previous)
+
+    if out:
+        with open(out, 'w') as f:
+            json.dump({'url': url, 'dayof_url': dayof_url, 'clients': clients, 'duration': duration,
+                       'think_time': think_time, 'participants': len(participants),
+                       'finished': time.strftime('%Y-%m-%dT%H:%M:%S'), 'endpoints': report}, f, indent=4)
@@ -0,0 +1,215 @@
+import bisect
+import heapq
+import re
+import threading
+import unicodedata
+from flask_restful import Resource, reqparse
+from .core import api, db, app
+from .authentication import auth
+from .registration import Signup
+from .mentor import Mentor
+from .guest import Guest
+from .dayof_model import SignIn
+from .changes import changed_keys_since, settled_head
+from .event_model import current_event_id, lookup_event
+
+# Name lookup for the check-in desk: current attendees, mentors and guests, found by the start of any of
+# the words of their name or email as it's typed. The index is kept in memory as a sorted list of
+# (word, participant) pairs, so the participants a prefix matches are next to each other. It's built when
+# the app starts, and brought up to date from the change log before each lookup, like the skill index
+
+# kind -> model, id column, columns the participant is found by
+KINDS = {
+    'attendee': (Signup, Signup.user_id,  [Signup.first_name, Signup.surname, Signup.email]),
+    'mentor':   (Mentor, Mentor.mentor_id, [Mentor.name, Mentor.email]),
+    'guest':    (Guest,  Guest.guest_id,   [Guest.name, Guest.email]),
+}
+
+TABLE_KINDS = {model.__table__.name: kind for kind, (model, _, _) in KINDS.items()}
+
+MAX_LIMIT = 50
+
+# past this many changed participants, the index is built again instead of updated
+MAX_CHANGED = 1000
+
+## Helpers
+
+def words(text):
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode().lower()
+    return [x for x in re.split(r"[^a-z0-9]+", text) if x]
+
+def participant_words(values):
+    # each word, and the whole email, so "jane.doe@" narrows down as it's typed
+    result = set()
+    for value in values:
+        result.update(words(value))
+        if value and '@' in value:
+            result.add(value.lower())
+    return result
+
+class NameIndex:
+    """The current participants of an event by the words of their names, for this process. The lock is
+    only held to read or swap in the in-memory copy, never during queries"""
+
+    def __init__(self, event_id):
+        self.event_id = event_id
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.words = []        # sorted (word, (kind, participant id))
+        self.participants = {} # (kind, participant id) -> participant
+
+    def fetch(self, kind, participant_ids=None):
+        model, id_column, columns = KINDS[kind]
+        query = (db.session.query(id_column, SignIn.signed_out, model.sign_in_id, *columns)
+                           .outerjoin(SignIn, model.sign_in_id == SignIn.id)
+                           .filter(model.event_id == self.event_id, model.outdated == False))
+
+        if participant_ids is not None:
+            query = query.filter(id_column.in_(participant_ids))
+
+        participants = {}
+        for participant_id, signed_out, sign_in_id, *values in query:
+            participants[(kind, participant_id)] = {
+                'kind': kind,
+                'id': participant_id,
+                'name': ' '.join(x for x in values[:-1] if x),
+                'sort_name': ' '.join(x for x in values[:-1] if x).lower(),
+                'email': values[-1],
+                'signed_in': sign_in_id is not None and not signed_out,
+                'words': frozenset(participant_words(values)),
+            }
+
+        return participants
+
+    def add(self, key, participant):
+        self.participants[key] = participant
+        for word in sorted(participant['words']):
+            bisect.insort(self.words, (word, key))
+
+    def remove(self, key):
+        participant = self.participants.pop(key, None)
+        if participant:
+            for word in participant['words']:
+                i = bisect.bisect_left(self.words, (word, key))
+                if i < len(self.words) and self.words[i] == (word, key):
+                    del self.words[i]
+
+    def rebuild(self):
+        cursor = settled_head(db.session.connection())
+        participants = {}
+        for kind in KINDS:
+            participants.update(self.fetch(kind))
+
+        words = sorted((word, key) for key, participant in participants.items() for word in participant['words'])
+
+        with self.lock:
+            self.words, self.participants, self.cursor = words, participants, cursor
+
+    # returns False if the index has to be rebuilt instead
+    def catch_up(self, cursor):
+        changed = changed_keys_since(cursor, list(TABLE_KINDS) + ['sign_in'], MAX_CHANGED)
+        if changed is None:
+            return False
+
+        new_cursor, keys = changed
+        badges = keys.pop('sign_in')
+        changed = {TABLE_KINDS[table]: participant_ids for table, participant_ids in keys.items()}
+        participants = {}
+
+        for kind, (model, id_column, _) in KINDS.items():
+            if badges:
+                changed[kind].update(x for x, in db.session.query(id_column)
+                                                           .join(SignIn, model.sign_in_id == SignIn.id)
+                                                           .filter(SignIn.badge_data.in_(badges), model.event_id == self.event_id,
+                                                                   model.outdated == False))
+            if changed[kind]:
+                participants.update(self.fetch(kind, changed[kind]))
+
+        with self.lock:
+            # another request may have caught up meanwhile
+            if self.cursor == cursor:
+                for kind, participant_ids in changed.items():
+                    for participant_id in participant_ids:
+                        self.remove((kind, participant_id))
+                for key, participant in participants.items():
+                    self.add(key, participant)
+                self.cursor = new_cursor
+
+        return True
+
+    def refresh(self):
+        with self.lock:
+            cursor = self.cursor
+
+        if cursor is None or not self.catch_up(cursor):
+            self.rebuild()
+
+    def prefixed(self, prefix):
+        i = bisect.bisect_left(self.words, (prefix,))
+        while i < len(self.words) and self.words[i][0].startswith(prefix):
+            yield self.words[i]
+            i += 1
+
+    def find(self, query, kind, limit):
+        typed = words(query)
+        if '@' in query:
+            typed = [query.strip().lower()]
+        if not typed:
+            return []
+
+        with self.lock:
+            # the participants the longest word matches, then those matching every other word too
+            longest = max(typed, key=len)
+            keys = set(key for _, key in self.prefixed(longest) if kind is None or key[0] == kind)
+            participants = [self.participants[key] for key in keys]
+
+        others = [x for x in typed if x != longest]
+        if others:
+            participants = [x for x in participants if all(any(w.startswith(o) for w in x['words']) for o in others)]
+
+        # whole words typed first, then by name
+        participants = heapq.nsmallest(limit, participants, key=lambda x: (-sum(w in x['words'] for w in typed), x['sort_name']))
+
+        return [{'kind': x['kind'],
+                 'id': x['id'],
+                 'name': x['name'],
+                 'email': x['email'],
+                 'signed_in': x['signed_in']} for x in participants]
+
+# event id -> NameIndex
+indexes = {}
+
+def event_index(event_id=None):
+    event_id = event_id or current_event_id()
+    return indexes.setdefault(event_id, NameIndex(event_id))
+
+# the configured event's index is built before the first request, instead of during it
+@app.before_first_request
+def build_index():
+    event_id = lookup_event(app.config['EVENT'])
+    if event_id is not None:
+        event_index(event_id).refresh()
+
+## Endpoints
+
+class LookupEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('q',     type=str, required=True, location='args')
+        self.parser.add_argument('kind',  type=str, choices=list(KINDS), location='args')
+        self.parser.add_argument('limit', type=int, default=10,  location='args')
+
+    @auth
+    def get(self):
+        args = self.parser.parse_args()
+        if args['limit'] < 1 or args['limit'] > MAX_LIMIT:
+            return {"message": "limit must be between 1 and " + str(MAX_LIMIT)}, 400
+
+        index = event_index()
+        index.refresh()
+        return index.find(args['q'], args['kind'], args['limit'])
+
+api.add_resource(LookupEndpoint, '/dayof/v1/lookup')
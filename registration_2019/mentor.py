@@ -1,7 +1,9 @@
 import datetime
 import enum
-from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime
-from flask import redirect
+from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime, Index, UniqueConstraint
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from flask import redirect, request
 from flask_restful import Resource, reqparse
 from .core import api, db, app
 from .helper import *
@@ -9,22 +11,34 @@ from .authentication import auth
 from .emailing import send_email_template
 from .registration import TShirtSizeEnum, AcceptanceStatusEnum
 from .dayof_model import SignIn
+from .event_model import Event, current_event_id, open_event
+from .participant import ParticipantQueries, email_taken, version_mapper_args, supersede, precondition_failed, version_changed, CONFLICT, modified
+from .versioning import conditional
+from .serialization import RowSerializer
+from .ratelimit import rate_limited
+from .routing import replica_read
+from .verification import make_token, confirm_email
 
 ## Models
 
 class MentorEmailVerification(db.Model):
     id          = Column(Integer,     nullable=False, primary_key=True)
+    event_id    = Column(Integer,     ForeignKey(Event.id), nullable=False, default=current_event_id)
     mentor_id   = Column(String(36),  nullable=False)
     email       = Column(String(255), nullable=False)
-    email_token = Column(String(36),  nullable=False, default=rand_uuid)
+    email_token = Column(String(36),  nullable=False, default=rand_uuid) # only checked for links sent before signed tokens
     verified    = Column(Boolean,     nullable=False, default=False)
 
+    __table_args__ = (Index('mentor_email_verification_event_mentor', 'event_id', 'mentor_id'),)
+
 class Mentor(db.Model):
     id                    = Column(Integer,                    nullable=False, primary_key=True)
+    event_id              = Column(Integer,                    ForeignKey(Event.id), nullable=False, default=current_event_id)
     mentor_id             = Column(String(36),                 nullable=False, default=rand_uuid)
     name                  = Column(String(255),                nullable=False)
     phone                 = Column(String(255),                nullable=False)
     email                 = Column(String(255),                nullable=False)
+    current_email         = Column(String(255)) # see participant.set_current_emails
     over_18               = Column(Boolean,                    nullable=False)
     skillset              = Column(String(1000))
     tshirt_size           = Column(Enum(TShirtSizeEnum),       nullable=False)
@@ -34,11 +48,19 @@ class Mentor(db.Model):
     acceptance_status     = Column(Enum(AcceptanceStatusEnum), nullable=False, default=AcceptanceStatusEnum.none)
     signed_waiver         = Column(Boolean,                    nullable=False, default=False)
     outdated              = Column(Boolean,                    nullable=False, default=False)
+    version               = Column(Integer,                    nullable=False, default=1) # see participant.version_mapper_args
     timestamp             = Column(DateTime,                   nullable=False, default=datetime.datetime.utcnow)
 
     email_verification    = db.relationship('MentorEmailVerification', foreign_keys='Mentor.email_verification_id')
     sign_in                = db.relationship('SignIn', foreign_keys='Mentor.sign_in_id')
 
+    __table_args__ = (UniqueConstraint('event_id', 'current_email', name='mentor_event_current_email'),
+                      Index('mentor_event_mentor', 'event_id', 'mentor_id'),
+                      Index('mentor_event_email', 'event_id', 'email'),
+                      Index('mentor_event_outdated', 'event_id', 'outdated'))
+
+    __mapper_args__ = version_mapper_args(version)
+
     def as_dict(self):
         result = {c.name: help_jsonify(getattr(self, c.name)) for c in self.__table__.columns}
         result['email_verified'] = self.email_verification.verified
@@ -47,29 +69,35 @@ class Mentor(db.Model):
 
 ## Helper Functions
 
-def email_in_use(new_email):
-    return Mentor.query.filter_by(email=new_email, outdated=False).count() > 0
+clean_mentor = RowSerializer(Mentor, ['mentor_id', 'name', 'email', 'phone', 'tshirt_size',
+                                      'skillset', 'dietary_restrictions', 'signed_waiver',
+                                      'over_18', 'acceptance_status', 'email_verified',
+                                      'timestamp', 'signed_in', 'version'],
+                             {'email_verified': lambda x: x.email_verification.verified,
+                              'signed_in':      lambda x: x.sign_in_id is not None})
 
-def clean_mentor(mentor, extra=[]):
-    return select_keys(mentor.as_dict(), ['mentor_id', 'name', 'email', 'phone', 'tshirt_size',
-                                          'skillset', 'dietary_restrictions', 'signed_waiver',
-                                          'over_18', 'acceptance_status', 'email_verified',
-                                          'timestamp', 'signed_in', *extra])
+mentors = ParticipantQueries(Mentor, Mentor.mentor_id, [Mentor.name, Mentor.email, Mentor.phone],
+                             clean_mentor, "Mentor does not exist", verification='email_verification')
 
-def send_email(mentor, template):
+email_in_use = mentors.email_in_use
+
+def email_data(mentor):
     email_data = select_keys(mentor.as_dict(), ['mentor_id', 'name', 'email', 'phone'
                                                 'tshirt_size', 'dietary_restrictions', 'signed_waiver',
                                                 'acceptance_status'])
 
     first_name = mentor.name.split(' ', 1)[0]
 
-    full_data = {**email_data, 'full_name': mentor.name, 'first_name': first_name, 'email_verification_token': mentor.email_verification.email_token}
-    send_email_template(full_data, template)
+    return {**email_data, 'full_name': mentor.name, 'first_name': first_name,
+            'email_verification_token': make_token('mentor', mentor.mentor_id, mentor.email_verification_id)}
+
+def send_email(mentor, template):
+    send_email_template(email_data(mentor), template)
 
 def add_mentor(mentor):
     db.session.add(mentor)
 
-    email_verification = MentorEmailVerification.query.filter_by(email=mentor.email, mentor_id=mentor.mentor_id).scalar()
+    email_verification = MentorEmailVerification.query.filter_by(event_id=mentor.event_id, email=mentor.email, mentor_id=mentor.mentor_id).scalar()
 
     if not email_verification:
         email_verification = MentorEmailVerification(mentor_id=mentor.mentor_id, email=mentor.email)
@@ -83,14 +111,37 @@ def add_mentor(mentor):
     if not mentor.email_verification.verified:
         send_email(mentor, "mentor_confirmation")
 
-def modify(mentor_id, delta):
+# like registration.create_signup
+def create_mentor(args):
+    mentor_id = rand_uuid()
+    mentor = Mentor(**args, mentor_id=mentor_id, email_verification=MentorEmailVerification(mentor_id=mentor_id, email=args['email']))
+    db.session.add(mentor)
+
+    try:
+        db.session.flush()
+    except IntegrityError as e:
+        db.session.rollback()
+        if email_taken(e):
+            return False
+        raise
+
+    data = email_data(mentor)
+    db.session.commit()
+
+    send_email_template(data, "mentor_confirmation")
+    return True
+
+def modify(mentor_id, delta, if_match=None):
 
     # find the most recent mentor for mentor_id
-    old_mentor = Mentor.query.filter_by(mentor_id=mentor_id, outdated=False).scalar()
+    old_mentor = mentors.current(mentor_id)
 
     if not old_mentor:
         return {"message": "User does not exist"}, 400
 
+    if precondition_failed(old_mentor, if_match):
+        return version_changed(old_mentor)
+
     new_mentor, changed = copy_row(Mentor, old_mentor, ignored_columns=['id', 'outdated', 'timestamp', 'email_verified'], overwrite=delta)
 
     email_verified = delta.get('email_verified')
@@ -107,75 +158,34 @@ def modify(mentor_id, delta):
         return {"message": "Email already in use"}, 400
 
     # validated, update the data
-    if changed:
-        old_mentor.outdated = True
-        add_mentor(new_mentor)
-
-        if new_verified:
-            new_mentor.email_verification.verified = email_verified
-    elif new_verified:
-        # only change is email verification, no new mentor will be created (since verification is in a separate table)
-        old_mentor.email_verification.verified = email_verified
-
-    db.session.commit()
+    try:
+        if changed:
+            supersede(old_mentor, new_mentor)
+            add_mentor(new_mentor)
 
-    return {"status": "ok"}
+            if new_verified:
+                new_mentor.email_verification.verified = email_verified
+        elif new_verified:
+            # only change is email verification, no new mentor will be created (since verification is in a separate table)
+            old_mentor.email_verification.verified = email_verified
 
-def search(query):
-
-    if not query:
-        return []
-    elif type(query) is str:
-        results = Mentor.query.filter((Mentor.mentor_id == query) |
-                                      Mentor.name.contains(query) |
-                                      Mentor.email.contains(query) |
-                                      Mentor.phone.contains(query)).all()
-
-        return [clean_mentor(x, extra=['outdated']) for x in results]
-    else:
-        query = remove_none_values(query)
-        email_verified = query.get('email_verified')
-        outdated = query.get('outdated')
-
-        if email_verified is not None:
-            query.pop('email_verified')
-
-        if outdated == '*':
-            query.pop('outdated')
-
-        if outdated is None:
-            results = Mentor.query.filter_by(**query, outdated=False)
-        else:
-            results = Mentor.query.filter_by(**query)
-
-        return [clean_mentor(x,
-                             # include `outdated` field if it was provided in the request
-                             extra=(['outdated'] if outdated is not None else []))
-                for x in results
-                # have to manually check the email verification if it was provided, since it's in another table
-                if (email_verified is None or
-                    x.email_verification.verified == email_verified)]
-
-def list():
-    return [clean_mentor(x) for x in Mentor.query.filter_by(outdated=False)]
-
-def history(mentor_id):
-    mentors = Mentor.query.filter_by(mentor_id=mentor_id)
-
-    if mentors.count() == 0:
-        return {"message": "Mentor does not exist"}, 400
-    else:
-        return [clean_mentor(x, extra=['outdated']) for x in mentors]
-
-def delete(mentor_id):
-        mentor = Mentor.query.filter_by(mentor_id=mentor_id, outdated=False).scalar()
-        if not mentor:
-            return {"message": "Mentor does not exist"}, 400
-
-        else:
-            mentor.outdated=True
-            db.session.commit()
-            return {"status": "ok"}
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return CONFLICT
+    except IntegrityError as e:
+        db.session.rollback()
+        # the email was taken after it was checked above
+        if email_taken(e):
+            return {"message": "Email already in use"}, 400
+        raise
+
+    return modified(new_mentor.version if changed else old_mentor.version)
+
+search  = mentors.search
+list    = mentors.list
+history = mentors.history
+delete  = mentors.delete
 
 ## Endpoints
 
@@ -193,27 +203,21 @@ class MentorEndpoint(Resource):
         self.parser.add_argument('tshirt_size',           type=TShirtSizeEnum, required=True)
         self.parser.add_argument('dietary_restrictions',  type=strn)
 
+    @rate_limited('mentor.signup')
+    @open_event
     def post(self):
 
         args = self.parser.parse_args()
 
-        if email_in_use(args['email']):
-            mentor = Mentor.query.filter_by(email=args['email'], outdated=False).scalar()
-            #send_email(mentor, "mentor_reregistered") # TODO: Send reregistered email
-            return {"status": "ok"}
-
-        add_mentor(Mentor(**args))
-
+        # the same answer if the email was already registered, so emails can't be probed
+        create_mentor(args) # TODO: Send the mentor_reregistered email when it returns False
         return {"status": "ok"}
 
 class MentorVerifyEndpoint(Resource):
 
+    @open_event
     def get(self, mentor_id, email_token):
-        email_verification = MentorEmailVerification.query.filter_by(mentor_id=mentor_id, email_token=email_token).scalar()
-
-        if email_verification:
-            email_verification.verified = True
-            db.session.commit()
+        if confirm_email('mentor', MentorEmailVerification, MentorEmailVerification.mentor_id, mentor_id, email_token):
             return redirect(app.config['CONFIRMATION_REDIRECT'])
         else:
             return {"message": "Could not verify"}, 422
@@ -236,9 +240,10 @@ class MentorModifyEndpoint(Resource):
         self.parser.add_argument('email_verified',        type=bool)
 
     @auth
+    @open_event
     def post(self, mentor_id):
         args = self.parser.parse_args()
-        return modify(mentor_id, args)
+        return modify(mentor_id, args, request.if_match)
 
 class MentorSearchEndpoint(Resource):
 
@@ -261,6 +266,7 @@ class MentorSearchEndpoint(Resource):
         self.nested_parser.add_argument('outdated',              type=or_types(boolean, strn), location='query')
 
     @auth
+    @replica_read
     def post(self):
         args = self.parser.parse_args()
 
@@ -275,18 +281,22 @@ class MentorSearchEndpoint(Resource):
 class MentorListEndpoint(Resource):
 
     @auth
+    @replica_read
+    @conditional(Mentor, MentorEmailVerification)
     def get(self):
         return list()
 
 class MentorHistoryEndpoint(Resource):
 
     @auth
+    @replica_read
     def get(self, mentor_id):
         return history(mentor_id)
 
 class MentorDeleteEndpoint(Resource):
 
     @auth
+    @open_event
     def get(self, mentor_id):
         return delete(mentor_id)
 
@@ -0,0 +1,187 @@
+from sqlalchemy import or_, bindparam, event
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
+from .core import db
+from .helper import remove_none_values
+from .event_model import current_event_id
+
+# Compiled queries are cached here, keyed on the model and the shape of the filter
+# (which columns are filtered on, not their values), so repeated dashboard queries
+# skip building and compiling the ORM query
+bakery = baked.bakery()
+
+# A participant's `current_email` is their email on their current row, and null on outdated ones.
+# It's unique, so the database keeps two current participants from sharing an email (outdated rows
+# can, which a unique email couldn't allow)
+@event.listens_for(db.session, 'before_flush')
+def set_current_emails(session, flush_context, instances):
+    for x in list(session.new) + list(session.dirty):
+        if hasattr(type(x), 'current_email'):
+            x.current_email = None if x.outdated else x.email
+
+def email_taken(error):
+    return 'current_email' in str(error.orig)
+
+# Participants' rows have a version, as the mapper's `version_id_col`: every update of a row is made
+# `WHERE version = <the version read>`, and fails with StaleDataError if someone else wrote the row
+# since it was read. It's bumped here on every update (including being marked outdated, so two edits of
+# the same row can't both go through), and a participant's new row takes the version after the old one's
+def version_mapper_args(version_column):
+    return {'version_id_col': version_column, 'version_id_generator': False}
+
+@event.listens_for(db.session, 'before_flush')
+def bump_participant_versions(session, flush_context, instances):
+    for x in session.dirty:
+        if hasattr(type(x), 'outdated') and hasattr(type(x), 'version') and session.is_modified(x):
+            x.version += 1
+
+def supersede(old_row, new_row):
+    new_row.version = old_row.version + 1
+    old_row.outdated = True
+
+# `If-Match` on a modify request, checked against the participant's current version
+def precondition_failed(row, if_match):
+    return bool(if_match) and not if_match.contains(str(row.version))
+
+def version_changed(row):
+    return {"message": "Participant was changed since it was read", "version": row.version}, 412
+
+CONFLICT = {"message": "Participant was changed by someone else at the same time, try again"}, 409
+
+# for writes that read the participant's current row themselves (sign-ins, waivers): when the row was
+# changed by someone else in the meantime, the write is rolled back and made again on the row as it is now,
+# once, before giving up with CONFLICT
+def retry_stale(write, *args):
+    for attempt in range(2):
+        try:
+            return write(*args)
+        except StaleDataError:
+            db.session.rollback()
+
+    return CONFLICT
+
+def modified(version):
+    return {"status": "ok", "version": version}, 200, {'ETag': '"' + str(version) + '"'}
+
+class ParticipantQueries:
+    """Queries shared by the Signup, Mentor and Guest endpoints
+
+    `id_column` is the public id (user_id, mentor_id, guest_id), `search_columns` are
+    checked with `contains` on a string search, `clean` turns a row into its response dict,
+    and `verification` names the email verification relationship (if the model has one)
+    """
+
+    def __init__(self, model, id_column, search_columns, clean, missing_message, verification=None):
+        self.model = model
+        self.id_column = id_column
+        self.search_columns = search_columns
+        self.clean = clean
+        self.missing_message = missing_message
+        self.verification = verification
+
+        # relationships read when serializing, loaded in the same query to avoid a lazy load per row
+        self.relationships = [verification] if verification else []
+
+    def _rows(self):
+        model = self.model
+        relationships = self.relationships
+
+        query = bakery(lambda session: session.query(model), model)
+        query += lambda q: q.options(*[joinedload(getattr(model, r)) for r in relationships])
+        query += lambda q: q.filter(model.event_id == bindparam('event_id'))
+        return query
+
+    # every query is within the request's event
+    def _run(self, baked_query, **params):
+        return baked_query(db.session()).params(event_id=current_event_id(), **params)
+
+    def _current(self, query):
+        model = self.model
+        query += lambda q: q.filter(model.outdated == False)
+        return query
+
+    def _by_id(self, query):
+        id_column = self.id_column
+        query += lambda q: q.filter(id_column == bindparam('participant_id'))
+        return query
+
+    def current(self, participant_id):
+        return self._run(self._current(self._by_id(self._rows())), participant_id=participant_id).one_or_none()
+
+    def email_in_use(self, new_email):
+        model = self.model
+
+        query = bakery(lambda session: session.query(model.id), model)
+        query += lambda q: q.filter(model.event_id == bindparam('event_id'), model.email == bindparam('email'))
+        query = self._current(query)
+
+        return self._run(query, email=new_email).first() is not None
+
+    def search(self, query):
+        model = self.model
+
+        if not query:
+            return []
+        elif type(query) is str:
+            id_column = self.id_column
+            search_columns = self.search_columns
+
+            results = self._rows()
+            results += lambda q: q.filter(or_(id_column == bindparam('query'),
+                                              *[c.contains(bindparam('query')) for c in search_columns]))
+
+            return [self.clean(x, extra=['outdated']) for x in self._run(results, query=query)]
+        else:
+            query = remove_none_values(query)
+            email_verified = query.pop('email_verified', None)
+            outdated = query.get('outdated')
+
+            if outdated == '*':
+                query.pop('outdated')
+
+            results = self._rows()
+
+            keys = tuple(sorted(query))
+            if keys:
+                results.add_criteria(lambda q: q.filter(*[getattr(model, k) == bindparam(k) for k in keys]), keys)
+
+            if outdated is None:
+                results = self._current(results)
+
+            # the email verification is in another table, so filter on it through the relationship
+            if email_verified is not None and self.verification:
+                verification = getattr(model, self.verification)
+                target = verification.property.mapper.class_
+                results.add_criteria(lambda q: q.filter(verification.has(target.verified == bindparam('email_verified'))))
+                query['email_verified'] = email_verified
+
+            return [self.clean(x,
+                               # include `outdated` field if it was provided in the request
+                               extra=(['outdated'] if outdated is not None else []))
+                    for x in self._run(results, **query)]
+
+    def list(self):
+        return [self.clean(x) for x in self._run(self._current(self._rows()))]
+
+    def history(self, participant_id):
+        rows = self._run(self._by_id(self._rows()), participant_id=participant_id).all()
+
+        if not rows:
+            return {"message": self.missing_message}, 400
+        else:
+            return [self.clean(x, extra=['outdated']) for x in rows]
+
+    def delete(self, participant_id):
+        participant = self.current(participant_id)
+
+        if not participant:
+            return {"message": self.missing_message}, 400
+        else:
+            participant.outdated = True
+            try:
+                db.session.commit()
+            except StaleDataError:
+                db.session.rollback()
+                return CONFLICT
+            return {"status": "ok"}
@@ -0,0 +1,165 @@
+import click
+from sqlalchemy import func, case
+from sqlalchemy.orm.exc import StaleDataError
+from flask_restful import Resource, reqparse
+from .core import api, db, app
+from .helper import copy_row, boolean
+from .authentication import auth
+from .emailing import queue_email, outbox
+from .registration import Signup, EmailVerification, AcceptanceStatusEnum, email_data
+from .event_model import Event, current_event_id, open_event
+from .participant import supersede, CONFLICT
+
+# Applicants are moved `queue` -> `accepted` while there are seats left at the venue, and
+# `waitlist_queue` -> `waitlisted` while there is room on the waitlist (unlimited if no size is given).
+# Only applicants who verified their email are promoted, in the order they first signed up.
+# Runs for the same event are serialized on the event's row, so one doesn't count the seats
+# before another's promotions are committed and overfill the venue
+
+## Helpers
+
+def counts():
+    accepted, verified, signed_waiver = (
+        db.session.query(func.count(Signup.id),
+                         func.sum(case([(EmailVerification.verified == True, 1)], else_=0)),
+                         func.sum(case([(Signup.signed_waiver == True, 1)], else_=0)))
+                  .join(EmailVerification, Signup.email_verification)
+                  .filter(Signup.event_id == current_event_id(), Signup.outdated == False,
+                          Signup.acceptance_status == AcceptanceStatusEnum.accepted)
+                  .one())
+
+    waitlisted = Signup.query.filter_by(event_id=current_event_id(), outdated=False,
+                                        acceptance_status=AcceptanceStatusEnum.waitlisted).count()
+
+    return {'accepted': accepted, 'verified': verified or 0, 'signed_waiver': signed_waiver or 0, 'waitlisted': waitlisted}
+
+def next_in_line(status, limit):
+    if limit is not None and limit <= 0:
+        return []
+
+    # when each applicant first signed up, so that being modified doesn't move them back in line
+    first_signup = (db.session.query(Signup.user_id, func.min(Signup.timestamp).label('first'))
+                              .filter(Signup.event_id == current_event_id())
+                              .group_by(Signup.user_id)
+                              .subquery())
+
+    query = (Signup.query.join(first_signup, first_signup.c.user_id == Signup.user_id)
+                         .join(EmailVerification, Signup.email_verification)
+                         .filter(Signup.event_id == current_event_id(),
+                                 Signup.outdated == False,
+                                 Signup.acceptance_status == status,
+                                 EmailVerification.verified == True)
+                         .order_by(first_signup.c.first, Signup.id)
+                         .with_for_update(of=Signup))
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.all()
+
+def promote(signups, status):
+    promoted = []
+
+    for old_signup in signups:
+        new_signup, _ = copy_row(Signup, old_signup, ignored_columns=['id', 'outdated', 'timestamp'],
+                                 overwrite={'acceptance_status': status})
+        supersede(old_signup, new_signup)
+        db.session.add(new_signup)
+        promoted.append(new_signup)
+
+    return promoted
+
+def run_promotion(capacity, waitlist_capacity=None, dry_run=False):
+    # held until the promotions are committed (or rolled back)
+    Event.query.filter_by(id=current_event_id()).with_for_update().one()
+
+    current = counts()
+
+    to_accept = next_in_line(AcceptanceStatusEnum.queue, capacity - current['accepted'])
+    to_waitlist = next_in_line(AcceptanceStatusEnum.waitlist_queue,
+                               None if waitlist_capacity is None else waitlist_capacity - current['waitlisted'])
+
+    report = {
+        'dry_run': dry_run,
+        'capacity': capacity,
+        'waitlist_capacity': waitlist_capacity,
+        **current,
+        'accepted_promoted': [x.user_id for x in to_accept],
+        'waitlisted_promoted': [x.user_id for x in to_waitlist],
+    }
+
+    if dry_run:
+        db.session.rollback()
+        return report
+
+    # all of the promotions are made in a single transaction
+    emails = [(x, "acceptance") for x in promote(to_accept, AcceptanceStatusEnum.accepted)]
+    emails += [(x, "waitlisted") for x in promote(to_waitlist, AcceptanceStatusEnum.waitlisted)]
+
+    db.session.flush()
+    emails = [(email_data(x), template) for x, template in emails]
+    db.session.commit()
+
+    # only notify once the promotions are committed
+    for data, template in emails:
+        queue_email(data, template)
+
+    return report
+
+def default_capacity():
+    capacity = app.config.get('VENUE_CAPACITY')
+    return int(capacity) if capacity else None
+
+## Endpoints
+
+class PromoteEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('capacity',          type=int)
+        self.parser.add_argument('waitlist_capacity', type=int)
+        self.parser.add_argument('dry_run',           type=boolean, default=False)
+
+    @auth
+    @open_event
+    def post(self):
+        args = self.parser.parse_args()
+
+        capacity = args['capacity'] if args['capacity'] is not None else default_capacity()
+        if capacity is None:
+            return {"message": "Venue capacity must be provided"}, 400
+
+        try:
+            return run_promotion(capacity, args['waitlist_capacity'], args['dry_run'])
+        except StaleDataError:
+            db.session.rollback()
+            return CONFLICT
+
+api.add_resource(PromoteEndpoint, '/registration/v1/promote')
+
+## Command (to run on a schedule, e.g. from cron with `flask promote`)
+
+@app.cli.command('promote')
+@click.option('--capacity', type=int, help="Venue capacity (defaults to LAH_VENUE_CAPACITY)")
+@click.option('--waitlist-capacity', type=int, help="Waitlist size (unlimited if not given)")
+@click.option('--dry-run', is_flag=True, help="Report who would be promoted without promoting them")
+def promote_command(capacity, waitlist_capacity, dry_run):
+    """Promote the next applicants from the queues"""
+    capacity = capacity if capacity is not None else default_capacity()
+    if capacity is None:
+        raise click.UsageError("Venue capacity must be provided")
+
+    try:
+        report = run_promotion(capacity, waitlist_capacity, dry_run)
+    except StaleDataError:
+        db.session.rollback()
+        raise click.ClickException(CONFLICT[0]['message'])
+
+    click.echo("{accepted} accepted ({verified} verified, {signed_waiver} signed waiver), {waitlisted} waitlisted".format(**report))
+    click.echo(("Would accept: " if dry_run else "Accepted: ") + ", ".join(report['accepted_promoted']))
+    click.echo(("Would waitlist: " if dry_run else "Waitlisted: ") + ", ".join(report['waitlisted_promoted']))
+
+    # wait for the notifications to go out before exiting
+    outbox.join()
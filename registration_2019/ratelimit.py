@@ -0,0 +1,160 @@
+import collections
+import sqlite3
+import threading
+import time
+from flask import request
+from flask_restful import Resource
+from .core import api, app
+from .authentication import auth
+
+# Token buckets, as (capacity, tokens refilled per second)
+# a whole school can be behind one IP, so that limit is looser than the per-email one
+IP_LIMIT    = (20, 1 / 5)
+EMAIL_LIMIT = (3,  1 / 60)
+
+## Stores
+
+def refill(tokens, updated, capacity, rate, now):
+    return min(capacity, tokens + (now - updated) * rate)
+
+class MemoryStore:
+    """Buckets and counters kept in this process"""
+
+    # buckets that have refilled are dropped once there are more than this many, since they're the same as missing ones
+    MAX_BUCKETS = 100000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.counters = collections.Counter()
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            tokens, updated, _ = self.buckets.get(key, (capacity, now, now))
+            tokens = refill(tokens, updated, capacity, rate, now)
+
+            wait = (1 - tokens) / rate if tokens < 1 else 0
+            if not wait:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+
+            if len(self.buckets) > self.MAX_BUCKETS:
+                self.buckets = {k: v for k, v in self.buckets.items() if v[2] > now}
+
+            return wait
+
+    def incr(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def counts(self):
+        with self.lock:
+            return dict(self.counters)
+
+class SQLiteStore:
+    """Buckets and counters kept in a local SQLite file, shared by every worker on the machine"""
+
+    # refilled buckets are deleted every this many takes
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        conn = self.connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS buckets_full_at ON buckets (full_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self.local.takes = 0
+
+        return conn
+
+    def take(self, key, capacity, rate, now):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = refill(tokens, updated, capacity, rate, now)
+
+            wait = (1 - tokens) / rate if tokens < 1 else 0
+            if not wait:
+                tokens -= 1
+
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                         (key, tokens, now, now + (capacity - tokens) / rate))
+
+            self.local.takes += 1
+            if self.local.takes % self.PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def incr(self, name):
+        conn = self.connection()
+        conn.execute("INSERT OR IGNORE INTO counters (name, count) VALUES (?, 0)", (name,))
+        conn.execute("UPDATE counters SET count = count + 1 WHERE name = ?", (name,))
+
+    def counts(self):
+        return dict(self.connection().execute("SELECT name, count FROM counters"))
+
+# LAH_RATE_LIMIT_STORE can point to a SQLite file to share limits between workers
+store = SQLiteStore(app.config['RATE_LIMIT_STORE']) if app.config.get('RATE_LIMIT_STORE') else MemoryStore()
+
+# @rate_limited decorator
+
+# Throttles by client IP (see LAH_TRUSTED_PROXIES behind a load balancer) and by the `email` in the request
+# body, before the request is parsed or touches the database. `name` is the endpoint name used in the counters
+def rate_limited(name, ip_limit=IP_LIMIT, email_limit=EMAIL_LIMIT):
+    def decorator(f):
+        def wrapper(*args, **kwargs):
+
+            now = time.time()
+            wait = store.take('ip:' + str(request.remote_addr), *ip_limit, now)
+            reason = 'ip'
+
+            if not wait:
+                body = request.get_json(silent=True)
+                email = body.get('email') if type(body) is dict else None
+
+                if type(email) is str:
+                    wait = store.take('email:' + email.strip().lower(), *email_limit, now)
+                    reason = 'email'
+
+            if wait:
+                store.incr(name + '.throttled_' + reason)
+                return {"message": "Too many requests"}, 429, {'Retry-After': str(int(wait) + 1)}
+
+            store.incr(name + '.allowed')
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+## Endpoints
+
+class RateLimitStatsEndpoint(Resource):
+
+    @auth
+    def get(self):
+        stats = {}
+        for key, count in store.counts().items():
+            name, counter = key.rsplit('.', 1)
+            stats.setdefault(name, {})[counter] = count
+        return stats
+
+api.add_resource(RateLimitStatsEndpoint, '/ratelimit/v1/stats')
@@ -1,13 +1,22 @@
 import datetime
 import enum
-from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime
-from flask import redirect
+from sqlalchemy import Column, String, SmallInteger, Integer, Enum, Boolean, ForeignKey, DateTime, Index, UniqueConstraint
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from flask import redirect, request
 from flask_restful import Resource, reqparse
 from .core import api, db, app
 from .helper import *
 from .authentication import auth
 from .emailing import send_email_template
 from .dayof_model import SignIn
+from .event_model import Event, current_event_id, open_event
+from .participant import ParticipantQueries, email_taken, version_mapper_args, supersede, precondition_failed, version_changed, CONFLICT, modified
+from .versioning import conditional
+from .serialization import RowSerializer
+from .ratelimit import rate_limited
+from .routing import replica_read
+from .verification import make_token, confirm_email
 
 ## Models
 
@@ -27,17 +36,22 @@ class AcceptanceStatusEnum(enum.Enum):
 
 class EmailVerification(db.Model):
     id          = Column(Integer,     nullable=False, primary_key=True)
+    event_id    = Column(Integer,     ForeignKey(Event.id), nullable=False, default=current_event_id)
     user_id     = Column(String(36),  nullable=False)
     email       = Column(String(255), nullable=False)
-    email_token = Column(String(36),  nullable=False, default=rand_uuid)
+    email_token = Column(String(36),  nullable=False, default=rand_uuid) # only checked for links sent before signed tokens
     verified    = Column(Boolean,     nullable=False, default=False)
 
+    __table_args__ = (Index('email_verification_event_user', 'event_id', 'user_id'),)
+
 class Signup(db.Model):
     id                    = Column(Integer,                    nullable=False, primary_key=True)
+    event_id              = Column(Integer,                    ForeignKey(Event.id), nullable=False, default=current_event_id)
     user_id               = Column(String(36),                 nullable=False, default=rand_uuid)
     first_name            = Column(String(255),                nullable=False)
     surname               = Column(String(255),                nullable=False)
     email                 = Column(String(255),                nullable=False)
+    current_email         = Column(String(255)) # see participant.set_current_emails
     age                   = Column(SmallInteger,               nullable=False)
     school                = Column(String(255),                nullable=False)
     grade                 = Column(SmallInteger,               nullable=False)
@@ -57,11 +71,19 @@ class Signup(db.Model):
     sign_in_id            = Column(Integer,                    ForeignKey(SignIn.id), nullable=True)
     acceptance_status     = Column(Enum(AcceptanceStatusEnum), nullable=False, default=AcceptanceStatusEnum.none)
     outdated              = Column(Boolean,                    nullable=False, default=False)
+    version               = Column(Integer,                    nullable=False, default=1) # see participant.version_mapper_args
     timestamp             = Column(DateTime,                   nullable=False, default=datetime.datetime.utcnow)
 
     email_verification    = db.relationship('EmailVerification', foreign_keys='Signup.email_verification_id')
     sign_in                = db.relationship('SignIn', foreign_keys='Signup.sign_in_id')
 
+    __table_args__ = (UniqueConstraint('event_id', 'current_email', name='signup_event_current_email'),
+                      Index('signup_event_user', 'event_id', 'user_id'),
+                      Index('signup_event_email', 'event_id', 'email'),
+                      Index('signup_event_outdated', 'event_id', 'outdated'))
+
+    __mapper_args__ = version_mapper_args(version)
+
     def as_dict(self):
         result = {c.name: help_jsonify(getattr(self, c.name)) for c in self.__table__.columns}
         result['email_verified'] = self.email_verification.verified
@@ -73,18 +95,23 @@ class Signup(db.Model):
 def invalid_age(args):
     return args['age'] < 18 and not (args['guardian_name'] and args['guardian_email'] and args['guardian_phone_number'])
 
-def email_in_use(new_email):
-    return Signup.query.filter_by(email=new_email, outdated=False).count() > 0
+clean_signup = RowSerializer(Signup, ['user_id', 'first_name', 'surname', 'email', 'age', 'school',
+                                      'grade', 'student_phone_number', 'guardian_name',
+                                      'guardian_email', 'guardian_phone_number', 'gender', 'ethnicity',
+                                      'tshirt_size', 'previous_hackathons', 'github_username',
+                                      'linkedin_profile', 'dietary_restrictions', 'signed_waiver',
+                                      'acceptance_status', 'email_verified', 'signed_in', 'timestamp', 'version'],
+                             {'email_verified': lambda x: x.email_verification.verified,
+                              'signed_in':      lambda x: x.sign_in_id is not None})
 
-def clean_signup(signup, extra=[]):
-    return select_keys(signup.as_dict(), ['user_id', 'first_name', 'surname', 'email', 'age', 'school',
-                                          'grade', 'student_phone_number', 'guardian_name',
-                                          'guardian_email', 'guardian_phone_number', 'gender', 'ethnicity',
-                                          'tshirt_size', 'previous_hackathons', 'github_username',
-                                          'linkedin_profile', 'dietary_restrictions', 'signed_waiver',
-                                          'acceptance_status', 'email_verified', 'signed_in', 'timestamp', *extra])
+signups = ParticipantQueries(Signup, Signup.user_id,
+                             [Signup.first_name, Signup.surname, Signup.email, Signup.student_phone_number,
+                              Signup.guardian_name, Signup.guardian_email, Signup.guardian_phone_number],
+                             clean_signup, "User does not exist", verification='email_verification')
 
-def send_email(signup, template):
+email_in_use = signups.email_in_use
+
+def email_data(signup):
     full_name = signup.first_name + " " + signup.surname
     email_data = select_keys(signup.as_dict(), ['user_id', 'first_name', 'surname', 'email', 'age', 'school',
                                                 'grade', 'student_phone_number', 'guardian_name',
@@ -92,13 +119,16 @@ def send_email(signup, template):
                                                 'tshirt_size', 'dietary_restrictions', 'signed_waiver',
                                                 'acceptance_status'])
 
-    full_data = {**email_data, 'full_name': full_name, 'email_verification_token': signup.email_verification.email_token}
-    send_email_template(full_data, template)
+    return {**email_data, 'full_name': full_name,
+            'email_verification_token': make_token('registration', signup.user_id, signup.email_verification_id)}
+
+def send_email(signup, template):
+    send_email_template(email_data(signup), template)
 
 def add_signup(signup):
     db.session.add(signup)
 
-    email_verification = EmailVerification.query.filter_by(email=signup.email, user_id=signup.user_id).scalar()
+    email_verification = EmailVerification.query.filter_by(event_id=signup.event_id, email=signup.email, user_id=signup.user_id).scalar()
 
     if not email_verification:
         email_verification = EmailVerification(user_id=signup.user_id, email=signup.email)
@@ -112,14 +142,39 @@ def add_signup(signup):
     if not signup.email_verification.verified:
         send_email(signup, "confirmation")
 
-def modify(user_id, delta):
+# a new participant and their email verification are written together, in one flush and one transaction
+# (instead of checking whether the email is in use first). Returns False if the email is already in use
+def create_signup(args):
+    user_id = rand_uuid()
+    signup = Signup(**args, user_id=user_id, email_verification=EmailVerification(user_id=user_id, email=args['email']))
+    db.session.add(signup)
+
+    try:
+        db.session.flush()
+    except IntegrityError as e:
+        db.session.rollback()
+        if email_taken(e):
+            return False
+        raise
+
+    # the email is made before committing, while the rows are still loaded
+    data = email_data(signup)
+    db.session.commit()
+
+    send_email_template(data, "confirmation")
+    return True
+
+def modify(user_id, delta, if_match=None):
 
     # find the most recent signup for user_id
-    old_signup = Signup.query.filter_by(user_id=user_id, outdated=False).scalar()
+    old_signup = signups.current(user_id)
 
     if not old_signup:
         return {"message": "User does not exist"}, 400
 
+    if precondition_failed(old_signup, if_match):
+        return version_changed(old_signup)
+
     new_signup, changed = copy_row(Signup, old_signup, ignored_columns=['id', 'outdated', 'timestamp', 'email_verified'], overwrite=delta)
 
     email_verified = delta.get('email_verified')
@@ -139,79 +194,34 @@ def modify(user_id, delta):
         return {"message": "Email already in use"}, 400
 
     # validated, update the data
-    if changed:
-        old_signup.outdated = True
-        add_signup(new_signup)
-
-        if new_verified:
-            new_signup.email_verification.verified = email_verified
-    elif new_verified:
-        # only change is email verification, no new signup will be created (since verification is in a separate table)
-        old_signup.email_verification.verified = email_verified
-
-    db.session.commit()
-
-    return {"status": "ok"}
+    try:
+        if changed:
+            supersede(old_signup, new_signup)
+            add_signup(new_signup)
 
-def search(query):
+            if new_verified:
+                new_signup.email_verification.verified = email_verified
+        elif new_verified:
+            # only change is email verification, no new signup will be created (since verification is in a separate table)
+            old_signup.email_verification.verified = email_verified
 
-    if not query:
-        return []
-    elif type(query) is str:
-        results = Signup.query.filter((Signup.user_id == query) |
-                                      Signup.first_name.contains(query) |
-                                      Signup.surname.contains(query) |
-                                      Signup.email.contains(query) |
-                                      Signup.student_phone_number.contains(query) |
-                                      Signup.guardian_name.contains(query) |
-                                      Signup.guardian_email.contains(query) |
-                                      Signup.guardian_phone_number.contains(query)).all()
-
-        return [clean_signup(x, extra=['outdated']) for x in results]
-    else:
-        query = remove_none_values(query)
-        email_verified = query.get('email_verified')
-        outdated = query.get('outdated')
-
-        if email_verified is not None:
-            query.pop('email_verified')
-
-        if outdated == '*':
-            query.pop('outdated')
-
-        if outdated is None:
-            results = Signup.query.filter_by(**query, outdated=False)
-        else:
-            results = Signup.query.filter_by(**query)
-
-        return [clean_signup(x,
-                             # include `outdated` field if it was provided in the request
-                             extra=(['outdated'] if outdated is not None else []))
-                for x in results
-                # have to manually check the email verification if it was provided, since it's in another table
-                if (email_verified is None or
-                    x.email_verification.verified == email_verified)]
-
-def list():
-    return [clean_signup(x) for x in Signup.query.filter_by(outdated=False)]
-
-def history(user_id):
-    signups = Signup.query.filter_by(user_id=user_id)
-
-    if signups.count() == 0:
-        return {"message": "User does not exist"}, 400
-    else:
-        return [clean_signup(x, extra=['outdated']) for x in signups]
-
-def delete(user_id):
-        signup = Signup.query.filter_by(user_id=user_id, outdated=False).scalar()
-        if not signup:
-            return {"message": "User does not exist"}, 400
-
-        else:
-            signup.outdated=True
-            db.session.commit()
-            return {"status": "ok"}
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return CONFLICT
+    except IntegrityError as e:
+        db.session.rollback()
+        # the email was taken after it was checked above
+        if email_taken(e):
+            return {"message": "Email already in use"}, 400
+        raise
+
+    return modified(new_signup.version if changed else old_signup.version)
+
+search  = signups.search
+list    = signups.list
+history = signups.history
+delete  = signups.delete
 
 ## Endpoints
 
@@ -240,6 +250,8 @@ class SignupEndpoint(Resource):
         self.parser.add_argument('linkedin_profile',      type=strn)
         self.parser.add_argument('dietary_restrictions',  type=strn)
 
+    @rate_limited('registration.signup')
+    @open_event
     def post(self):
 
         args = self.parser.parse_args()
@@ -247,23 +259,15 @@ class SignupEndpoint(Resource):
         if invalid_age(args):
             return {"message": "Minors must provide guardian information"}, 400
 
-        if email_in_use(args['email']):
-            signup = Signup.query.filter_by(email=args['email'], outdated=False).scalar()
-            #send_email(signup, "reregistered") # TODO: Send reregistered email
-            return {"status": "ok"}
-
-        add_signup(Signup(**args))
-
+        # the same answer if the email was already registered, so emails can't be probed
+        create_signup(args) # TODO: Send the reregistered email when it returns False
         return {"status": "ok"}
 
 class VerifyEndpoint(Resource):
 
+    @open_event
     def get(self, user_id, email_token):
-        email_verification = EmailVerification.query.filter_by(user_id=user_id, email_token=email_token).scalar()
-
-        if email_verification:
-            email_verification.verified = True
-            db.session.commit()
+        if confirm_email('registration', EmailVerification, EmailVerification.user_id, user_id, email_token):
             return redirect(app.config['CONFIRMATION_REDIRECT'])
         else:
             return {"message": "Could not verify"}, 422
@@ -295,9 +299,10 @@ class ModifyEndpoint(Resource):
         self.parser.add_argument('email_verified',        type=bool)
 
     @auth
+    @open_event
     def post(self, user_id):
         args = self.parser.parse_args()
-        return modify(user_id, args)
+        return modify(user_id, args, request.if_match)
 
 class SearchEndpoint(Resource):
 
@@ -333,6 +338,7 @@ class SearchEndpoint(Resource):
         self.nested_parser.add_argument('outdated',              type=or_types(boolean, strn), location='query')
 
     @auth
+    @replica_read
     def post(self):
         args = self.parser.parse_args()
 
@@ -347,18 +353,22 @@ class SearchEndpoint(Resource):
 class ListEndpoint(Resource):
 
     @auth
+    @replica_read
+    @conditional(Signup, EmailVerification)
     def get(self):
         return list()
 
 class HistoryEndpoint(Resource):
 
     @auth
+    @replica_read
     def get(self, user_id):
         return history(user_id)
 
 class DeleteEndpoint(Resource):
 
     @auth
+    @open_event
     def get(self, user_id):
         return delete(user_id)
 
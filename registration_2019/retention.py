@@ -0,0 +1,265 @@
+import datetime
+import shutil
+import time
+import click
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, select, func, and_, not_, exists, true
+from flask_restful import Resource
+from .core import api, db, app
+from .helper import help_jsonify
+from .authentication import auth
+from .event_model import Event
+from .registration import Signup, EmailVerification
+from .mentor import Mentor, MentorEmailVerification
+from .guest import Guest
+from .email_list import EmailSubscription
+from .dedup import BlockingKey, DuplicatePair
+from .campaigns import Campaign, CampaignRecipient
+from .export import Snapshot, SnapshotStatusEnum, snapshot_directory
+from .changes import Change, log_changes, TABLE_KEYS, OperationEnum
+from .versioning import counter_event, mark_changed
+from .events import ARCHIVE_TABLES
+
+# Once an event is closed, the personal details it no longer needs are purged: unverified attendees and
+# mentors are deleted, participants' outdated rows and email verifications are anonymized (their statuses
+# and timestamps are kept, for stats and the promotion order), and the mailing list is deleted. The same is
+# done to the archive tables, for events archived before being purged. The copies of their details kept
+# elsewhere go too: duplicate detection's keys and pairs, campaign recipients, export snapshots (and their
+# files), and the subscribers' emails the change log keys subscriptions by.
+#
+# Rows are purged in small chunks in id order, one short transaction each, with a pause in between so
+# requests aren't kept waiting on locks. Each rule's position is saved with its chunk, so an interrupted
+# purge carries on from where it stopped
+
+# rows per transaction
+CHUNK_SIZE = 500
+
+# seconds between chunks
+PAUSE = 0.2
+
+# what anonymized columns that can't be null are set to
+REDACTED = 'redacted'
+
+PII_COLUMNS = {
+    Signup:                  ['first_name', 'surname', 'email', 'student_phone_number', 'ethnicity', 'guardian_name',
+                              'guardian_email', 'guardian_phone_number', 'github_username', 'linkedin_profile',
+                              'dietary_restrictions'],
+    Mentor:                  ['name', 'phone', 'email', 'dietary_restrictions'],
+    Guest:                   ['name', 'phone', 'email'],
+    EmailVerification:       ['email'],
+    MentorEmailVerification: ['email'],
+    CampaignRecipient:       ['email', 'data'],
+    Change:                  ['row_key'],
+}
+
+## Models
+
+class PurgeProgress(db.Model):
+    rule      = Column(String(64), nullable=False, primary_key=True)
+    cursor    = Column(Integer,    nullable=False, default=0) # last id purged
+    processed = Column(Integer,    nullable=False, default=0)
+    done      = Column(Boolean,    nullable=False, default=False)
+    started   = Column(DateTime,   nullable=False, default=datetime.datetime.utcnow)
+    updated   = Column(DateTime,   nullable=False, default=datetime.datetime.utcnow)
+
+## Helpers
+
+def of_events(table, event_ids):
+    return table.c.event_id.in_(event_ids)
+
+class Rule:
+    """The rows of the purged events in `table` matching `where(table)`: deleted if `delete` is set,
+    otherwise their `model`'s PII columns are blanked. Writes to `logged` tables go to the change log.
+    `events(table, event_ids)` picks the purged events' rows, for tables without an `event_id`, and
+    `before(ids)` is run on each chunk before it's written, in the same transaction"""
+
+    def __init__(self, name, model, table, where, delete=False, logged=True, events=of_events, before=None):
+        self.name = name
+        self.table = table
+        self.where = where
+        self.logged = logged
+        self.events = events
+        self.before = before
+        self.values = None if delete else {c: None if table.c[c].nullable else REDACTED for c in PII_COLUMNS[model]}
+
+        if self.values is not None and 'version' in table.c:
+            self.values['version'] = table.c.version + 1
+
+        key = TABLE_KEYS.get(table.name)
+        # a subscription's key is its email, which shouldn't be written again
+        self.key = table.c[key.key] if key is not None and key.key != 'email' else None
+
+    def condition(self, event_ids):
+        return and_(self.events(self.table, event_ids), self.where(self.table))
+
+def outdated(table):
+    return and_(table.c.outdated == True, table.c.email != REDACTED)
+
+def not_redacted(table):
+    return table.c.email != REDACTED
+
+def unverified(verification):
+    def where(table):
+        return and_(table.c.outdated == False,
+                    not_(exists().where(and_(verification.c.id == table.c.email_verification_id, verification.c.verified == True))))
+    return where
+
+def everything(table):
+    return true()
+
+def finished(table):
+    # a snapshot that's still being built would write its files again
+    return table.c.status != SnapshotStatusEnum.running
+
+def of_campaigns(table, event_ids):
+    campaigns = Campaign.__table__
+    return table.c.campaign_id.in_(select([campaigns.c.id]).where(campaigns.c.event_id.in_(event_ids)))
+
+def of_forgotten_subscribers(table, event_ids):
+    # subscriptions are logged by email, which stays in the log until no kept event has it subscribed
+    subscriptions = EmailSubscription.__table__
+    return and_(table.c.table_name == subscriptions.name, table.c.row_key != None,
+                not_(exists().where(and_(subscriptions.c.email == table.c.row_key, subscriptions.c.event_id.notin_(event_ids)))))
+
+def remove_snapshot_files(ids):
+    for snapshot_id in ids:
+        shutil.rmtree(snapshot_directory(snapshot_id), ignore_errors=True)
+
+def rules(tables, prefix='', logged=True):
+    # deletions first, so deleted rows aren't anonymized beforehand
+    return [Rule(prefix + 'unverified_signups', Signup, tables[Signup], unverified(tables[EmailVerification]), delete=True, logged=logged),
+            Rule(prefix + 'unverified_mentors', Mentor, tables[Mentor], unverified(tables[MentorEmailVerification]), delete=True, logged=logged),
+            Rule(prefix + 'signup_history', Signup, tables[Signup], outdated, logged=logged),
+            Rule(prefix + 'mentor_history', Mentor, tables[Mentor], outdated, logged=logged),
+            Rule(prefix + 'guest_history', Guest, tables[Guest], outdated, logged=logged),
+            Rule(prefix + 'email_verifications', EmailVerification, tables[EmailVerification], not_redacted, logged=logged),
+            Rule(prefix + 'mentor_email_verifications', MentorEmailVerification, tables[MentorEmailVerification], not_redacted, logged=logged),
+            Rule(prefix + 'subscriptions', EmailSubscription, tables[EmailSubscription], everything, delete=True, logged=logged)]
+
+MODELS = [Signup, Mentor, Guest, EmailVerification, MentorEmailVerification, EmailSubscription]
+
+RULES = (rules({model: model.__table__ for model in MODELS})
+         + rules({model: ARCHIVE_TABLES[model] for model in MODELS}, prefix='archive_', logged=False)
+         + [Rule('blocking_keys', BlockingKey, BlockingKey.__table__, everything, delete=True, logged=False),
+            Rule('duplicate_pairs', DuplicatePair, DuplicatePair.__table__, everything, delete=True, logged=False),
+            Rule('campaign_recipients', CampaignRecipient, CampaignRecipient.__table__, not_redacted, logged=False, events=of_campaigns),
+            Rule('export_snapshots', Snapshot, Snapshot.__table__, finished, delete=True, logged=False, before=remove_snapshot_files),
+            # after the subscriptions are deleted
+            Rule('subscription_changes', Change, Change.__table__, everything, logged=False, events=of_forgotten_subscribers)])
+
+def purged_events():
+    # the current event is never purged, even once it's closed
+    return [x for x, in db.session.query(Event.id).filter(Event.closed == True, Event.slug != app.config['EVENT'])]
+
+def clean_progress(progress):
+    return {'rule': progress.rule,
+            'cursor': progress.cursor,
+            'processed': progress.processed,
+            'done': progress.done,
+            'started': help_jsonify(progress.started),
+            'updated': help_jsonify(progress.updated)}
+
+def start_run():
+    PurgeProgress.query.delete()
+    db.session.add_all([PurgeProgress(rule=rule.name) for rule in RULES])
+    db.session.commit()
+
+# purges the next chunk of the rule's rows, returns False once there are none left
+def purge_chunk(rule, progress, event_ids, chunk_size):
+    table = rule.table
+    condition = rule.condition(event_ids)
+    key = rule.key if rule.key is not None else table.c.id
+
+    rows = db.session.execute(select([table.c.id, key]).where(and_(table.c.id > progress.cursor, condition))
+                                                      .order_by(table.c.id).limit(chunk_size)).fetchall()
+    progress.updated = datetime.datetime.utcnow()
+
+    if not rows:
+        progress.done = True
+        db.session.commit()
+        return False
+
+    ids = [x[0] for x in rows]
+
+    if rule.before:
+        rule.before(ids)
+
+    # the condition is checked again, for rows changed since they were read
+    if rule.values is None:
+        result = db.session.execute(table.delete().where(and_(table.c.id.in_(ids), condition)))
+        operation = OperationEnum.delete
+    else:
+        result = db.session.execute(table.update().where(and_(table.c.id.in_(ids), condition)).values(**rule.values))
+        operation = OperationEnum.update
+
+    if rule.logged and result.rowcount:
+        keys = [x[1] for x in rows] if rule.key is not None else [None]
+        log_changes(db.session.connection(), [(table.name, key, operation) for key in keys])
+        mark_changed(db.session, [(counter_event(table.name, event_id), table.name) for event_id in event_ids])
+
+    progress.cursor = ids[-1]
+    progress.processed += result.rowcount
+    db.session.commit()
+    return True
+
+def purge(chunk_size=CHUNK_SIZE, pause=PAUSE, restart=False, report=None):
+    """Runs (or carries on with) the purge of the closed events"""
+    progress = {x.rule: x for x in PurgeProgress.query}
+
+    if restart or any(rule.name not in progress for rule in RULES) or all(x.done for x in progress.values()):
+        start_run()
+        progress = {x.rule: x for x in PurgeProgress.query}
+
+    event_ids = purged_events()
+
+    for rule in RULES:
+        if not event_ids:
+            progress[rule.name].done = True
+            db.session.commit()
+            continue
+
+        while not progress[rule.name].done:
+            if purge_chunk(rule, progress[rule.name], event_ids, chunk_size):
+                if report:
+                    report(progress[rule.name])
+                time.sleep(pause)
+
+    return [clean_progress(progress[rule.name]) for rule in RULES]
+
+def pending():
+    event_ids = purged_events()
+    if not event_ids:
+        return {rule.name: 0 for rule in RULES}
+
+    return {rule.name: db.session.execute(select([func.count()]).select_from(rule.table).where(rule.condition(event_ids))).scalar()
+            for rule in RULES}
+
+## Endpoints
+
+class PurgeProgressEndpoint(Resource):
+
+    @auth
+    def get(self):
+        progress = {x.rule: x for x in PurgeProgress.query}
+        return [clean_progress(progress[rule.name]) for rule in RULES if rule.name in progress]
+
+api.add_resource(PurgeProgressEndpoint, '/retention/v1/progress')
+
+## Command (to run once an event is closed, it can be stopped and run again)
+
+@app.cli.command('purge-pii')
+@click.option('--chunk-size', default=CHUNK_SIZE, help="Rows per transaction")
+@click.option('--pause',      default=PAUSE,      help="Seconds to wait between chunks")
+@click.option('--restart',    is_flag=True,       help="Start over instead of carrying on with an interrupted purge")
+@click.option('--dry-run',    is_flag=True,       help="Only count the rows that would be purged")
+def purge_pii_command(chunk_size, pause, restart, dry_run):
+    """Delete or anonymize the personal details closed events no longer need"""
+    if dry_run:
+        for rule, count in pending().items():
+            click.echo("{}: {} rows".format(rule, count))
+        return
+
+    def report(progress):
+        click.echo("{}: {} rows purged (up to id {})".format(progress.rule, progress.processed, progress.cursor))
+
+    for progress in purge(chunk_size, pause, restart, report):
+        click.echo("{}: done, {} rows".format(progress['rule'], progress['processed']))
@@ -0,0 +1,220 @@
+import collections
+import gzip
+import hashlib
+import hmac
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import click
+from flask import make_response, request
+from flask_restful import Resource, reqparse
+from sqlalchemy import select, and_
+from .core import api, db, app
+from .authentication import auth
+from .registration import Signup
+from .mentor import Mentor
+from .guest import Guest
+from .dayof_model import SignIn
+from .changes import Change
+from .export import settled_head
+from .event_model import current_event_id, lookup_event
+
+# Roster bundles let day-of kiosks check badges without a round trip to the server: a small SQLite file with
+# the current participants of the event (kind, id, name, acceptance, waiver, badge), signed with an HMAC of
+# its bytes using LAH_ROSTER_SECRET. Its version is the change log position it's up to, so a kiosk that has
+# version N asks for `?since=N` and only gets the participants that changed after it, and the ones to drop
+
+# kind -> model, id column, name columns, acceptance column (guests aren't accepted, they're invited)
+KINDS = collections.OrderedDict([
+    ('attendee', (Signup, Signup.user_id,   [Signup.first_name, Signup.surname], Signup.acceptance_status)),
+    ('mentor',   (Mentor, Mentor.mentor_id, [Mentor.name],                       Mentor.acceptance_status)),
+    ('guest',    (Guest,  Guest.guest_id,   [Guest.name],                        None)),
+])
+
+TABLE_KINDS = {model.__table__.name: kind for kind, (model, _, _, _) in KINDS.items()}
+
+# past this many changes since the kiosk's version, it gets a full bundle instead of a delta
+MAX_CHANGES = 5000
+
+# bundles kept in memory, so a room of kiosks on the same version share one
+CACHED_BUNDLES = 32
+
+SCHEMA = ["PRAGMA page_size = 1024",
+          "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID",
+          "CREATE TABLE participant (kind TEXT NOT NULL, id TEXT NOT NULL, name TEXT, acceptance TEXT, waiver INTEGER NOT NULL, "
+          "badge TEXT, signed_out INTEGER, PRIMARY KEY (kind, id)) WITHOUT ROWID",
+          "CREATE INDEX participant_badge ON participant (badge)",
+          "CREATE TABLE removed (kind TEXT NOT NULL, id TEXT NOT NULL, PRIMARY KEY (kind, id)) WITHOUT ROWID"]
+
+## Helpers
+
+def sign(data):
+    return hmac.new(app.config['ROSTER_SECRET'].encode(), data, hashlib.sha256).hexdigest()
+
+def participant_rows(event_id, kind, participant_ids=None):
+    model, id_column, name_columns, acceptance_column = KINDS[kind]
+    query = (db.session.query(id_column, acceptance_column if acceptance_column is not None else db.null(),
+                              model.signed_waiver, SignIn.badge_data, SignIn.signed_out, *name_columns)
+                       .outerjoin(SignIn, model.sign_in_id == SignIn.id)
+                       .filter(model.event_id == event_id, model.outdated == False))
+
+    if participant_ids is not None:
+        query = query.filter(id_column.in_(participant_ids))
+
+    for participant_id, acceptance, waiver, badge, signed_out, *names in query:
+        yield (kind, participant_id, ' '.join(x for x in names if x), acceptance.value if acceptance else None,
+               int(waiver), badge, None if signed_out is None else int(signed_out))
+
+# the participants of each kind changed after `since`, or None if there are too many (or some aren't known)
+def changed_participants(event_id, since, until):
+    rows = db.session.execute(select([Change.table_name, Change.row_key])
+                              .where(and_(Change.id > since, Change.id <= until))
+                              .limit(MAX_CHANGES + 1)).fetchall()
+    if len(rows) > MAX_CHANGES:
+        return None
+
+    changed, badges = {kind: set() for kind in KINDS}, set()
+    for table_name, row_key in rows:
+        if table_name not in TABLE_KINDS and table_name != 'sign_in':
+            continue
+        if row_key is None:
+            return None
+        if table_name == 'sign_in':
+            badges.add(row_key)
+        else:
+            changed[TABLE_KINDS[table_name]].add(row_key)
+
+    # a sign-in changing (e.g. signing out) changes the participant holding the badge
+    if badges:
+        for kind, (model, id_column, _, _) in KINDS.items():
+            changed[kind].update(x for x, in db.session.query(id_column)
+                                                       .join(SignIn, model.sign_in_id == SignIn.id)
+                                                       .filter(SignIn.badge_data.in_(badges), model.event_id == event_id,
+                                                               model.outdated == False))
+
+    return changed
+
+def build_bundle(event_id, since=0):
+    """The bundle of the event's roster as of now, with only what changed after `since` if it's a
+    version the change log can still tell the changes from. Returns (version, base, bytes)"""
+    version = settled_head(db.session.connection())
+    changed = changed_participants(event_id, since, version) if 0 < since <= version else None
+    base = since if changed is not None else 0
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+
+    try:
+        bundle = sqlite3.connect(path)
+        for statement in SCHEMA:
+            bundle.execute(statement)
+
+        bundle.executemany("INSERT INTO meta VALUES (?, ?)", [('event', str(event_id)), ('version', str(version)),
+                                                             ('base', str(base)), ('created', str(int(time.time())))])
+
+        for kind in KINDS:
+            if changed is None:
+                bundle.executemany("INSERT INTO participant VALUES (?, ?, ?, ?, ?, ?, ?)", participant_rows(event_id, kind))
+            elif changed[kind]:
+                rows = list(participant_rows(event_id, kind, changed[kind]))
+                bundle.executemany("INSERT INTO participant VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+                # changed participants without a current row were deleted
+                current = set(x[1] for x in rows)
+                bundle.executemany("INSERT INTO removed VALUES (?, ?)", [(kind, x) for x in changed[kind] - current])
+
+        bundle.commit()
+        bundle.execute("VACUUM")
+        bundle.close()
+
+        with open(path, 'rb') as f:
+            return version, base, f.read()
+    finally:
+        os.remove(path)
+
+class BundleCache:
+    """The last few bundles built, by the event, the version asked for changes since and the version"""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.bundles = collections.OrderedDict() # (event id, since, version) -> (base, bytes)
+
+    def get(self, event_id, since):
+        key = (event_id, since, settled_head(db.session.connection()))
+
+        with self.lock:
+            if key in self.bundles:
+                self.bundles.move_to_end(key)
+                return (key[2],) + self.bundles[key]
+
+        version, base, data = build_bundle(event_id, since)
+
+        with self.lock:
+            self.bundles[(event_id, since, version)] = (base, data)
+            while len(self.bundles) > self.size:
+                self.bundles.popitem(last=False)
+
+        return version, base, data
+
+bundles = BundleCache(CACHED_BUNDLES)
+
+## Endpoints
+
+class RosterBundleEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('since', type=int, default=0, location='args')
+
+    @auth
+    def get(self):
+        if not app.config['ROSTER_SECRET']:
+            return {"message": "Roster bundles aren't set up (LAH_ROSTER_SECRET)"}, 503
+
+        args = self.parser.parse_args()
+        version, base, data = bundles.get(current_event_id(), args['since'])
+
+        # the kiosk is up to date
+        if base and base == version:
+            response = make_response('', 304)
+        else:
+            gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+            response = make_response(gzip.compress(data) if gzipped else data)
+            response.headers['Content-Type'] = 'application/vnd.sqlite3'
+            response.headers['X-Roster-Signature'] = sign(data)
+            if gzipped:
+                response.headers['Content-Encoding'] = 'gzip'
+                response.headers['Vary'] = 'Accept-Encoding'
+
+        response.headers['X-Roster-Version'] = str(version)
+        response.headers['X-Roster-Base'] = str(base)
+        return response
+
+api.add_resource(RosterBundleEndpoint, '/dayof/v1/roster-bundle')
+
+## Command (to set kiosks up before the doors open)
+
+@app.cli.command('roster-bundle')
+@click.argument('path')
+@click.option('--since', default=0, help="Version the kiosk already has (a full bundle if 0)")
+def roster_bundle_command(path, since):
+    """Write the current event's roster bundle to PATH, and its signature to PATH.sig"""
+    if not app.config['ROSTER_SECRET']:
+        raise click.UsageError("LAH_ROSTER_SECRET isn't set")
+
+    event_id = lookup_event(app.config['EVENT'])
+    if event_id is None:
+        raise click.UsageError("The current event (LAH_EVENT) doesn't exist")
+
+    version, base, data = build_bundle(event_id, since)
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open(path + '.sig', 'w') as f:
+        f.write(sign(data) + '\n')
+
+    click.echo("Roster version {} ({} bytes{})".format(version, len(data), ", changes since " + str(base) if base else ""))
@@ -0,0 +1,153 @@
+import datetime
+import random
+import time
+import threading
+from flask import g, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, event, create_engine, select, func, table, column, DateTime
+from sqlalchemy.exc import SQLAlchemyError
+
+# Reads in endpoints marked with @replica_read go to one of the read replicas (if any are configured),
+# everything else goes to the primary. A request sticks to the replica it first read from. Replicas more than
+# READ_YOUR_WRITES_WINDOW seconds behind the primary aren't read from (measured by how long the oldest change
+# in the change log they don't have yet has been waiting), so once that long has passed since a write, every
+# process reads it. A read stays on the primary when:
+# - the request has already written something
+# - the same client wrote something through this process less than READ_YOUR_WRITES_WINDOW seconds ago
+#   (so it reads its own writes). Writes are only remembered by the process that made them, so with several
+#   workers a client's next request can still land on a worker that doesn't know about its write
+# - the request asks for fresh data with `Cache-Control: no-cache`
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica():
+            if 'replica' not in g:
+                g.replica = self.db.choose_replica(self.app)
+            if g.replica is not None:
+                return g.replica
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def use_replica(self):
+        if not has_request_context() or not g.get('replica_read'):
+            return False
+
+        if self._flushing or self.new or self.dirty or self.deleted or self.info.get('wrote'):
+            return False
+
+        if 'no-cache' in request.headers.get('Cache-Control', ''):
+            return False
+
+        return not self.db.wrote_recently(client_key(), self.app.config['READ_YOUR_WRITES_WINDOW'])
+
+def client_key():
+    return request.headers.get('Authorization') or request.remote_addr
+
+# the change log (see changes.py, which can't be imported here). Most writes add to it, so how much of it a
+# replica has tells how far behind it is
+changes = table('change', column('id'), column('timestamp', DateTime))
+
+# seconds since the oldest change the replica doesn't have yet was written (0 if it has them all)
+def measure_lag(primary, replica):
+    with replica.connect() as connection:
+        head = connection.execute(select([func.max(changes.c.id)])).scalar() or 0
+
+    with primary.connect() as connection:
+        missing = connection.execute(select([func.min(changes.c.timestamp)]).where(changes.c.id > head)).scalar()
+
+    if missing is None:
+        return 0
+    return max(0, (datetime.datetime.utcnow() - missing).total_seconds())
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    # this process's recent writes by client, forgotten once there are more than this many clients
+    MAX_RECENT_WRITES = 10000
+
+    # seconds a replica's measured lag is reused for
+    LAG_CHECK_EVERY = 1
+
+    def __init__(self, *args, **kwargs):
+        self.replicas = None
+        self.recent_writes = {}
+        self.replica_lags = {}
+        self.replica_lock = threading.Lock()
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+        event.listen(self.session, 'after_flush', mark_written)
+        event.listen(self.session, 'after_bulk_update', mark_bulk_written)
+        event.listen(self.session, 'after_bulk_delete', mark_bulk_written)
+        event.listen(self.session, 'after_rollback', forget_write)
+        event.listen(self.session, 'after_commit', remember_write)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def replica_engines(self, app):
+        if self.replicas is None:
+            with self.replica_lock:
+                if self.replicas is None:
+                    uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+                    self.replicas = [create_engine(uri, pool_pre_ping=True) for uri in uris]
+
+        return self.replicas
+
+    def replica_lag(self, app, replica):
+        now = time.time()
+        checked = self.replica_lags.get(replica)
+
+        if checked is None or now - checked[0] > self.LAG_CHECK_EVERY:
+            try:
+                lag = measure_lag(self.get_engine(app), replica)
+            except SQLAlchemyError:
+                # unreachable, or the change log isn't there yet
+                lag = float('inf')
+            checked = self.replica_lags[replica] = (now, lag)
+
+        return checked[1]
+
+    # a replica that's caught up (enough), or None to read from the primary
+    def choose_replica(self, app):
+        window = app.config['READ_YOUR_WRITES_WINDOW']
+        caught_up = [x for x in self.replica_engines(app) if self.replica_lag(app, x) <= window]
+
+        return random.choice(caught_up) if caught_up else None
+
+    def record_write(self, key):
+        now = time.time()
+
+        # a minute is longer than any read-your-writes window we'd use
+        if len(self.recent_writes) > self.MAX_RECENT_WRITES:
+            self.recent_writes = {k: t for k, t in self.recent_writes.items() if now - t < 60}
+
+        self.recent_writes[key] = now
+
+    def wrote_recently(self, key, window):
+        return time.time() - self.recent_writes.get(key, 0) < window
+
+def mark_written(session, flush_context):
+    session.info['wrote'] = True
+
+def mark_bulk_written(context):
+    if context.result.rowcount:
+        context.session.info['wrote'] = True
+
+def forget_write(session):
+    session.info.pop('wrote', None)
+
+def remember_write(session):
+    if session.info.pop('wrote', False) and has_request_context():
+        session.db.record_write(client_key())
+
+# @replica_read decorator
+
+def replica_read(f):
+    def wrapper(*args, **kwargs):
+        g.replica_read = True
+        return f(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,122 @@
+import gzip
+import json
+from operator import attrgetter
+from flask import make_response, request, current_app
+from sqlalchemy import Enum, DateTime
+from .core import api
+
+# optional faster backends, used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bodies smaller than this aren't worth compressing, which leaves only list, search and history responses
+COMPRESSION_MIN_SIZE = 1024
+
+# content codings we can produce, in order of preference
+CONTENT_CODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+## Row serialization
+
+def enum_value(x):
+    return None if x is None else x.value
+
+def datetime_string(x):
+    return None if x is None else str(x)
+
+def column_converter(column):
+    if isinstance(column.type, Enum) and column.type.enum_class:
+        return enum_value
+    if isinstance(column.type, DateTime):
+        return datetime_string
+    return None
+
+class RowSerializer:
+    """Turns a model row into the dict returned by the endpoints
+
+    The getter and converter for each field are worked out once per model, so serializing a row
+    is a single pass over its fields with no `type()` checks and no intermediate dict. `computed`
+    maps fields that aren't columns (e.g. `email_verified`) to functions of the row
+    """
+
+    def __init__(self, model, fields, computed={}):
+        self.model = model
+        self.fields = fields
+        self.computed = computed
+        self.getters = {}
+
+    def getter(self, field):
+        if field in self.computed:
+            return self.computed[field]
+
+        get = attrgetter(field)
+        convert = column_converter(self.model.__table__.columns[field])
+
+        if convert:
+            return lambda row: convert(get(row))
+        return get
+
+    def plan(self, extra):
+        key = tuple(extra)
+        plan = self.getters.get(key)
+
+        if plan is None:
+            plan = self.getters[key] = [(f, self.getter(f)) for f in [*self.fields, *extra]]
+
+        return plan
+
+    def __call__(self, row, extra=[]):
+        return {field: get(row) for field, get in self.plan(extra)}
+
+## Representation
+
+def dumps(data):
+    if orjson and not current_app.debug:
+        return orjson.dumps(data)
+
+    # same output as flask-restful's default representation
+    settings = current_app.config.get('RESTFUL_JSON', {})
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+
+    return (json.dumps(data, **settings) + "\n").encode('utf-8')
+
+def negotiate_coding():
+    for coding in CONTENT_CODINGS:
+        if request.accept_encodings[coding]:
+            return coding
+    return None
+
+def compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=6)
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    body = dumps(data)
+    headers = dict(headers or {})
+
+    if len(body) >= COMPRESSION_MIN_SIZE:
+        coding = negotiate_coding()
+
+        if coding:
+            body = compress(body, coding)
+            headers['Content-Encoding'] = coding
+
+            # each coding is a different representation, so it needs its own strong ETag
+            etag = headers.get('ETag')
+            if etag:
+                headers['ETag'] = etag[:-1] + '-' + coding + '"'
+
+        headers['Vary'] = 'Accept-Encoding'
+
+    resp = make_response(body, code)
+    resp.headers.extend(headers)
+    return resp
@@ -0,0 +1,266 @@
+import re
+import threading
+import click
+from sqlalchemy import Column, String, Integer, event, Index
+from flask_restful import Resource, reqparse
+from .core import api, db, app
+from .helper import query_boolean
+from .authentication import auth
+from .mentor import Mentor
+from .dayof_model import SignIn
+from .changes import changed_keys_since, settled_head
+from .event_model import current_event_id
+
+# Mentors' skillsets are split into normalized skills, kept in the MentorSkill table (an inverted index
+# from skill to mentor) whenever a mentor is written. Matching is done against an in-memory copy of
+# the index, which is brought up to date from the change log before each match
+
+# different spellings of the same skill
+ALIASES = {
+    'reactjs':     'react',
+    'react.js':    'react',
+    'js':          'javascript',
+    'es6':         'javascript',
+    'ts':          'typescript',
+    'node.js':     'node',
+    'nodejs':      'node',
+    'vue.js':      'vue',
+    'vuejs':       'vue',
+    'angularjs':   'angular',
+    'py':          'python',
+    'python3':     'python',
+    'golang':      'go',
+    'cpp':         'c++',
+    'csharp':      'c#',
+    'ml':          'machine learning',
+    'ai':          'artificial intelligence',
+    'swiftui':     'swift',
+    'postgres':    'postgresql',
+    'mongo':       'mongodb',
+    'k8s':         'kubernetes',
+}
+
+SEPARATORS = re.compile(r"[,;/|\n]+|\band\b|&")
+
+MAX_SKILL_LENGTH = 64
+
+## Models
+
+class MentorSkill(db.Model):
+    id        = Column(Integer,                 nullable=False, primary_key=True)
+    mentor_id = Column(String(36),              nullable=False)
+    skill     = Column(String(MAX_SKILL_LENGTH), nullable=False)
+
+    __table_args__ = (Index('mentor_skill_skill', 'skill'), Index('mentor_skill_mentor_id', 'mentor_id'))
+
+## Helpers
+
+def normalize(skill):
+    skill = re.sub(r"[^a-z0-9+#. ]", " ", skill.lower())
+    skill = re.sub(r"\s+", " ", skill).strip(" .")
+    return ALIASES.get(skill, skill)[:MAX_SKILL_LENGTH]
+
+# each skill, and for skills of several words each of the words (so "react native" is found for "react")
+def tokenize(skillset):
+    skills = set()
+
+    for part in SEPARATORS.split(skillset or ''):
+        skill = normalize(part)
+        if not skill:
+            continue
+
+        skills.add(skill)
+
+        words = skill.split(' ')
+        if len(words) > 1:
+            skills.update(normalize(word) for word in words if len(word) > 1)
+
+    skills.discard('')
+    return skills
+
+def index_rows(mentor_id, skillset):
+    return [{'mentor_id': mentor_id, 'skill': skill} for skill in sorted(tokenize(skillset))]
+
+@event.listens_for(db.session, 'after_flush')
+def track_mentors(session, flush_context):
+    touched = [x for x in list(session.new) + list(session.dirty) + list(session.deleted)
+               if isinstance(x, Mentor) and (x not in session.dirty or session.is_modified(x))]
+    if not touched:
+        return
+
+    # a mentor's skills are those of their current row (if it was written), none if it was deleted or outdated
+    skillsets = {x.mentor_id: None for x in touched}
+    for x in touched:
+        if not x.outdated and x not in session.deleted:
+            skillsets[x.mentor_id] = x.skillset
+
+    table = MentorSkill.__table__
+    connection = session.connection()
+    connection.execute(table.delete().where(table.c.mentor_id.in_(skillsets)))
+
+    rows = [row for mentor_id, skillset in skillsets.items() for row in index_rows(mentor_id, skillset)]
+    if rows:
+        connection.execute(table.insert(), rows)
+
+class SkillIndex:
+    """The skill index and mentors' sign in state of an event, for this process. The lock is only held
+    to read or swap in the in-memory copy, never during queries"""
+
+    def __init__(self, event_id):
+        self.event_id = event_id
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.skills = {}  # skill -> set of mentor ids
+        self.mentors = {} # mentor id -> mentor
+
+    def fetch(self, mentor_ids=None):
+        query = (db.session.query(Mentor.mentor_id, Mentor.name, Mentor.phone, Mentor.email, SignIn.signed_out, Mentor.sign_in_id)
+                           .outerjoin(SignIn, Mentor.sign_in_id == SignIn.id)
+                           .filter(Mentor.event_id == self.event_id, Mentor.outdated == False))
+        skills = (db.session.query(MentorSkill.mentor_id, MentorSkill.skill)
+                            .join(Mentor, Mentor.mentor_id == MentorSkill.mentor_id)
+                            .filter(Mentor.event_id == self.event_id, Mentor.outdated == False))
+
+        if mentor_ids is not None:
+            query = query.filter(Mentor.mentor_id.in_(mentor_ids))
+            skills = skills.filter(MentorSkill.mentor_id.in_(mentor_ids))
+
+        mentors = {}
+        for mentor_id, name, phone, email, signed_out, sign_in_id in query:
+            mentors[mentor_id] = {'mentor_id': mentor_id, 'name': name, 'phone': phone, 'email': email,
+                                  'signed_in': sign_in_id is not None and not signed_out, 'skills': set()}
+
+        for mentor_id, skill in skills:
+            if mentor_id in mentors:
+                mentors[mentor_id]['skills'].add(skill)
+
+        return mentors
+
+    def add(self, mentor):
+        self.mentors[mentor['mentor_id']] = mentor
+        for skill in mentor['skills']:
+            self.skills.setdefault(skill, set()).add(mentor['mentor_id'])
+
+    def remove(self, mentor_id):
+        mentor = self.mentors.pop(mentor_id, None)
+        if mentor:
+            for skill in mentor['skills']:
+                self.skills.get(skill, set()).discard(mentor_id)
+
+    def rebuild(self):
+        cursor = settled_head(db.session.connection())
+        mentors = self.fetch()
+
+        with self.lock:
+            self.skills, self.mentors = {}, {}
+            for mentor in mentors.values():
+                self.add(mentor)
+            self.cursor = cursor
+
+    # returns False if the index has to be rebuilt instead
+    def catch_up(self, cursor):
+        changed = changed_keys_since(cursor, ['mentor', 'sign_in'])
+        if changed is None:
+            return False
+
+        new_cursor, keys = changed
+        mentor_ids = keys['mentor']
+
+        if keys['sign_in']:
+            mentor_ids.update(x for x, in db.session.query(Mentor.mentor_id)
+                                                    .join(SignIn, Mentor.sign_in_id == SignIn.id)
+                                                    .filter(SignIn.badge_data.in_(keys['sign_in']), Mentor.event_id == self.event_id,
+                                                            Mentor.outdated == False))
+
+        mentors = self.fetch(mentor_ids) if mentor_ids else {}
+
+        with self.lock:
+            # another request may have caught up meanwhile
+            if self.cursor == cursor:
+                for mentor_id in mentor_ids:
+                    self.remove(mentor_id)
+                for mentor in mentors.values():
+                    self.add(mentor)
+                self.cursor = new_cursor
+
+        return True
+
+    def refresh(self):
+        with self.lock:
+            cursor = self.cursor
+
+        if cursor is None or not self.catch_up(cursor):
+            self.rebuild()
+
+    def match(self, skills, signed_in_only, limit):
+        with self.lock:
+            scores = {}
+            for skill in skills:
+                for mentor_id in self.skills.get(skill, ()):
+                    scores.setdefault(mentor_id, []).append(skill)
+
+            mentors = [(self.mentors[mentor_id], matched) for mentor_id, matched in scores.items()
+                       if not signed_in_only or self.mentors[mentor_id]['signed_in']]
+
+        # most skills matched first, then the most specialized
+        mentors.sort(key=lambda x: (-len(x[1]), len(x[0]['skills']), x[0]['name']))
+
+        return [{'mentor_id': mentor['mentor_id'],
+                 'name': mentor['name'],
+                 'phone': mentor['phone'],
+                 'email': mentor['email'],
+                 'signed_in': mentor['signed_in'],
+                 'skills': sorted(mentor['skills']),
+                 'matched': sorted(matched),
+                 'score': len(matched)} for mentor, matched in mentors[:limit]]
+
+# event id -> SkillIndex
+indexes = {}
+
+def event_index():
+    event_id = current_event_id()
+    return indexes.setdefault(event_id, SkillIndex(event_id))
+
+def skill_list(x):
+    skills = tokenize(x)
+    if not skills:
+        raise ValueError("No skills given")
+    return skills
+
+## Endpoints
+
+class MentorMatchEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('skills',    type=skill_list,    required=True, location='args')
+        self.parser.add_argument('signed_in', type=query_boolean, default=True,  location='args')
+        self.parser.add_argument('limit',     type=int,           default=5,     location='args')
+
+    @auth
+    def get(self):
+        args = self.parser.parse_args()
+
+        index = event_index()
+        index.refresh()
+        return index.match(args['skills'], args['signed_in'], args['limit'])
+
+api.add_resource(MentorMatchEndpoint, '/mentor/v1/match')
+
+## Command (to index mentors who signed up before the index existed)
+
+@app.cli.command('reindex-skills')
+def reindex_skills_command():
+    """Rebuild the mentor skill index"""
+    table = MentorSkill.__table__
+    db.session.execute(table.delete())
+
+    rows = [row for mentor_id, skillset in db.session.query(Mentor.mentor_id, Mentor.skillset).filter(Mentor.outdated == False)
+                for row in index_rows(mentor_id, skillset)]
+    if rows:
+        db.session.execute(table.insert(), rows)
+
+    db.session.commit()
+    click.echo(str(len(rows)) + " skills indexed")
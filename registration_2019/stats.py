@@ -0,0 +1,95 @@
+from sqlalchemy import func
+from flask_restful import Resource
+from .core import api, db
+from .helper import help_jsonify
+from .authentication import auth
+from .versioning import conditional, etag
+from .routing import replica_read
+from .registration import Signup, EmailVerification
+from .mentor import Mentor, MentorEmailVerification
+from .guest import Guest
+from .event_model import current_event_id
+
+# tables the stats are computed from, any write to them invalidates the cache
+SOURCES = (Signup, EmailVerification, Mentor, MentorEmailVerification, Guest)
+
+# computed stats, along with the table versions (and event) they were computed at
+cache = {'tag': None, 'stats': None}
+
+## Helpers
+
+def stats_key(x):
+    x = help_jsonify(x)
+
+    if x is None:
+        return 'none'
+    if type(x) is bool:
+        return 'true' if x else 'false'
+    return str(x)
+
+def count_by(model, column, verification=None):
+    query = db.session.query(column, func.count(model.id)).filter(model.event_id == current_event_id(), model.outdated == False)
+
+    if verification:
+        query = query.join(verification, model.email_verification)
+
+    return {stats_key(k): n for k, n in query.group_by(column)}
+
+def breakdown(model, columns, verification=None):
+    result = {'total': db.session.query(func.count(model.id)).filter(model.event_id == current_event_id(), model.outdated == False).scalar()}
+
+    for column in columns:
+        result[column.name] = count_by(model, column)
+
+    if verification:
+        result['email_verified'] = count_by(model, verification.verified, verification)
+
+    return result
+
+def signups_per_day():
+    # date a person first signed up, only counting people who are still registered
+    first_signup = (db.session.query(Signup.user_id, func.min(Signup.timestamp).label('first'))
+                              .filter(Signup.event_id == current_event_id())
+                              .group_by(Signup.user_id)
+                              .subquery())
+    current = db.session.query(Signup.user_id).filter(Signup.event_id == current_event_id(), Signup.outdated == False)
+
+    day = func.date(first_signup.c.first)
+    days = (db.session.query(day, func.count())
+                      .filter(first_signup.c.user_id.in_(current))
+                      .group_by(day)
+                      .order_by(day))
+
+    return [{'date': str(d), 'count': n} for d, n in days]
+
+def compute_stats():
+    return {
+        'attendee': {**breakdown(Signup, [Signup.acceptance_status, Signup.school, Signup.grade,
+                                          Signup.tshirt_size, Signup.dietary_restrictions, Signup.signed_waiver],
+                                 verification=EmailVerification),
+                     'per_day': signups_per_day()},
+        'mentor': breakdown(Mentor, [Mentor.acceptance_status, Mentor.tshirt_size,
+                                     Mentor.dietary_restrictions, Mentor.signed_waiver],
+                            verification=MentorEmailVerification),
+        'guest': breakdown(Guest, [Guest.kind, Guest.signed_waiver]),
+    }
+
+def stats():
+    tag = etag(*SOURCES)
+
+    if cache['tag'] != tag:
+        cache.update(tag=tag, stats=compute_stats())
+
+    return cache['stats']
+
+## Endpoints
+
+class StatsEndpoint(Resource):
+
+    @auth
+    @replica_read
+    @conditional(*SOURCES)
+    def get(self):
+        return stats()
+
+api.add_resource(StatsEndpoint, '/stats/v1/summary')
@@ -0,0 +1,173 @@
+import collections
+import json
+import logging
+import logging.handlers
+import threading
+import time
+from flask import g, request, has_request_context
+from flask_restful import Resource, reqparse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .core import api, app
+from .helper import query_boolean
+from .authentication import auth
+from .breakers import dependencies
+
+# With LAH_SQL_TRACE set, every SQL statement run during a request is recorded with its parameters
+# and timing. Statements run many times in one request (usually a lazy load per row) are flagged, and
+# the plans of statements slower than LAH_SLOW_QUERY_MS are captured with EXPLAIN. Traces are kept for
+# the debug endpoint, and written to LAH_SQL_TRACE_LOG (rotated) if it's set. Parameters are included,
+# so traces can contain participants' details
+
+# statements run at least this many times in a request are flagged
+REPEATED_THRESHOLD = 5
+
+# how many traces the debug endpoint keeps
+MAX_TRACES = 200
+
+# parameters longer than this are cut short
+MAX_PARAMETER_LENGTH = 200
+
+traces = collections.deque(maxlen=MAX_TRACES)
+traces_lock = threading.Lock()
+
+## Helpers
+
+def short(value):
+    value = repr(value)
+    return value if len(value) <= MAX_PARAMETER_LENGTH else value[:MAX_PARAMETER_LENGTH] + '...'
+
+def explain(engine, statement, parameters):
+    if engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    elif engine.dialect.name == 'mysql':
+        prefix = 'EXPLAIN '
+    else:
+        return None
+
+    # on its own connection, straight through the driver so it isn't traced itself
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(prefix + statement, parameters)
+        columns = [x[0] for x in cursor.description]
+        return [dict(zip(columns, [str(v) for v in row])) for row in cursor.fetchall()]
+    except Exception as e:
+        return 'EXPLAIN failed: ' + str(e)
+    finally:
+        connection.close()
+
+def before_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_trace' in g:
+        conn.info.setdefault('trace_started', []).append(time.time())
+
+def after_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_trace' in g and conn.info.get('trace_started'):
+        duration = (time.time() - conn.info['trace_started'].pop()) * 1000
+        g.sql_trace.append((conn.engine, statement, parameters, executemany, duration))
+
+def start_trace():
+    g.sql_trace = []
+    g.sql_trace_started = time.time()
+
+def finish_trace(response):
+    statements = g.pop('sql_trace', None)
+    if not statements:
+        return response
+
+    counts = collections.Counter(statement for _, statement, _, _, _ in statements)
+    slow_ms = app.config['SLOW_QUERY_MS']
+
+    trace = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round((time.time() - g.pop('sql_trace_started')) * 1000, 3),
+        'sql_ms': round(sum(x[4] for x in statements), 3),
+        'statements': [],
+        'repeated': sorted([{'statement': statement, 'count': count} for statement, count in counts.items()
+                            if count >= REPEATED_THRESHOLD], key=lambda x: -x['count']),
+        'slow': 0,
+    }
+
+    for engine, statement, parameters, executemany, duration in statements:
+        entry = {
+            'statement': statement,
+            'parameters': short(parameters),
+            'duration_ms': round(duration, 3),
+            'database': engine.url.database,
+        }
+
+        if duration >= slow_ms:
+            trace['slow'] += 1
+            if not executemany and statement.lstrip().upper().startswith('SELECT'):
+                entry['plan'] = explain(engine, statement, parameters)
+
+        trace['statements'].append(entry)
+
+    with traces_lock:
+        traces.appendleft(trace)
+
+    if trace_log:
+        trace_log.info(json.dumps(trace))
+
+    return response
+
+def open_trace_log(path):
+    logger = logging.getLogger('registration_2019.sql_trace')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(logging.handlers.RotatingFileHandler(path, maxBytes=10 * 1024 * 1024, backupCount=5))
+    return logger
+
+trace_log = None
+
+if app.config.get('SQL_TRACE'):
+    # every engine (including the read replicas)
+    event.listen(Engine, 'before_cursor_execute', before_execute)
+    event.listen(Engine, 'after_cursor_execute', after_execute)
+
+    app.before_request(start_trace)
+    app.after_request(finish_trace)
+
+    if app.config.get('SQL_TRACE_LOG'):
+        trace_log = open_trace_log(app.config['SQL_TRACE_LOG'])
+
+## Endpoints
+
+class SQLTracesEndpoint(Resource):
+
+    parser = reqparse.RequestParser()
+
+    def __init__(self):
+
+        self.parser.add_argument('endpoint', type=str,           location='args')
+        self.parser.add_argument('slow',     type=query_boolean, location='args', default=False)
+        self.parser.add_argument('limit',    type=int,           location='args', default=50)
+
+    @auth
+    def get(self):
+        if not app.config.get('SQL_TRACE'):
+            return {"message": "SQL tracing is not enabled (set LAH_SQL_TRACE)"}, 400
+
+        args = self.parser.parse_args()
+
+        with traces_lock:
+            result = [x for x in traces
+                      if (not args['endpoint'] or x['endpoint'] == args['endpoint'])
+                      and (not args['slow'] or x['slow'] or x['repeated'])]
+
+        return result[:args['limit']]
+
+api.add_resource(SQLTracesEndpoint, '/debug/v1/sql-traces')
+
+# the state of the outbound services' circuit breakers, and their latencies
+class DependenciesEndpoint(Resource):
+
+    @auth
+    def get(self):
+        return [x.status() for x in dependencies.values()]
+
+api.add_resource(DependenciesEndpoint, '/debug/v1/dependencies')
@@ -0,0 +1,57 @@
+import base64
+import hashlib
+import hmac
+import re
+import time
+from .core import app, db
+
+# Verification links carry `<verification id>.<expiry>.<signature>` as their token, signed with
+# LAH_VERIFICATION_SECRET, so a link can be checked without reading the database and confirmed
+# with a single UPDATE. Links sent before this carry the random `email_token` stored on the row
+
+legacy_token = re.compile("^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+def signature(kind, participant_id, verification_id, expires):
+    message = "{}:{}:{}:{}".format(kind, participant_id, verification_id, expires).encode('utf-8')
+    digest = hmac.new(app.config['VERIFICATION_SECRET'].encode('utf-8'), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode('utf-8').rstrip('=')
+
+# `kind` keeps a token for one table from being used on another
+def make_token(kind, participant_id, verification_id):
+    expires = int(time.time()) + app.config['VERIFICATION_TTL']
+    return "{}.{}.{}".format(verification_id, expires, signature(kind, participant_id, verification_id, expires))
+
+# returns the verification id if the token is valid for the participant and hasn't expired
+def read_token(kind, participant_id, token):
+    try:
+        verification_id, expires, sig = token.split('.')
+        verification_id, expires = int(verification_id), int(expires)
+    except ValueError:
+        return None
+
+    if expires < time.time():
+        return None
+
+    if not hmac.compare_digest(sig, signature(kind, participant_id, verification_id, expires)):
+        return None
+
+    return verification_id
+
+def confirm_email(kind, model, id_column, participant_id, token):
+    verification_id = read_token(kind, participant_id, token)
+
+    if verification_id is not None:
+        # already verified rows aren't matched, so repeated clicks don't write anything
+        model.query.filter(model.id == verification_id,
+                           id_column == participant_id,
+                           model.verified == False).update({'verified': True}, synchronize_session=False)
+        db.session.commit()
+        return True
+
+    if legacy_token.match(token):
+        matched = model.query.filter(id_column == participant_id,
+                                     model.email_token == token).update({'verified': True}, synchronize_session=False)
+        db.session.commit()
+        return matched > 0
+
+    return False
@@ -0,0 +1,140 @@
+from flask import request, Response
+from sqlalchemy import event, select, and_, or_
+from sqlalchemy.exc import IntegrityError
+from .core import db
+from .helper import bulk_key
+from .serialization import CONTENT_CODINGS, negotiate_coding
+from .event_model import Event, current_event_id
+
+## Models
+
+# A change counter per event and table, bumped in the same transaction as every write made through the session
+# (just before it commits, so the counters are only locked for as long as the commit takes, and writers of
+# different events don't wait on each other). Roster endpoints build their ETag from them, so an unchanged
+# roster costs a primary key lookup. Tables without an `event_id` share one counter, under event 0
+class TableVersion(db.Model):
+    event_id = db.Column(db.Integer,    primary_key=True, autoincrement=False)
+    name     = db.Column(db.String(64), primary_key=True)
+    version  = db.Column(db.Integer,    nullable=False, default=0)
+
+SHARED = 0
+
+def counter_event(name, event_id):
+    table = db.metadata.tables.get(name)
+    return event_id if table is not None and 'event_id' in table.c else SHARED
+
+# an event's counters, or the shared ones for event 0
+def counter_rows(event_id):
+    return [{'event_id': event_id, 'name': name, 'version': 0} for name, table in db.metadata.tables.items()
+            if name != TableVersion.__tablename__ and ('event_id' in table.c) == (event_id != SHARED)]
+
+# the counters are added with each event (and, for tables added since, when the app starts), so writers
+# only ever update them, instead of racing to insert the first one
+@event.listens_for(db.metadata, 'after_create')
+def add_counters(metadata, connection, **kwargs):
+    table = TableVersion.__table__
+    existing = set((event_id, name) for event_id, name in connection.execute(select([table.c.event_id, table.c.name])))
+    event_ids = [SHARED] + [x for x, in connection.execute(select([Event.id]))]
+
+    missing = [x for event_id in event_ids for x in counter_rows(event_id) if (x['event_id'], x['name']) not in existing]
+
+    if missing:
+        try:
+            connection.execute(table.insert(), missing)
+        except IntegrityError:
+            # another process starting at the same time added them
+            pass
+
+## Helpers
+
+# the update bumping the given (event_id, table name) counters, event_id None for all of a table's counters
+def versions_update(counters):
+    table = TableVersion.__table__
+
+    # all the counters in one statement, which locks them in primary key order
+    # (so concurrent writers can't deadlock on them)
+    conditions = [table.c.name == name if event_id is None else and_(table.c.event_id == event_id, table.c.name == name)
+                  for event_id, name in sorted(counters, key=lambda x: (x[0] is None, x[0] or 0, x[1]))]
+
+    return table.update().where(or_(*conditions)).values(version=table.c.version + 1)
+
+def bump_versions(connection, counters):
+    connection.execute(versions_update(counters))
+
+# writes made through the session bump their counters when it commits
+def mark_changed(session, counters):
+    session.info.setdefault('table_versions', set()).update(counters)
+
+@event.listens_for(db.session, 'after_flush')
+def track_flush(session, flush_context):
+    changed = list(session.new) + list(session.deleted) + [x for x in session.dirty if session.is_modified(x)]
+
+    mark_changed(session, [(counter_event(x.__table__.name, getattr(x, 'event_id', None)), x.__table__.name)
+                           for x in changed if x.__table__.name != TableVersion.__tablename__])
+
+@event.listens_for(db.session, 'after_bulk_update')
+@event.listens_for(db.session, 'after_bulk_delete')
+def track_bulk(context):
+    table = context.mapper.local_table
+    whereclause = context.query.whereclause
+
+    if context.result.rowcount:
+        event_id = bulk_key(whereclause, table.c.event_id) if 'event_id' in table.c and whereclause is not None else None
+        mark_changed(context.session, [(counter_event(table.name, event_id), table.name)])
+
+@event.listens_for(db.session, 'before_commit')
+def bump_on_commit(session):
+    # what's still pending is flushed first, so it's counted too
+    session.flush()
+
+    counters = session.info.pop('table_versions', None)
+    if counters:
+        bump_versions(session.connection(), counters)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changes(session):
+    session.info.pop('table_versions', None)
+
+def etag(*models):
+    event_id = current_event_id()
+    names = [m.__table__.name for m in models]
+
+    versions = db.session.query(TableVersion.event_id, TableVersion.name, TableVersion.version) \
+                         .filter(TableVersion.event_id.in_([event_id, SHARED]), TableVersion.name.in_(names))
+    versions = {(x.event_id, x.name): x.version for x in versions}
+
+    # each event's rows are a different response, from the same tables
+    return '-'.join([str(event_id)] + [str(versions.get((counter_event(name, event_id), name), 0)) for name in names])
+
+# @conditional decorator
+
+# Answers `If-None-Match` with a 304 when none of the given models changed, before running the endpoint
+def conditional(*models):
+    def decorator(f):
+        def wrapper(*args, **kwargs):
+
+            tag = etag(*models)
+
+            # compressed responses carry the tag with their coding appended
+            tags = [tag] + [tag + '-' + coding for coding in CONTENT_CODINGS]
+
+            matched = [t for t in tags if request.if_none_match.contains_weak(t)]
+            if matched:
+                # the 304 carries the tag the client revalidated with (the coded one, if its copy was compressed)
+                coding = negotiate_coding()
+                coded = tag + '-' + coding if coding else tag
+
+                response = Response(status=304)
+                response.set_etag(coded if coded in matched else matched[0])
+                response.headers['Vary'] = 'Accept-Encoding'
+                return response
+
+            result = f(*args, **kwargs)
+
+            # errors are passed through without an ETag
+            if type(result) is tuple:
+                return result
+
+            return result, 200, {'ETag': '"' + tag + '"'}
+        return wrapper
+    return decorator